@@ -0,0 +1,4 @@
+from u19_pipeline import imaging_pipeline
+
+# nframes_good & last_good_file of AcquiredTiff are nullable (bleaching cutoff is not computed by the python ingestion)
+imaging_pipeline.AcquiredTiff.alter(prompt=False)
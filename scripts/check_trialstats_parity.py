@@ -0,0 +1,38 @@
+"""
+Check meso_analysis_utils.get_trialstats (meso_analysis.Trialstats.make) against the expected rows of the fixture
+session in trialstats_parity_fixture.json (no database connection needed).
+Exits with an error if any column of any trial does not match.
+"""
+
+import json
+import pathlib
+import sys
+
+import pandas as pd
+
+from u19_pipeline.utils import meso_analysis_utils as mau
+
+fixture_path = pathlib.Path(pathlib.Path(__file__).parent, 'trialstats_parity_fixture.json')
+
+
+def check_trialstats_fixture(fixture_path=fixture_path):
+    """
+    Returns:
+        parity (pd.DataFrame): per column mismatches (see meso_analysis_utils.compare_trialstats)
+    """
+    with open(fixture_path) as f:
+        fixture = json.load(f)
+
+    trials = pd.DataFrame(fixture['trials'])
+    sync = fixture['sync']
+    python_rows = mau.get_trialstats(trials, sync['block_by_frame'], sync['trial_by_frame'], sync['iter_by_frame'])
+    return mau.compare_trialstats(python_rows, fixture['expected_rows'])
+
+
+if __name__ == '__main__':
+
+    parity = check_trialstats_fixture()
+    print(parity.to_string())
+    if parity['n_mismatch'].sum() > 0 or parity.attrs['python_only_trials'] or parity.attrs['matlab_only_trials']:
+        sys.exit('Trialstats do not match the fixture session')
+    print('Trialstats match the fixture session')
@@ -0,0 +1,138 @@
+import argparse
+import multiprocessing
+import resource
+import time
+
+import pandas as pd
+from datajoint.hash import key_hash
+
+
+def get_behavior_sync_keys(restriction=None):
+    """
+    Get recording keys still missing in BehaviorSync (not synced and not reserved/errored in the jobs table)
+    Input:
+    restriction (dict or str) = Extra restriction for ephys_pipeline.BehaviorSync.key_source (e.g. 'recording_id > 300')
+    Returns:
+    rec_keys    (list)        = List of recording keys, most recent first
+    """
+    from u19_pipeline import ephys_pipeline
+
+    key_source = ephys_pipeline.BehaviorSync.key_source - ephys_pipeline.BehaviorSync
+    if restriction is not None:
+        key_source = key_source & restriction
+
+    rec_keys = key_source.fetch('KEY', order_by='recording_id DESC')
+
+    jobs = ephys_pipeline.schema.jobs & {'table_name': ephys_pipeline.BehaviorSync.table_name}
+    reserved_hashes = set(jobs.fetch('key_hash'))
+    rec_keys = [rec_key for rec_key in rec_keys if key_hash(rec_key) not in reserved_hashes]
+
+    return rec_keys
+
+
+def clear_behavior_sync_errors(restriction=None):
+    """
+    Delete errored BehaviorSync jobs so they are tried again (e.g. after a sync code fix)
+    Returns:
+    num_errors  (int)  = # of error jobs deleted
+    """
+    from u19_pipeline import ephys_pipeline
+
+    error_jobs = ephys_pipeline.schema.jobs & {'table_name': ephys_pipeline.BehaviorSync.table_name, 'status': 'error'}
+    if restriction is not None:
+        error_keys = (ephys_pipeline.BehaviorSync.key_source & restriction).fetch('KEY')
+        error_jobs = error_jobs & [{'key_hash': key_hash(rec_key)} for rec_key in error_keys]
+
+    num_errors = len(error_jobs)
+    if num_errors > 0:
+        error_jobs.delete_quick()
+
+    return num_errors
+
+
+def populate_behavior_sync_recording(rec_key):
+    """
+    Populate BehaviorSync for a single recording with job reservation.
+    Runs in its own worker process (own DB connection, peak memory is for this recording only).
+    Returns:
+    rec_stats (dict) = recording key + status ('synced', 'error', 'reserved'), elapsed_time (s), peak_memory_mb & error_message
+    """
+    from u19_pipeline import ephys_pipeline
+
+    start_time = time.time()
+    ephys_pipeline.BehaviorSync.populate(rec_key, reserve_jobs=True, suppress_errors=True)
+    elapsed_time = time.time() - start_time
+
+    error_message = ''
+    if ephys_pipeline.BehaviorSync & rec_key:
+        status = 'synced'
+    else:
+        job = ephys_pipeline.schema.jobs & {'table_name': ephys_pipeline.BehaviorSync.table_name,
+                                            'key_hash': key_hash(rec_key)}
+        if job:
+            status, error_message = job.fetch1('status', 'error_message')
+        else:
+            # make returned without inserting (e.g. test subjects)
+            status = 'skipped'
+
+    # ru_maxrss is in kB on Linux
+    peak_memory_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+    return dict(rec_key, status=status, elapsed_time=elapsed_time, peak_memory_mb=peak_memory_mb,
+                error_message=error_message)
+
+
+def populate_behavior_sync_parallel(restriction=None, processes=4, clear_errors=False):
+    """
+    Backfill BehaviorSync across many recordings with a process pool.
+    Jobs are reserved in the ephys_pipeline jobs table, so several drivers (or a crashed and restarted one)
+    can run on the same recordings without repeating work. Errors are stored in the jobs table.
+    Input:
+    restriction  (dict or str) = Extra restriction for the recordings to sync
+    processes    (int)         = # of worker processes
+    clear_errors (bool)        = Delete errored jobs before starting so they are tried again
+    Returns:
+    sync_stats   (pd.DataFrame) = One row per recording with status, elapsed_time (s) & peak_memory_mb
+    """
+
+    if clear_errors:
+        num_errors = clear_behavior_sync_errors(restriction)
+        print('Cleared', num_errors, 'BehaviorSync error jobs')
+
+    rec_keys = get_behavior_sync_keys(restriction)
+    print('Recordings to sync:', len(rec_keys))
+
+    sync_stats = list()
+    # Fresh process per recording: no DB connection shared between processes & per recording peak memory
+    ctx = multiprocessing.get_context('spawn')
+    with ctx.Pool(processes=processes, maxtasksperchild=1) as pool:
+        for rec_stats in pool.imap_unordered(populate_behavior_sync_recording, rec_keys):
+            print('recording_id:', rec_stats['recording_id'],
+                  'status:', rec_stats['status'],
+                  f"time: {rec_stats['elapsed_time']:.1f} s",
+                  f"peak memory: {rec_stats['peak_memory_mb']:.0f} MB")
+            sync_stats.append(rec_stats)
+
+    sync_stats = pd.DataFrame(sync_stats)
+    if sync_stats.shape[0] > 0:
+        print(sync_stats['status'].value_counts())
+        print(f"Total time: {sync_stats['elapsed_time'].sum():.1f} s")
+
+    return sync_stats
+
+
+if __name__ == '__main__':
+
+    from scripts.conf_file_finding import try_find_conf_file
+    try_find_conf_file()
+
+    parser = argparse.ArgumentParser(description='Parallel backfill of ephys_pipeline.BehaviorSync')
+    parser.add_argument('--restriction', default=None, help='SQL restriction for recordings, e.g. "recording_id > 300"')
+    parser.add_argument('--processes', type=int, default=4)
+    parser.add_argument('--clear-errors', action='store_true', help='Retry recordings with errors in the jobs table')
+    parser.add_argument('--output', default=None, help='csv file to store per recording timing and memory')
+    args = parser.parse_args()
+
+    sync_stats = populate_behavior_sync_parallel(args.restriction, args.processes, args.clear_errors)
+    if args.output is not None:
+        sync_stats.to_csv(args.output, index=False)
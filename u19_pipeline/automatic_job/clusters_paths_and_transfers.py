@@ -4,12 +4,14 @@ import subprocess
 import json
 import re
 import os
+import shlex
 import time
 
 from datetime import datetime
 from element_interface.utils import dict_to_uuid
 
 import u19_pipeline.automatic_job.params_config as config
+import u19_pipeline.utils.scp_transfers as scp_tr
 #Functions to transfer files (globus, scp, smbclient)
 
 #FOR PNI endpoint
@@ -26,6 +28,15 @@ tiger_ep_dir   = '8e1bbdfe-d234-4a7c-93a5-86086a249918'  # Endpoint of Della's /
 
 tiger_home_dir_globus = '/BRAINCOGS/Data/'
 
+# All globus tasks requested by the pipeline have this label prefix (to poll them all with a single task list call)
+globus_label_prefix = 'u19_pipeline'
+# Max length of globus task labels
+globus_label_max_length = 128
+# Seconds to trust a positive endpoint activation check
+globus_activation_cache_secs = 3600
+# Endpoint activation checks {endpoint_id: time of last positive check}
+globus_endpoint_activation_cache = dict()
+
 #Slurm default values for queue job
 slurm_dict_tiger_default = {
     'job-name': 'kilosort2',
@@ -123,13 +134,34 @@ def get_cluster_vars(cluster):
         raise('Non existing cluster')
 
 def scp_file_transfer(source, dest):
+    '''
+    Copy file from/to cluster ("user@host:path" source or dest) through pooled ssh connection
+    Returns 0 if transfer succeded (as scp)
+    '''
 
     print("scp", source, dest)
 
-    print(["scp", "-i", public_key_location, source, dest])
+    remote_source = scp_tr.split_remote_path(source)
+    remote_dest = scp_tr.split_remote_path(dest)
+
+    # Local copy, nothing to do with the cluster
+    if remote_source is None and remote_dest is None:
+        p = subprocess.Popen(["scp", "-i", public_key_location, source, dest])
+        transfer_status = p.wait()
+        return transfer_status
+
+    try:
+        if remote_source is not None:
+            user, host, remote_path = remote_source
+            scp_tr.get_remote_client(user, host).get(remote_path, dest)
+        else:
+            user, host, remote_path = remote_dest
+            scp_tr.get_remote_client(user, host).put(source, remote_path)
+        transfer_status = config.system_process['SUCCESS']
+    except Exception as e:
+        print('scp transfer failed', source, dest, e)
+        transfer_status = 1
 
-    p = subprocess.Popen(["scp", "-i", public_key_location, source, dest])
-    transfer_status = p.wait()
     return transfer_status
 
 
@@ -146,17 +178,11 @@ def cp_file_transfer(source, dest):
     transfer_status = p.wait()
     return transfer_status
 
-def request_globus_transfer(job_id_str, source_ep, dest_ep, source_filepath, dest_filepath):
-
-    source_fullpath = source_ep+ ":" + source_filepath
-    dest_fullpath   = dest_ep  + ":" + dest_filepath
+def get_globus_submit_result(p):
+    '''
+    Get task_id (or error) from output of a globus transfer/delete submission
+    '''
 
-    globus_command = ["globus", "transfer", source_fullpath, dest_fullpath, '--label', job_id_str, '--recursive', '--format', 'json']
-    print('**********************************')
-    print(globus_command)
-    print('**********************************')
-    p = subprocess.run(globus_command, capture_output=True)
-    print(p)
     transfer_request = dict()
     print('p.stderr',p.stderr)
     print('p.stdout', p.stdout)
@@ -178,16 +204,97 @@ def request_globus_transfer(job_id_str, source_ep, dest_ep, source_filepath, des
     return transfer_request
 
 
-def request_globus_transfer_status(job_id):
+def get_globus_label(label):
+    '''
+    Label for globus task with pipeline prefix, cropped to globus max label length
+    '''
 
-    globus_command = ["globus", "task", "show", job_id, '--format', 'json']
-    s = subprocess.run(globus_command, capture_output=True)
-    task_output = json.loads(s.stdout.decode('UTF-8'))
+    label = globus_label_prefix + '_' + label
+    return label[:globus_label_max_length]
+
+
+def check_globus_endpoint_activated(endpoint_id):
+    '''
+    Check if globus endpoint is activated, positive checks are cached for globus_activation_cache_secs
+    '''
+
+    last_check = globus_endpoint_activation_cache.get(endpoint_id, None)
+    if last_check is not None and time.time() - last_check < globus_activation_cache_secs:
+        return True
+
+    globus_command = ["globus", "endpoint", "is-activated", endpoint_id, '--format', 'json']
+    p = subprocess.run(globus_command, capture_output=True)
+
+    # Exit code 1 is "not activated", other exit codes are auth / CLI failures: endpoint can not be trusted either
+    activated = p.returncode == 0
+    if activated:
+        globus_endpoint_activation_cache[endpoint_id] = time.time()
+    else:
+        print('globus endpoint not activated', endpoint_id, p.stdout, p.stderr)
+
+    return activated
+
+
+def request_globus_transfer(job_id_str, source_ep, dest_ep, source_filepath, dest_filepath):
+
+    source_fullpath = source_ep+ ":" + source_filepath
+    dest_fullpath   = dest_ep  + ":" + dest_filepath
+
+    globus_command = ["globus", "transfer", source_fullpath, dest_fullpath, '--label', job_id_str, '--recursive', '--format', 'json']
+    print('**********************************')
+    print(globus_command)
+    print('**********************************')
+    p = subprocess.run(globus_command, capture_output=True)
+    print(p)
+    transfer_request = get_globus_submit_result(p)
+
+    return transfer_request
+
+
+def request_globus_transfer_batch(label, source_ep, dest_ep, transfer_paths):
+    '''
+    Request a single globus transfer task for many directories (globus batch input)
+    Input:
+    label          (str)  = Label of globus task
+    source_ep      (str)  = Source endpoint id
+    dest_ep        (str)  = Destination endpoint id
+    transfer_paths (list) = List of (source_filepath, dest_filepath) directories to transfer
+    Returns:
+    transfer_request (dict) = Same as request_globus_transfer, status, task_id & error_info
+    '''
 
     transfer_request = dict()
-    if task_output['status'] == 'SUCCEEDED':
+    for this_ep in [source_ep, dest_ep]:
+        if not check_globus_endpoint_activated(this_ep):
+            transfer_request['status'] = config.system_process['ERROR']
+            transfer_request['error_info'] = 'Globus endpoint ' + this_ep + ' is not activated (or activation check failed)'
+            return transfer_request
+
+    batch_input = ''
+    for source_filepath, dest_filepath in transfer_paths:
+        batch_input += shlex.quote(source_filepath) + ' ' + shlex.quote(dest_filepath) + ' --recursive\n'
+
+    globus_command = ["globus", "transfer", source_ep, dest_ep, '--batch', '-', '--label', label, '--format', 'json']
+    print('**********************************')
+    print(globus_command)
+    print(batch_input)
+    print('**********************************')
+    p = subprocess.run(globus_command, input=batch_input.encode('UTF-8'), capture_output=True)
+    print(p)
+    transfer_request = get_globus_submit_result(p)
+
+    return transfer_request
+
+
+def get_globus_transfer_status(globus_status):
+    '''
+    Translate globus task status to pipeline transfer status
+    '''
+
+    transfer_request = dict()
+    if globus_status == 'SUCCEEDED':
         transfer_request['status'] = config.system_process['COMPLETED']
-    elif task_output['status'] in ['PENDING','RETRYING', 'ACTIVE']:
+    elif globus_status in ['PENDING','RETRYING', 'ACTIVE']:
         transfer_request['status'] = config.system_process['SUCCESS']
     else:
         transfer_request['status'] = config.system_process['ERROR']
@@ -195,14 +302,110 @@ def request_globus_transfer_status(job_id):
     return transfer_request
 
 
-def globus_transfer_to_tiger(job_id, raw_rel_path, modality):
+def request_globus_transfer_status(job_id):
 
-    job_id_str = "job_id_"+str(job_id)+"_raw_transfer"
-    source_ep = pni_ep_id
-    dest_ep   = tiger_ep_dir
+    globus_command = ["globus", "task", "show", job_id, '--format', 'json']
+    s = subprocess.run(globus_command, capture_output=True)
+    task_output = json.loads(s.stdout.decode('UTF-8'))
+
+    transfer_request = get_globus_transfer_status(task_output['status'])
+
+    return transfer_request
+
+
+def request_globus_transfers_status(task_ids):
+    '''
+    Get status of many globus tasks with a single task list call (tasks with pipeline label prefix)
+    Returns:
+    transfers_status (dict) = {task_id: transfer_request (same as request_globus_transfer_status)}
+                              tasks not found in task list are not included
+    '''
+
+    task_ids = [str(x) for x in task_ids]
+    if len(task_ids) == 0:
+        return dict()
+
+    globus_command = ["globus", "task", "list", '--filter-label', globus_label_prefix, '--inexact',
+                      '--limit', '1000', '--format', 'json']
+    s = subprocess.run(globus_command, capture_output=True)
+
+    transfers_status = dict()
+    try:
+        task_list = json.loads(s.stdout.decode('UTF-8'))
+    except ValueError:
+        print('Failed to retrieve globus task list', s.stderr)
+        return transfers_status
+
+    if isinstance(task_list, dict):
+        task_list = task_list.get('DATA', list())
+
+    for this_task in task_list:
+        if this_task['task_id'] in task_ids:
+            transfers_status[this_task['task_id']] = get_globus_transfer_status(this_task['status'])
+
+    return transfers_status
+
+
+def get_globus_endpoints(type_dir='raw'):
+    '''
+    Get source & destination endpoints of globus transfers
+    raw:       pni   -> tiger
+    processed: tiger -> pni
+    '''
+
+    if type_dir == 'raw':
+        return pni_ep_id, tiger_ep_dir
+    else:
+        return tiger_ep_dir, pni_ep_id
+
+
+def get_globus_transfer_paths(rel_path, modality, type_dir='raw'):
+    '''
+    Get source & destination endpoints and directories of globus transfers
+    raw:       pni   -> tiger
+    processed: tiger -> pni
+    '''
+
+    source_ep, dest_ep = get_globus_endpoints(type_dir)
+    if type_dir == 'raw':
+        source_filepath = pathlib.Path(cluster_vars['spock']['root_data_dir_globus'], modality, rel_path).as_posix()
+        dest_filepath = pathlib.Path(cluster_vars['tiger']['root_data_dir_globus'], modality, rel_path).as_posix()
+    else:
+        dest_filepath = pathlib.Path(cluster_vars['spock']['processed_data_dir_globus'], modality, rel_path).as_posix()
+        source_filepath = pathlib.Path(cluster_vars['tiger']['processed_data_dir_globus'], modality, rel_path).as_posix()
+
+    return source_ep, dest_ep, source_filepath, dest_filepath
+
+
+def globus_transfer_batch(transfer_jobs, type_dir='raw'):
+    '''
+    Transfer directories of many jobs in a single globus task
+    Input:
+    transfer_jobs (list) = List of (job_id, rel_path, modality)
+    type_dir      (str)  = raw (pni -> tiger) or processed (tiger -> pni)
+    Returns:
+    transfer_request (dict) = Same as request_globus_transfer (all jobs share the task)
+    '''
+
+    source_ep, dest_ep = get_globus_endpoints(type_dir)
+
+    transfer_paths = list()
+    for _, rel_path, modality in transfer_jobs:
+        _, _, source_filepath, dest_filepath = get_globus_transfer_paths(rel_path, modality, type_dir)
+        transfer_paths.append((source_filepath, dest_filepath))
+
+    job_ids_str = '_'.join([str(x[0]) for x in transfer_jobs])
+    label = get_globus_label(type_dir + '_transfer_job_id_' + job_ids_str)
+
+    transfer_request = request_globus_transfer_batch(label, source_ep, dest_ep, transfer_paths)
 
-    source_filepath = pathlib.Path(cluster_vars['spock']['root_data_dir_globus'], modality, raw_rel_path).as_posix()
-    dest_filepath = pathlib.Path(cluster_vars['tiger']['root_data_dir_globus'], modality, raw_rel_path).as_posix()
+    return transfer_request
+
+
+def globus_transfer_to_tiger(job_id, raw_rel_path, modality):
+
+    job_id_str = get_globus_label("job_id_"+str(job_id)+"_raw_transfer")
+    source_ep, dest_ep, source_filepath, dest_filepath = get_globus_transfer_paths(raw_rel_path, modality, 'raw')
 
     transfer_request = request_globus_transfer(job_id_str, source_ep, dest_ep, source_filepath, dest_filepath)
 
@@ -210,12 +413,8 @@ def globus_transfer_to_tiger(job_id, raw_rel_path, modality):
 
 def globus_transfer_to_pni(job_id, processed_rel_path, modality):
 
-    job_id_str = "job_id_"+str(job_id)+"_processed_transfer"
-    source_ep = tiger_ep_dir
-    dest_ep   = pni_ep_id
-
-    dest_filepath = pathlib.Path(cluster_vars['spock']['processed_data_dir_globus'], modality, processed_rel_path).as_posix()
-    source_filepath = pathlib.Path(cluster_vars['tiger']['processed_data_dir_globus'], modality, processed_rel_path).as_posix()
+    job_id_str = get_globus_label("job_id_"+str(job_id)+"_processed_transfer")
+    source_ep, dest_ep, source_filepath, dest_filepath = get_globus_transfer_paths(processed_rel_path, modality, 'processed')
 
     transfer_request = request_globus_transfer(job_id_str, source_ep, dest_ep, source_filepath, dest_filepath)
 
@@ -302,16 +501,8 @@ def check_directory_exists_cluster(directory, cluster, modality, type_dir='raw')
     else:
         final_directory = pathlib.Path(cluster_vars[cluster]['processed_data_dir'], modality, directory).as_posix()
 
-    base_command = "ssh " + this_cluster_vars['user']+'@'+this_cluster_vars['hostname'] + " "
-
-    command = "'if [ -d " +  final_directory + " ]; "
-    post_command = """then
-                   echo "1"
-                   else echo "0"
-                   fi'"""
-
-    command = base_command + command + post_command
-    dir_exists = int(subprocess.check_output(command, shell=True).decode().strip())
+    remote_client = scp_tr.get_remote_client(this_cluster_vars['user'], this_cluster_vars['hostname'])
+    dir_exists = remote_client.is_dir(final_directory)
 
     if dir_exists:
         return final_directory
@@ -326,11 +517,8 @@ def delete_directory_cluster(directory, cluster):
 
     this_cluster_vars = get_cluster_vars(cluster)
 
-    command = "ssh " + this_cluster_vars['user']+'@'+this_cluster_vars['hostname']\
-        + " 'rm -R " + directory + " '"
-
-    p = subprocess.run(command, shell=True)
-    output = p.returncode
+    remote_client = scp_tr.get_remote_client(this_cluster_vars['user'], this_cluster_vars['hostname'])
+    output, _, _ = remote_client.exec_command('rm -R ' + directory)
 
     if output != 0:
         output = -1
@@ -355,6 +543,21 @@ def delete_directory_tiger_globus(modality, raw_rel_path):
     return output
 
 
+def delete_directories_tiger_globus(globus_filepaths):
+    '''
+    Delete many directories in cluster with a single globus delete task (globus batch input)
+    '''
+
+    batch_input = ''.join([shlex.quote(x) + '\n' for x in globus_filepaths])
+
+    globus_command = ["globus", "delete", tiger_ep_dir, '--batch', '-', '--recursive',
+                      '--label', get_globus_label('delete_empty_directories'), '--format', 'json']
+    p = subprocess.run(globus_command, input=batch_input.encode('UTF-8'), capture_output=True)
+    output = p.returncode
+
+    return output
+
+
 def delete_empty_data_directory_cluster(cluster, type='raw'):
     """
     Check if directory (or its childs) contains files and if not delete them
@@ -362,7 +565,7 @@ def delete_empty_data_directory_cluster(cluster, type='raw'):
 
     max_deletion = 10
     this_cluster_vars = get_cluster_vars(cluster)
-    base_command = "ssh " + this_cluster_vars['user']+'@'+this_cluster_vars['hostname'] + ' '
+    remote_client = scp_tr.get_remote_client(this_cluster_vars['user'], this_cluster_vars['hostname'])
 
     # Check base directory to delete
     if type == 'raw':
@@ -376,43 +579,40 @@ def delete_empty_data_directory_cluster(cluster, type='raw'):
         deleted_dirs = 0
 
         # List all directories on base (raw/processed) directory
-        command_list_dir = base_command + 'find ' + filepath + ' -type d  -print'
-        p = subprocess.run(command_list_dir, shell=True, capture_output=True)
+        command_list_dir = 'find ' + filepath + ' -type d  -print'
+        _, list_dir, _ = remote_client.exec_command(command_list_dir)
 
-        list_dir = p.stdout.decode()
+        list_dir = list_dir.decode()
         list_dir = list_dir.split('\n')
         if '.' in list_dir:
             list_dir.remove('.')
         if '' in list_dir:
             list_dir.remove('')
 
+        raw_globus_dirs = list()
         for dir in list_dir:
 
+            # Parent directory already going to be deleted (raw directories are deleted in a batch)
+            if any([dir.startswith(x + '/') for x in raw_globus_dirs]):
+                continue
+
             # Check if directory has no files in it (empty)
-            command = base_command + 'find ' + dir + ' -type f | wc -l'
-            num_files = subprocess.check_output(command, shell=True)
+            command = 'find ' + dir + ' -type f | wc -l'
+            _, num_files, _ = remote_client.exec_command(command)
             num_files = int(num_files.decode().strip())
 
             #If directory empty, delete it
             if num_files == 0:
                 if type == 'raw':
 
-                    # For raw directories, delete with globus
-                    # Translate local directory to globus dir
+                    # For raw directories, delete with globus (all of them in a single task, below)
+                    # Base directory and modality directories are kept
                     dir_globus = dir.replace(this_cluster_vars['root_data_dir'], '')
                     dir_globus = dir_globus[1:]
+                    if "/" not in dir_globus:
+                        continue
 
-                    index_sep = dir_globus.index("/")
-                    modality = dir_globus[0:index_sep]
-                    dir_globus = dir_globus[index_sep+1:]
-
-                    #Delete with globus
-                    status = delete_directory_tiger_globus(modality, dir_globus)
-                    time.sleep(2)
-                    if status == config.system_process['SUCCESS']:
-                        deleted_dirs = 1
-                        break
-                    total_deletion +=1
+                    raw_globus_dirs.append(dir)
                 else:
                     #Delete processed files with "normal" ssh
                     status = delete_directory_cluster(dir, cluster)
@@ -421,6 +621,15 @@ def delete_empty_data_directory_cluster(cluster, type='raw'):
                         break
                     total_deletion +=1
 
+        # Delete all empty raw directories with globus
+        # Globus deletion is asynchronous, don't repeat listing (deleted directories would appear again)
+        if len(raw_globus_dirs) > 0:
+            globus_filepaths = [pathlib.Path(cluster_vars['tiger']['root_data_dir_globus'],\
+                x.replace(this_cluster_vars['root_data_dir'], '')[1:]).as_posix() for x in raw_globus_dirs]
+            status = delete_directories_tiger_globus(globus_filepaths)
+            print('globus delete', globus_filepaths, status)
+            break
+
         # If in this round no directories were deleted we are done
         if deleted_dirs == 0 or total_deletion >= max_deletion:
             break
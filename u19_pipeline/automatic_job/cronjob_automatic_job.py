@@ -5,15 +5,31 @@ try_find_conf_file()
 
 time.sleep(1)
 
+import u19_pipeline.automatic_job.params_config as config
 import u19_pipeline.automatic_job.recording_handler as rec_handler
 import u19_pipeline.automatic_job.recording_process_handler as rec_process_handler
+import u19_pipeline.utils.scp_transfers as scp_tr
+
+
+def process_handler_main():
+    # Concurrent driver can be rolled back to the serial one with config.process_handler_concurrent
+    if config.process_handler_concurrent:
+        rec_process_handler.RecProcessHandler.pipeline_handler_main_concurrent(
+            config.process_handler_max_workers, config.process_handler_max_jobs_per_host)
+    else:
+        rec_process_handler.RecProcessHandler.pipeline_handler_main()
+
 
 # Check recordings and then jobs
-rec_handler.RecordingHandler.pipeline_handler_main()
-time.sleep(5)
-rec_process_handler.RecProcessHandler.pipeline_handler_main()
-time.sleep(5)
-rec_process_handler.RecProcessHandler.pipeline_handler_main()
+try:
+    rec_handler.RecordingHandler.pipeline_handler_main()
+    time.sleep(5)
+    process_handler_main()
+    time.sleep(5)
+    process_handler_main()
+finally:
+    # Persistent ssh connections to clusters opened during this run
+    scp_tr.close_remote_clients()
 
 time.sleep(5)
 #Check if we need to delete empty directories
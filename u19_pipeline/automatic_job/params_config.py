@@ -37,7 +37,8 @@ recording_status_dict = [
         'UpdateField': None,       # Which field in the u19_recording.recording table will be updated
         'ProcessFunction': None,   # Which function to execute in workflow for this status
         'FunctionField': None,     # Which field of u19_recording.recording will be used in status function
-        'SlackMessage': None       # Slack notification message for this status
+        'SlackMessage': None,      # Slack notification message for this status
+        'ClaimJob': False          # Process function has side effects outside the DB (rig transfer, new process jobs): record is claimed before it runs
     },
     {
         'Value': 0,
@@ -46,7 +47,8 @@ recording_status_dict = [
         'UpdateField': None,
         'ProcessFunction': None,
         'FunctionField': None,
-        'SlackMessage': None
+        'SlackMessage': None,
+        'ClaimJob': False
     },
     {
         'Value': 1,
@@ -55,7 +57,8 @@ recording_status_dict = [
         'UpdateField': 'task_copy_id_pni',
         'ProcessFunction': 'local_transfer_request',
         'FunctionField': 'recording_process_pre_path',
-        'SlackMessage': None
+        'SlackMessage': None,
+        'ClaimJob': True
     },
     {
         'Value': 2,
@@ -64,7 +67,8 @@ recording_status_dict = [
         'UpdateField': None,
         'ProcessFunction': 'local_transfer_check',
         'FunctionField': 'task_copy_id_pni',
-        'SlackMessage': 'Recording was transferred to braininit (cup) drive' 
+        'SlackMessage': 'Recording was transferred to braininit (cup) drive',
+        'ClaimJob': False
     },
     {
         'Value': 3,
@@ -73,7 +77,8 @@ recording_status_dict = [
         'UpdateField': None,
         'ProcessFunction': 'modality_preingestion',
         'FunctionField': None,
-        'SlackMessage': None 
+        'SlackMessage': None,
+        'ClaimJob': True
     },
   
 ]
@@ -91,7 +96,9 @@ recording_process_status_dict = [
         'UpdateField': None,
         'ProcessFunction': None,
         'FunctionField': None,
-        'SlackMessage': None
+        'SlackMessage': None,
+        'ConcurrentSafe': False,  # Process function only waits on clusters (no DB access), can run in a thread
+        'ClaimJob': False         # Process function has side effects outside the DB (sbatch, globus task): job is claimed before it runs
     },
     {
         'Value': -1,
@@ -100,7 +107,9 @@ recording_process_status_dict = [
         'UpdateField': None,
         'ProcessFunction': None,
         'FunctionField': None,
-        'SlackMessage': None
+        'SlackMessage': None,
+        'ConcurrentSafe': False,
+        'ClaimJob': False
     },
     {
         'Value': 0,
@@ -109,7 +118,9 @@ recording_process_status_dict = [
         'UpdateField': None,
         'ProcessFunction': None,
         'FunctionField': None,
-        'SlackMessage': None
+        'SlackMessage': None,
+        'ConcurrentSafe': False,
+        'ClaimJob': False
     },
     {
         'Value': 1,
@@ -118,7 +129,9 @@ recording_process_status_dict = [
         'UpdateField': 'task_copy_id_pre',
         'ProcessFunction': 'transfer_request',
         'FunctionField': 'recording_process_pre_path',
-        'SlackMessage': None
+        'SlackMessage': None,
+        'ConcurrentSafe': True,
+        'ClaimJob': True
     },
     {
         'Value': 2,
@@ -127,7 +140,9 @@ recording_process_status_dict = [
         'UpdateField': None,
         'ProcessFunction': 'transfer_check',
         'FunctionField': 'task_copy_id_pre',
-        'SlackMessage': None
+        'SlackMessage': None,
+        'ConcurrentSafe': True,
+        'ClaimJob': False
     },
     {
         'Value': 3,
@@ -136,7 +151,9 @@ recording_process_status_dict = [
         'UpdateField': 'slurm_id',
         'ProcessFunction': 'slurm_job_queue',
         'FunctionField': None,
-        'SlackMessage': 'Job was queued to be processed in cluster' 
+        'SlackMessage': 'Job was queued to be processed in cluster',
+        'ConcurrentSafe': False,
+        'ClaimJob': True
     },
     {
         'Value': 4,
@@ -145,7 +162,9 @@ recording_process_status_dict = [
         'UpdateField': None,
         'ProcessFunction': 'slurm_job_check',
         'FunctionField': 'slurm_id',
-        'SlackMessage': None
+        'SlackMessage': None,
+        'ConcurrentSafe': True,
+        'ClaimJob': False
     },
     {
         'Value': 5,
@@ -154,7 +173,9 @@ recording_process_status_dict = [
         'UpdateField': 'task_copy_id_post',
         'ProcessFunction': 'transfer_request',
         'FunctionField': 'recording_process_post_path',
-        'SlackMessage': None
+        'SlackMessage': None,
+        'ConcurrentSafe': True,
+        'ClaimJob': True
     },
     {
         'Value': 6,
@@ -163,7 +184,9 @@ recording_process_status_dict = [
         'UpdateField': None,
         'ProcessFunction': 'transfer_check',
         'FunctionField': 'task_copy_id_post',
-        'SlackMessage': 'Processed data was transferred to cup. Available on the GUI'
+        'SlackMessage': 'Processed data was transferred to cup. Available on the GUI',
+        'ConcurrentSafe': True,
+        'ClaimJob': False
     },
     {
         'Value': 7,
@@ -172,7 +195,9 @@ recording_process_status_dict = [
         'UpdateField': None,
         'ProcessFunction': 'populate_element',
         'FunctionField': None,
-        'SlackMessage': 'Job was successfully processed. Data in element DB' 
+        'SlackMessage': 'Job was successfully processed. Data in element DB',
+        'ConcurrentSafe': False,
+        'ClaimJob': False
     },
     {
         'Value': 8,
@@ -181,7 +206,9 @@ recording_process_status_dict = [
         'UpdateField': None,
         'ProcessFunction': 'populate_element',
         'FunctionField': None,
-        'SlackMessage': None
+        'SlackMessage': None,
+        'ConcurrentSafe': False,
+        'ClaimJob': False
     },
 ]
 
@@ -261,6 +288,9 @@ startup_pipeline_matlab_dir = pathlib.Path(u19_matlab_dir, 'scripts').as_posix()
 
 this_dir = os.path.dirname(__file__)
 ingest_scaninfo_script = pathlib.Path(this_dir, 'ingest_scaninfo_shell.sh').as_posix()
+# AcquiredTiff & TiffSplit ingested in python (tiff headers only, bleaching cutoff not computed)
+# instead of ingest_scaninfo_script
+acquired_tiff_python_ingestion = False
 
 # Look for CATGT directory (Should be present on same directory as U19-Pipeline_Python)
 catgt_dir = pathlib.Path(datajoint_proj_dir, 'CatGT-linux')
@@ -280,6 +310,15 @@ xyz_picks_n = pathlib.Path(xyz_picks_files_dir, 'xyz_picks_shank%d.json').as_pos
 chanmap_files_filepath = pathlib.Path(this_dir, 'ChanMapFiles').as_posix()
 default_chanmap_filename = 'chanmap_%s.mat'
 
+# Active process jobs & parameter sets of previous handler call (cron job runs handler in a new process every time)
+handler_cache_filepath = pathlib.Path(this_dir, 'HandlerCache').as_posix()
+handler_cache_filename = 'recording_process_handler_cache.pkl'
+
+# Cron job runs the recording process handler with pipeline_handler_main_concurrent (False: serial pipeline_handler_main)
+process_handler_concurrent = True
+process_handler_max_workers = 8
+process_handler_max_jobs_per_host = 2
+
 
 #Slack notification channels
 slack_webhooks = lab.SlackWebhooks.fetch()
@@ -7,5 +7,9 @@ time.sleep(1)
 
 import datajoint as dj
 import u19_pipeline.automatic_job.pupillometry_handler as ph
+import u19_pipeline.utils.scp_transfers as scp_tr
 
-ph.PupillometryProcessingHandler.check_processed_pupillometry_sessions()
+try:
+    ph.PupillometryProcessingHandler.check_processed_pupillometry_sessions()
+finally:
+    scp_tr.close_remote_clients()
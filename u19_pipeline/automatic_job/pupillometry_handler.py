@@ -22,6 +22,7 @@ import u19_pipeline.automatic_job.params_config as config
 from u19_pipeline.automatic_job import recording_handler
 from u19_pipeline.utils.file_utils import write_file
 import u19_pipeline.automatic_job.clusters_paths_and_transfers as ft
+import u19_pipeline.utils.scp_transfers as scp_tr
 
 def pupillometry_exception_handler(func):
     def inner_function(*args, **kwargs):
@@ -162,16 +163,14 @@ class PupillometryProcessingHandler():
         ]
 
         print(command)
-        p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        #p = os.popen(command_new).read()
-        p.wait()
-        stdout, stderr = p.communicate()
+        remote_client = scp_tr.get_remote_client('u19prod', PupillometryProcessingHandler.spock_system_name)
+        returncode, stdout, stderr = remote_client.exec_command(' '.join(command[2:]))
 
-        print(p.returncode)
+        print(returncode)
         print(stderr)
         print(stdout)
 
-        if p.returncode == 0:
+        if returncode == 0:
             error_message = ''
             batch_job_sentence = stdout.decode('UTF-8')
             print('batch_job_sentence', batch_job_sentence)
@@ -180,7 +179,7 @@ class PupillometryProcessingHandler():
         else:
             error_message = stderr.decode('UTF-8')
 
-        return p.returncode, id_slurm_job, error_message
+        return returncode, id_slurm_job, error_message
 
 
     @staticmethod
@@ -16,6 +16,8 @@ import u19_pipeline.utils.scp_transfers as scp_tr
 from u19_pipeline.automatic_job import ephys_element_ingest
 import u19_pipeline.automatic_job.params_config as config
 
+from u19_pipeline.automatic_job.status_batch_writer import StatusBatchWriter
+
 
 
 def exception_handler(func):
@@ -46,59 +48,85 @@ class RecordingHandler():
         #Get info from all the possible status for a processjob
         df_all_recordings = RecordingHandler.get_active_recordings()
 
-        #For all active process jobs
-        for i in range(df_all_recordings.shape[0]):
+        # All status updates & logs of this call are written together at the end
+        # (except recordings claimed for process functions with side effects, written right after them)
+        batch_writer = StatusBatchWriter(recording.Recording, 'status_recording_id', recording.LogStatus)
 
-            #Filter current process job
-            recording_series = df_all_recordings.loc[i, :]
+        try:
+            #For all active process jobs
+            for i in range(df_all_recordings.shape[0]):
 
-            #Filter current status info
-            current_status = recording_series['status_recording_id']
-            next_status_series    = config.recording_status_df.loc[config.recording_status_df['Value'] == current_status+1, :].squeeze()
+                #Filter current process job
+                recording_series = df_all_recordings.loc[i, :]
 
-            print('function to apply:', next_status_series['ProcessFunction'])
+                #Filter current status info
+                current_status = recording_series['status_recording_id']
+                next_status_series    = config.recording_status_df.loc[config.recording_status_df['Value'] == current_status+1, :].squeeze()
 
-            # Get processing function
-            function_status_process = getattr(RecordingHandler, next_status_series['ProcessFunction'])
+                print('function to apply:', next_status_series['ProcessFunction'])
 
-            #Trigger process, if success update recording process record
-            try:
-                status, update_dict = function_status_process(recording_series)
+                # Get processing function
+                function_status_process = getattr(RecordingHandler, next_status_series['ProcessFunction'])
 
                 #Get dictionary of record process
                 key = recording_series['query_key']
 
-                if status == config.status_update_idx['NEXT_STATUS']:
-                    #Get values to update
-                    next_status = next_status_series['Value']
-                    value_update = update_dict['value_update']
-                    field_update = next_status_series['UpdateField']
+                # Process functions with side effects outside the DB (rig transfer, new process jobs) only run
+                # if this call could claim the recording, and its status is written right after them
+                claim_job = next_status_series['ClaimJob']
+                if claim_job and not batch_writer.claim(key, current_status):
+                    continue
+
+                #Trigger process, if success update recording process record
+                try:
+                    status, update_dict = function_status_process(recording_series)
+
+                    if status == config.status_update_idx['NEXT_STATUS']:
+                        #Get values to update
+                        next_status = next_status_series['Value']
+                        value_update = update_dict['value_update']
+                        field_update = next_status_series['UpdateField']
+
+                        # Update status in u19_recording.recording table (possibly other field as well)
+                        RecordingHandler.update_status_pipeline(key, next_status, field_update, value_update,\
+                            batch_writer=batch_writer, expected_status=current_status)
+
+                        # Send slack Message to webhook if slack message activated for status (once status is written)
+                        if next_status_series['SlackMessage']:
+                            batch_writer.after_flush(key, slack_utils.send_slack_update_notification,\
+                                config.slack_webhooks_dict['automation_pipeline_update_notification'],\
+                                next_status_series['SlackMessage'], recording_series)
 
-                    # Update status in u19_recording.recording table (possibly other field as well)
-                    RecordingHandler.update_status_pipeline(key, next_status, field_update, value_update)
+                    #An error occurred in process
+                    if status == config.status_update_idx['ERROR_STATUS']:
+                        next_status = config.RECORDING_STATUS_ERROR_ID
+                        RecordingHandler.update_status_pipeline(key,next_status, None, None,\
+                            batch_writer=batch_writer, expected_status=current_status)
+                        batch_writer.after_flush(key, slack_utils.send_slack_error_notification,\
+                            config.slack_webhooks_dict['automation_pipeline_error_notification'],\
+                            copy.deepcopy(update_dict['error_info']) ,recording_series)
 
-                    # Send slack Message to webhook if slack message activated for status
-                    if next_status_series['SlackMessage']:
-                        slack_utils.send_slack_update_notification(config.slack_webhooks_dict['automation_pipeline_update_notification'],\
-                             next_status_series['SlackMessage'], recording_series)
+                    #if success or error update status timestamps table
+                    if status != config.status_update_idx['NO_CHANGE']:
+                        RecordingHandler.update_recording_log(recording_series['recording_id'], current_status, next_status, update_dict['error_info'],\
+                            batch_writer=batch_writer)
 
-                #An error occurred in process
-                if status == config.status_update_idx['ERROR_STATUS']:
-                    next_status = config.RECORDING_STATUS_ERROR_ID
-                    RecordingHandler.update_status_pipeline(key,next_status, None, None)
-                    slack_utils.send_slack_error_notification(config.slack_webhooks_dict['automation_pipeline_error_notification'],\
-                        update_dict['error_info'] ,recording_series)
+                    if claim_job:
+                        batch_writer.flush([key])
 
-                #if success or error update status timestamps table
-                if status != config.status_update_idx['NO_CHANGE']:
-                    RecordingHandler.update_recording_log(recording_series['recording_id'], current_status, next_status, update_dict['error_info'])
+                except Exception as err:
+                    raise(err)
+                    ## Send notification error, update recording to error
 
+                finally:
+                    if claim_job:
+                        batch_writer.release(key)
 
-            except Exception as err:
-                raise(err)
-                ## Send notification error, update recording to error
+                time.sleep(2)
 
-            time.sleep(2)
+        # Write what was already processed even if a recording failed
+        finally:
+            batch_writer.flush()
 
 
     @staticmethod
@@ -161,7 +189,12 @@ class RecordingHandler():
 
         id_task = rec_series['task_copy_id_pni']
 
-        is_finished, exit_code = scp_tr.check_scp_transfer(id_task)
+        data_directory = pathlib.Path(dj.config['custom']['root_data_dir'], rec_series['recording_modality'], rec_series['recording_directory']).as_posix()
+        data_directory = pathlib.Path(data_directory).parent
+
+        # Completion is read from the transfer manifest (pid is checked if transfer has no manifest)
+        is_finished, exit_code = scp_tr.check_transfer(rec_series['ip_address'], rec_series['system_user'],
+        rec_series['local_directory'], data_directory.as_posix(), id_task)
 
         if is_finished:
             if exit_code == 0:
@@ -229,7 +262,7 @@ class RecordingHandler():
 
 
     @staticmethod
-    def update_status_pipeline(recording_key_dict, status, update_field=None, update_value=None):
+    def update_status_pipeline(recording_key_dict, status, update_field=None, update_value=None, batch_writer=None, expected_status=None):
         """
         Update recording.Recording table status and optional task field
         Args:
@@ -237,6 +270,8 @@ class RecordingHandler():
             status                     (int):    value of the status to be updated
             update_field               (str):    name of the field to be updated as extra (only applicable to some status)
             update_value             (str|int):  field value to be inserted on in task_field
+            batch_writer  (StatusBatchWriter):   if given, update is queued in batch_writer
+            expected_status            (int):    status read for the record (for batch_writer optimistic update)
         """
 
         print('recording_key_dict', recording_key_dict)
@@ -244,6 +279,10 @@ class RecordingHandler():
         print('update_field', update_field)
         print('update_value', update_value)
 
+        if batch_writer is not None:
+            batch_writer.update_status(recording_key_dict, status, expected_status, update_field, update_value)
+            return
+
         if update_field is not None:
             update_task_id_dict = recording_key_dict.copy()
             update_task_id_dict[update_field] = update_value
@@ -256,11 +295,11 @@ class RecordingHandler():
         recording.Recording.update1(update_status_dict)
 
     @staticmethod
-    def update_recording_log(recording_id, current_status, next_status, error_info_dict):
+    def update_recording_log(recording_id, current_status, next_status, error_info_dict, batch_writer=None):
         """
         Update recording.RecordingLog table status and optional task field
         Args:
-
+            batch_writer  (StatusBatchWriter):  if given, log row is queued in batch_writer
         """
 
         now = datetime.now()
@@ -283,7 +322,10 @@ class RecordingHandler():
         key['recording_error_message'] = error_info_dict['error_message']
         key['recording_error_exception'] = error_info_dict['error_exception']
 
-        recording.LogStatus.insert1(key)
+        if batch_writer is not None:
+            batch_writer.insert_log(dict(recording_id=recording_id), key)
+        else:
+            recording.LogStatus.insert1(key)
 
 
     @staticmethod
@@ -314,7 +356,7 @@ class RecordingHandler():
         print('before BehaviorSync')
         print("rec_series['query_key']", rec_series['query_key'])
 
-        ephys_pipeline.BehaviorSync.populate(rec_series['query_key'])
+        ephys_pipeline.BehaviorSync.populate(rec_series['query_key'], suppress_errors=True)
 
         if len(ingested_recording) == 0:
             status_update = config.status_update_idx['ERROR_STATUS']
@@ -381,11 +423,11 @@ class RecordingHandler():
         print("rec_series['query_key']")
         print(rec_series['query_key'])
 
-        #Populate ImagingPipelineSession and call matlab script that handles TiffSplits
+        #Populate ImagingPipelineSession, AcquiredTiff reads tiff headers and creates TiffSplits
         imaging_pipeline.ImagingPipelineSession.populate(rec_series['query_key'])
         imaging_pipeline.AcquiredTiff.populate(rec_series['query_key'])
 
-        #Retrieve all fovs records ingested in matlab Script
+        #Retrieve all fovs records ingested in AcquiredTiff
         fovs_ingested = (imaging_pipeline.TiffSplit & rec_series['query_key']).fetch("KEY", as_dict=True)
 
         if len(fovs_ingested) == 0:
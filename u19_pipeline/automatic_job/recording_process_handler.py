@@ -4,8 +4,13 @@ import traceback
 import pandas as pd
 import datajoint as dj
 import copy
+import os
 import pathlib
+import pickle
 import numpy as np
+import threading
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from u19_pipeline.automatic_job import recording_handler
 
@@ -18,6 +23,8 @@ import u19_pipeline.automatic_job.params_config as config
 import u19_pipeline.automatic_job.ephys_element_populate as ep
 import u19_pipeline.automatic_job.imaging_element_populate as ip
 
+from u19_pipeline.automatic_job.status_batch_writer import StatusBatchWriter
+
 from datetime import datetime
 from u19_pipeline import recording, recording_process, ephys_pipeline, imaging_pipeline, utility
 from u19_pipeline.utility import create_str_from_dict, is_this_spock
@@ -27,6 +34,25 @@ from ecephys_spike_sorting.common.SGLXMetaToCoords import MetaToCoords
 
 class RecProcessHandler():
 
+    # Slurm job states of current handler call, {process_cluster: {slurm_id: slurm state}} (see poll_slurm_jobs)
+    slurm_states_tick = dict()
+    # Globus transfers requested in batch in current handler call, {job_id: transfer_request} (see request_globus_transfers)
+    globus_transfers_tick = dict()
+    # Globus task status of current handler call, {task_id: transfer_request} (see poll_globus_transfers)
+    globus_status_tick = dict()
+    # Rows of active process jobs of previous call, {job_id: row} (see get_active_process_jobs)
+    # Kept on disk between calls (see load_handler_cache)
+    active_jobs_cache = dict()
+    # Change marker of cached jobs, {job_id: marker} (see get_active_jobs_markers)
+    active_jobs_markers = dict()
+    # Parameter sets already fetched (immutable), {paramset_idx / param_steps_id: params}
+    params_cache = {
+        'ephys_params':      dict(),
+        'ephys_preparams':   dict(),
+        'imaging_params':    dict(),
+        'imaging_preparams': dict(),
+    }
+
     @staticmethod
     def pipeline_handler_main():
         '''
@@ -36,95 +62,313 @@ class RecProcessHandler():
 
         #Get info from all the possible status for a processjob
         df_all_process_job = RecProcessHandler.get_active_process_jobs()
+        RecProcessHandler.poll_slurm_jobs(df_all_process_job)
+        RecProcessHandler.poll_globus_transfers(df_all_process_job)
 
-        #For all active process jobs
-        for i in range(df_all_process_job.shape[0]):
+        # All status updates & logs of this call are written together at the end
+        # (except jobs claimed for process functions with side effects, written right after them, see run_job)
+        batch_writer = RecProcessHandler.get_status_batch_writer()
 
-            #Filter current process job
-            rec_process_series = df_all_process_job.loc[i, :].copy()
+        try:
+            RecProcessHandler.request_globus_transfers(df_all_process_job, batch_writer)
 
-            #Filter current status info
-            current_status = rec_process_series['status_processing_id']
-            current_status_series = config.recording_process_status_df.loc[config.recording_process_status_df['Value'] == current_status, :].squeeze()
-            next_status_series    = config.recording_process_status_df.loc[config.recording_process_status_df['Value'] == current_status+1, :].squeeze()
+            #For all active process jobs
+            for i in range(df_all_process_job.shape[0]):
 
-            # Get processing function
-            function_status_process = getattr(RecProcessHandler, next_status_series['ProcessFunction'])
+                #Filter current process job
+                rec_process_series = df_all_process_job.loc[i, :].copy()
 
-            #Trigger process, if success update recording process record
-            try:
-                status, update_dict = function_status_process(rec_process_series, next_status_series)
+                # Already advanced by globus transfer requested for many jobs
+                if rec_process_series['job_id'] in RecProcessHandler.globus_transfers_tick:
+                    continue
 
-                #print('update_dict', update_dict)
-                #Get dictionary of record process
-                key = rec_process_series['query_key']
+                #Filter current status info
+                current_status = rec_process_series['status_processing_id']
+                current_status_series, next_status_series = RecProcessHandler.get_status_transition(current_status)
 
-                print('rec_process_series')
-                print(rec_process_series)
+                #Trigger process, if success update recording process record
+                try:
+                    RecProcessHandler.run_job(rec_process_series, current_status, next_status_series, batch_writer)
 
-                if status == config.status_update_idx['NEXT_STATUS']:
+                except Exception as err:
+                    raise(err)
+                    print(traceback.format_exc())
+                    ## Send notification error, update recording to error
 
+                time.sleep(2)
 
-                    #Get values to update
-                    next_status = next_status_series['Value']
-                    value_update = update_dict['value_update']
-                    field_update = next_status_series['UpdateField']
+        # Write what was already processed even if a job failed
+        finally:
+            batch_writer.flush()
 
-                    print('key to update', key)
-                    print('old status', current_status, 'new status', next_status)
-                    print('value_update', value_update, 'field_update', field_update)
-                    print('function executed:', next_status_series['ProcessFunction'])
+    @staticmethod
+    def pipeline_handler_main_concurrent(max_workers=8, max_jobs_per_host=2):
+        '''
+        Same as pipeline_handler_main, but process functions that only wait on clusters (ssh, sacct, globus)
+        run in a bounded thread pool (status with ConcurrentSafe in config.recording_process_status_df).
+        Other process functions and all DB updates / notifications run in the main thread.
+        Each job is advanced at most one status per call, so per job ordering is the same as in pipeline_handler_main.
+        Input:
+        max_workers       (int) = Maximum number of threads running process functions
+        max_jobs_per_host (int) = Maximum number of process functions running at the same time against each cluster host
+        Returns:
+        df_latency (pd.DataFrame) = Number of jobs, mean and max latency (seconds) of process functions for each status
+        '''
 
+        #Get info from all the possible status for a processjob
+        df_all_process_job = RecProcessHandler.get_active_process_jobs()
+        RecProcessHandler.poll_slurm_jobs(df_all_process_job)
+        RecProcessHandler.poll_globus_transfers(df_all_process_job)
 
-                    RecProcessHandler.update_status_pipeline(key, next_status, field_update, value_update)
+        latency_list = list()
+        # All status updates & logs of this call are written together at the end
+        # (except jobs claimed for process functions with side effects, written right after them, see run_job)
+        batch_writer = RecProcessHandler.get_status_batch_writer()
 
-                    if next_status_series['SlackMessage']:
-                        slack_utils.send_slack_update_notification(config.slack_webhooks_dict['automation_pipeline_update_notification'],\
-                             next_status_series['SlackMessage'], rec_process_series)
+        try:
+            RecProcessHandler.request_globus_transfers(df_all_process_job, batch_writer)
+            RecProcessHandler.run_concurrent_jobs(df_all_process_job, max_workers, max_jobs_per_host, batch_writer, latency_list)
+        finally:
+            batch_writer.flush()
 
-                #if success or error update status timestamps table
-                if status != config.status_update_idx['NO_CHANGE']:
-                    if status == config.status_update_idx['ERROR_STATUS']:
-                        next_status = config.RECORDING_STATUS_ERROR_ID
+        df_latency = pd.DataFrame(latency_list, columns=['status_key', 'latency'])
+        df_latency = df_latency.groupby('status_key')['latency'].agg(['count', 'mean', 'max'])
+        print('process function latency (seconds) by status')
+        print(df_latency)
 
-                        #Crop error messages to fit in DB
-                        if len(update_dict['error_info']['error_message']) > 255:
-                            print('Cropping error message')
-                            update_dict['error_info']['error_message'] = update_dict['error_info']['error_message'][-255:]
+        return df_latency
 
-                        if isinstance(update_dict['error_info']['error_exception'], str) and len(update_dict['error_info']['error_exception']) > 4095:
-                            print('Cropping error error_exception')
-                            update_dict['error_info']['error_exception'] = update_dict['error_info']['error_exception'][-4095:]
+    @staticmethod
+    def run_concurrent_jobs(df_all_process_job, max_workers, max_jobs_per_host, batch_writer, latency_list):
+        '''
+        Run process functions of all jobs for pipeline_handler_main_concurrent, latency of each one is appended to latency_list
+        '''
+
+        host_semaphores = dict()
+        # Jobs claimed in main thread before their process function was submitted to a thread
+        claimed_keys = dict()
+
+        def run_process_timed(rec_process_series, next_status_series, host_semaphore):
+            with host_semaphore:
+                start_time = time.time()
+                status, update_dict = RecProcessHandler.run_process_function(rec_process_series, next_status_series)
+                return status, update_dict, time.time() - start_time
 
-                    RecProcessHandler.update_job_id_log(rec_process_series['job_id'], current_status, next_status, update_dict['error_info'])
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
 
-                #An error occurred in process
-                if status == config.status_update_idx['ERROR_STATUS']:
+            future_dict = dict()
+            serial_jobs = list()
+            for i in range(df_all_process_job.shape[0]):
 
-                    next_status = config.RECORDING_STATUS_ERROR_ID
-                    RecProcessHandler.update_status_pipeline(key,next_status, None, None)
+                rec_process_series = df_all_process_job.loc[i, :].copy()
+                if rec_process_series['job_id'] in RecProcessHandler.globus_transfers_tick:
+                    continue
 
-                    #Crop even more error message to fit in slack notification
-                    if isinstance(update_dict['error_info']['error_exception'], str) and len(update_dict['error_info']['error_exception']) > 1024:
-                        print('Cropping error error_exception for slack')
-                        update_dict['error_info']['error_exception'] = update_dict['error_info']['error_exception'][-1023:]
+                current_status = rec_process_series['status_processing_id']
+                current_status_series, next_status_series = RecProcessHandler.get_status_transition(current_status)
 
-                    # Send slack notification with original error exception, retry if exception has invalid format
+                if not next_status_series['ConcurrentSafe']:
+                    serial_jobs.append((rec_process_series, current_status, next_status_series))
+                    continue
+
+                # DB connection is not thread safe, claim in main thread
+                if next_status_series['ClaimJob']:
+                    if not batch_writer.claim(rec_process_series['query_key'], current_status):
+                        continue
+                    claimed_keys[rec_process_series['job_id']] = rec_process_series['query_key']
+
+                # Rate limit by host where process function will connect (ssh, globus requests)
+                process_cluster = rec_process_series['program_selection_params']['process_cluster']
+                host = ft.cluster_vars.get(process_cluster, dict()).get('hostname', process_cluster)
+                if host not in host_semaphores:
+                    host_semaphores[host] = threading.BoundedSemaphore(max_jobs_per_host)
+
+                future = executor.submit(run_process_timed, rec_process_series, next_status_series, host_semaphores[host])
+                future_dict[future] = (rec_process_series, current_status, next_status_series)
+
+            try:
+                # Process functions that access the DB run in the main thread (DB connection is not thread safe)
+                for rec_process_series, current_status, next_status_series in serial_jobs:
+                    latency = RecProcessHandler.run_job(rec_process_series, current_status, next_status_series, batch_writer)
+                    if latency is not None:
+                        latency_list.append({'status_key': next_status_series['Key'], 'latency': latency})
+
+                # DB updates of concurrent process functions as they finish
+                for future in as_completed(future_dict):
+                    rec_process_series, current_status, next_status_series = future_dict[future]
+                    status, update_dict, latency = future.result()
+                    latency_list.append({'status_key': next_status_series['Key'], 'latency': latency})
+                    claimed_key = claimed_keys.pop(rec_process_series['job_id'], None)
                     try:
-                        slack_utils.send_slack_error_notification(config.slack_webhooks_dict['automation_pipeline_error_notification'],\
-                            update_dict['error_info'] ,rec_process_series)
-                    except:
-                        update_dict['error_info']['error_exception'] = 'Error exception not accepted in slack, check log file for error'
-                        slack_utils.send_slack_error_notification(config.slack_webhooks_dict['automation_pipeline_error_notification'],\
-                            update_dict['error_info'] ,rec_process_series)
+                        RecProcessHandler.apply_process_result(rec_process_series, current_status, next_status_series, status, update_dict,\
+                            batch_writer=batch_writer)
+                        # Claimed jobs are written as soon as their process function finishes
+                        if claimed_key is not None:
+                            batch_writer.flush([claimed_key])
+                    finally:
+                        if claimed_key is not None:
+                            batch_writer.release(claimed_key)
+            finally:
+                # If a job failed, write results of claimed jobs whose process function already ran
+                executor.shutdown(wait=True)
+                for future, (rec_process_series, current_status, next_status_series) in future_dict.items():
+                    if rec_process_series['job_id'] in claimed_keys and future.exception() is None:
+                        status, update_dict, _ = future.result()
+                        RecProcessHandler.apply_process_result(rec_process_series, current_status, next_status_series, status, update_dict,\
+                            batch_writer=batch_writer)
+                if len(claimed_keys) > 0:
+                    batch_writer.flush(list(claimed_keys.values()))
+                for key in claimed_keys.values():
+                    batch_writer.release(key)
+
+    @staticmethod
+    def run_job(rec_process_series, current_status, next_status_series, batch_writer):
+        '''
+        Run process function of a job and queue its result in batch_writer.
+        If process function has side effects outside the DB (ClaimJob in config.recording_process_status_df: sbatch,
+        globus transfer), the job is claimed before it runs and its status is written right after it, so a colliding
+        handler call does not submit it again and the new slurm_id / task_id is not lost if the handler is killed.
+        Returns:
+        latency (float) = Seconds spent in process function, None if job was not claimed
+        '''
+
+        key = rec_process_series['query_key']
+        claim_job = next_status_series['ClaimJob']
+        if claim_job and not batch_writer.claim(key, current_status):
+            return None
+
+        try:
+            start_time = time.time()
+            status, update_dict = RecProcessHandler.run_process_function(rec_process_series, next_status_series)
+            latency = time.time() - start_time
+            RecProcessHandler.apply_process_result(rec_process_series, current_status, next_status_series, status, update_dict,\
+                batch_writer=batch_writer)
+            if claim_job:
+                batch_writer.flush([key])
+        finally:
+            if claim_job:
+                batch_writer.release(key)
+
+        return latency
+
+    @staticmethod
+    def get_status_batch_writer():
+        '''
+        Get StatusBatchWriter for recording_process.Processing status updates and recording_process.LogStatus logs
+        '''
+        return StatusBatchWriter(recording_process.Processing, 'status_processing_id', recording_process.LogStatus)
+
+    @staticmethod
+    def get_status_transition(current_status):
+        '''
+        Get current and next status info (rows of config.recording_process_status_df) for a process job
+        '''
+        current_status_series = config.recording_process_status_df.loc[config.recording_process_status_df['Value'] == current_status, :].squeeze()
+        next_status_series    = config.recording_process_status_df.loc[config.recording_process_status_df['Value'] == current_status+1, :].squeeze()
+
+        return current_status_series, next_status_series
+
+    @staticmethod
+    def run_process_function(rec_process_series, next_status_series):
+        '''
+        Execute processing function that advances process job to next status
+        Returns:
+        (status, update_dict) returned by processing function
+        '''
+        # Get processing function
+        function_status_process = getattr(RecProcessHandler, next_status_series['ProcessFunction'])
 
+        return function_status_process(rec_process_series, next_status_series)
 
-            except Exception as err:
-                raise(err)
-                print(traceback.format_exc())
-                ## Send notification error, update recording to error
+    @staticmethod
+    def apply_process_result(rec_process_series, current_status, next_status_series, status, update_dict, batch_writer=None):
+        '''
+        Update recording process record, log and notifications from the result of a processing function
+        If batch_writer (StatusBatchWriter) is given updates, logs and notifications are queued until batch_writer.flush()
+        '''
+
+        #print('update_dict', update_dict)
+        #Get dictionary of record process
+        key = rec_process_series['query_key']
+
+        print('rec_process_series')
+        print(rec_process_series)
+
+        if status == config.status_update_idx['NEXT_STATUS']:
+
+
+            #Get values to update
+            next_status = next_status_series['Value']
+            value_update = update_dict['value_update']
+            field_update = next_status_series['UpdateField']
+
+            print('key to update', key)
+            print('old status', current_status, 'new status', next_status)
+            print('value_update', value_update, 'field_update', field_update)
+            print('function executed:', next_status_series['ProcessFunction'])
+
+
+            RecProcessHandler.update_status_pipeline(key, next_status, field_update, value_update,\
+                batch_writer=batch_writer, expected_status=current_status)
 
-            time.sleep(2)
+            if next_status_series['SlackMessage']:
+                notification_args = (config.slack_webhooks_dict['automation_pipeline_update_notification'],\
+                     next_status_series['SlackMessage'], rec_process_series)
+                if batch_writer is not None:
+                    batch_writer.after_flush(key, slack_utils.send_slack_update_notification, *notification_args)
+                else:
+                    slack_utils.send_slack_update_notification(*notification_args)
+
+        #if success or error update status timestamps table
+        if status != config.status_update_idx['NO_CHANGE']:
+            if status == config.status_update_idx['ERROR_STATUS']:
+                next_status = config.RECORDING_STATUS_ERROR_ID
+
+                #Crop error messages to fit in DB
+                if len(update_dict['error_info']['error_message']) > 255:
+                    print('Cropping error message')
+                    update_dict['error_info']['error_message'] = update_dict['error_info']['error_message'][-255:]
+
+                if isinstance(update_dict['error_info']['error_exception'], str) and len(update_dict['error_info']['error_exception']) > 4095:
+                    print('Cropping error error_exception')
+                    update_dict['error_info']['error_exception'] = update_dict['error_info']['error_exception'][-4095:]
+
+            RecProcessHandler.update_job_id_log(rec_process_series['job_id'], current_status, next_status, update_dict['error_info'],\
+                batch_writer=batch_writer)
+
+        #An error occurred in process
+        if status == config.status_update_idx['ERROR_STATUS']:
+
+            next_status = config.RECORDING_STATUS_ERROR_ID
+            RecProcessHandler.update_status_pipeline(key,next_status, None, None,\
+                batch_writer=batch_writer, expected_status=current_status)
+
+            # Copy, error info is already queued for the log if using batch_writer
+            error_info = copy.deepcopy(update_dict['error_info'])
+            if batch_writer is not None:
+                batch_writer.after_flush(key, RecProcessHandler.send_error_notification, error_info, rec_process_series)
+            else:
+                RecProcessHandler.send_error_notification(error_info, rec_process_series)
+
+    @staticmethod
+    def send_error_notification(error_info, rec_process_series):
+        '''
+        Send slack notification of a process job error
+        '''
+
+        #Crop even more error message to fit in slack notification
+        if isinstance(error_info['error_exception'], str) and len(error_info['error_exception']) > 1024:
+            print('Cropping error error_exception for slack')
+            error_info['error_exception'] = error_info['error_exception'][-1023:]
+
+        # Send slack notification with original error exception, retry if exception has invalid format
+        try:
+            slack_utils.send_slack_error_notification(config.slack_webhooks_dict['automation_pipeline_error_notification'],\
+                error_info ,rec_process_series)
+        except:
+            error_info['error_exception'] = 'Error exception not accepted in slack, check log file for error'
+            slack_utils.send_slack_error_notification(config.slack_webhooks_dict['automation_pipeline_error_notification'],\
+                error_info ,rec_process_series)
 
     @staticmethod
     @recording_handler.exception_handler
@@ -154,7 +398,11 @@ class RecProcessHandler():
         # If tiger, we trigger globus transfer
         if rec_series['program_selection_params']['process_cluster'] == "tiger":
 
-            if status_series['Key'] == 'RAW_FILE_TRANSFER_REQUEST':
+            # Transfer already requested with other jobs in a single globus task
+            if job_id in RecProcessHandler.globus_transfers_tick:
+                transfer_request = RecProcessHandler.globus_transfers_tick[job_id]
+
+            elif status_series['Key'] == 'RAW_FILE_TRANSFER_REQUEST':
 
                 #status, task_id = scp_tr.call_scp_background(ip_address=rec_series['ip_address'], system_user=rec_series['system_user'],
                 #recording_system_directory=rec_series['local_directory'], data_directory=data_directory.as_posix())
@@ -202,7 +450,11 @@ class RecProcessHandler():
         # If tiger, we trigger globus transfer
         if rec_series['program_selection_params']['process_cluster'] == "tiger":
 
-            transfer_request = ft.request_globus_transfer_status(str(id_task))
+            # Use status from task list of this handler call, check task alone if it was not there
+            if str(id_task) in RecProcessHandler.globus_status_tick:
+                transfer_request = RecProcessHandler.globus_status_tick[str(id_task)]
+            else:
+                transfer_request = ft.request_globus_transfer_status(str(id_task))
 
             if transfer_request['status'] == config.system_process['COMPLETED']:
                 status_update = config.status_update_idx['NEXT_STATUS']
@@ -342,7 +594,12 @@ class RecProcessHandler():
             ssh_host = ft.cluster_vars[program_selection_params['process_cluster']]['hostname']
             slurm_jobid = str(rec_series['slurm_id'])
 
-            status_update, message = slurmlib.check_slurm_job(ssh_user, ssh_host, slurm_jobid, local_user=local_user)
+            # Use state from batched sacct call of this handler call, check job alone if it was not there
+            slurm_states_dict = RecProcessHandler.slurm_states_tick.get(program_selection_params['process_cluster'], None)
+            if slurm_states_dict is not None and slurm_jobid in slurm_states_dict:
+                status_update, message = slurmlib.get_slurm_job_pipeline_state(slurm_states_dict[slurm_jobid])
+            else:
+                status_update, message = slurmlib.check_slurm_job(ssh_user, ssh_host, slurm_jobid, local_user=local_user)
 
             # Get message from slurm status check
             update_value_dict['error_info']['error_message'] = message
@@ -396,6 +653,150 @@ class RecProcessHandler():
 
         return (status_update, update_value_dict)
 
+    @staticmethod
+    def poll_slurm_jobs(df_process_jobs):
+        '''
+        Get state of all slurm jobs to be checked with a single sacct call per cluster
+        and store them in RecProcessHandler.slurm_states_tick for the rest of the handler call
+        Input:
+        df_process_jobs (pd.DataFrame) = active process jobs (from get_active_process_jobs)
+        '''
+
+        RecProcessHandler.slurm_states_tick = dict()
+
+        if df_process_jobs.shape[0] == 0:
+            return
+
+        # Jobs waiting for slurm_job_check
+        df_slurm_jobs = RecProcessHandler.get_jobs_next_function(df_process_jobs, 'slurm_job_check')
+        df_slurm_jobs = df_slurm_jobs.loc[df_slurm_jobs['slurm_id'].notnull(), :]
+
+        cluster_jobs = dict()
+        for _, rec_process_series in df_slurm_jobs.iterrows():
+            program_selection_params = rec_process_series['program_selection_params']
+            if program_selection_params['local_or_cluster'] != "cluster":
+                continue
+            process_cluster = program_selection_params['process_cluster']
+            cluster_jobs.setdefault(process_cluster, list()).append(str(rec_process_series['slurm_id']))
+
+        for process_cluster, slurm_jobids in cluster_jobs.items():
+
+            local_user = False
+            if process_cluster == 'spock' and is_this_spock():
+                local_user = True
+
+            ssh_user = ft.cluster_vars[process_cluster]['user']
+            ssh_host = ft.cluster_vars[process_cluster]['hostname']
+
+            slurm_states_dict = slurmlib.check_slurm_jobs(ssh_user, ssh_host, slurm_jobids, local_user=local_user)
+            if slurm_states_dict is not None:
+                RecProcessHandler.slurm_states_tick[process_cluster] = slurm_states_dict
+
+            print('slurm states', process_cluster, slurm_states_dict)
+
+    @staticmethod
+    def get_jobs_next_function(df_process_jobs, process_function):
+        '''
+        Filter process jobs whose next status is executed by process_function
+        Returns:
+        df_function_jobs (pd.DataFrame) = filtered process jobs, with column next_status_key
+        '''
+
+        status_df = config.recording_process_status_df
+        next_status_df = status_df.loc[status_df['ProcessFunction'] == process_function, ['Value', 'Key']]
+
+        df_function_jobs = df_process_jobs.loc[df_process_jobs['status_processing_id'].isin(next_status_df['Value'] - 1), :].copy()
+        df_function_jobs['next_status_key'] = df_function_jobs['status_processing_id'].map(\
+            dict(zip(next_status_df['Value'] - 1, next_status_df['Key'])))
+
+        return df_function_jobs
+
+    @staticmethod
+    def request_globus_transfers(df_process_jobs, batch_writer):
+        '''
+        Request globus transfers of all jobs waiting for transfer_request with a single globus task per direction.
+        Jobs are claimed before the request and their status is written right after it (see run_job),
+        they are stored in RecProcessHandler.globus_transfers_tick to be skipped for the rest of the handler call
+        Input:
+        df_process_jobs (pd.DataFrame)      = active process jobs (from get_active_process_jobs)
+        batch_writer    (StatusBatchWriter) = batch writer of the handler call
+        '''
+
+        RecProcessHandler.globus_transfers_tick = dict()
+
+        if df_process_jobs.shape[0] == 0:
+            return
+
+        df_transfer_jobs = RecProcessHandler.get_jobs_next_function(df_process_jobs, 'transfer_request')
+        df_transfer_jobs = df_transfer_jobs.loc[df_transfer_jobs['program_selection_params'].apply(\
+            lambda x: x['process_cluster'] == 'tiger'), :]
+
+        transfer_types = {
+            'RAW_FILE_TRANSFER_REQUEST':  ('raw', 'recording_process_pre_path'),
+            'PROC_FILE_TRANSFER_REQUEST': ('processed', 'recording_process_post_path'),
+        }
+
+        for status_key, (type_dir, path_field) in transfer_types.items():
+
+            this_df = df_transfer_jobs.loc[df_transfer_jobs['next_status_key'] == status_key, :]
+
+            # Single job transfers are requested as before in transfer_request
+            if this_df.shape[0] < 2:
+                continue
+
+            claimed_jobs = [x for _, x in this_df.iterrows()\
+                if batch_writer.claim(x['query_key'], x['status_processing_id'])]
+            try:
+                if len(claimed_jobs) < 2:
+                    continue
+
+                transfer_jobs = [(x['job_id'], x[path_field], x['recording_modality']) for x in claimed_jobs]
+                transfer_request = ft.globus_transfer_batch(transfer_jobs, type_dir)
+
+                print('globus batch transfer', type_dir, transfer_jobs, transfer_request)
+
+                for rec_process_series in claimed_jobs:
+                    RecProcessHandler.globus_transfers_tick[rec_process_series['job_id']] = transfer_request
+                    current_status = rec_process_series['status_processing_id']
+                    _, next_status_series = RecProcessHandler.get_status_transition(current_status)
+                    status, update_dict = RecProcessHandler.transfer_request(rec_process_series, next_status_series)
+                    RecProcessHandler.apply_process_result(rec_process_series, current_status, next_status_series,\
+                        status, update_dict, batch_writer=batch_writer)
+                batch_writer.flush([x['query_key'] for x in claimed_jobs])
+            finally:
+                for rec_process_series in claimed_jobs:
+                    batch_writer.release(rec_process_series['query_key'])
+
+    @staticmethod
+    def poll_globus_transfers(df_process_jobs):
+        '''
+        Get status of all globus transfers to be checked with a single task list call
+        and store them in RecProcessHandler.globus_status_tick for the rest of the handler call
+        Input:
+        df_process_jobs (pd.DataFrame) = active process jobs (from get_active_process_jobs)
+        '''
+
+        RecProcessHandler.globus_status_tick = dict()
+
+        if df_process_jobs.shape[0] == 0:
+            return
+
+        df_check_jobs = RecProcessHandler.get_jobs_next_function(df_process_jobs, 'transfer_check')
+        df_check_jobs = df_check_jobs.loc[df_check_jobs['program_selection_params'].apply(\
+            lambda x: x['process_cluster'] == 'tiger'), :]
+
+        task_ids = list()
+        for _, rec_process_series in df_check_jobs.iterrows():
+            _, next_status_series = RecProcessHandler.get_status_transition(rec_process_series['status_processing_id'])
+            task_ids.append(str(rec_process_series[next_status_series['FunctionField']]))
+
+        if len(task_ids) == 0:
+            return
+
+        RecProcessHandler.globus_status_tick = ft.request_globus_transfers_status(task_ids)
+
+        print('globus transfers status', RecProcessHandler.globus_status_tick)
+
     @staticmethod
     def get_program_selection_params(modality):
         '''
@@ -423,6 +824,9 @@ class RecProcessHandler():
     def get_active_process_jobs(active=True):
         '''
         get all process jobs that have to go through some action in the pipeline
+        For active jobs, only jobs that are new or changed (status, any other field or parameter ids, see
+        get_active_jobs_markers) since previous call are fetched, rest come from RecProcessHandler.active_jobs_cache
+        (loaded from disk if previous call was in another process)
         Return:
             df_process_jobs (pd.DataFrame): all jobs that are going to be processed in the pipeline
         '''
@@ -436,6 +840,23 @@ class RecProcessHandler():
 
         jobs_active = (recording.Recording.proj('recording_modality', 'location', 'recording_directory') * \
             recording_process.Processing & status_query)
+
+        if active:
+            RecProcessHandler.load_handler_cache()
+
+            # Change marker of all active jobs, full record only for new jobs or jobs that changed
+            job_markers = RecProcessHandler.get_active_jobs_markers(jobs_active)
+            jobs_cache = RecProcessHandler.active_jobs_cache
+            cached_markers = RecProcessHandler.active_jobs_markers
+            is_cached = {x: x in jobs_cache and cached_markers.get(x) == marker for x, marker in job_markers.items()}
+            changed_jobs = [dict(job_id=x) for x in job_markers if not is_cached[x]]
+            cached_jobs = [copy.deepcopy(jobs_cache[x]) for x in job_markers if is_cached[x]]
+            # program selection params come from config, not from the DB
+            for this_job in cached_jobs:
+                this_job['program_selection_params'] = RecProcessHandler.get_program_selection_params(\
+                    this_job['recording_modality'])['program_selection_params'].iloc[0]
+            jobs_active = jobs_active & changed_jobs
+
         df_process_jobs = pd.DataFrame(jobs_active.fetch(as_dict=True))
 
         if df_process_jobs.shape[0] > 0:
@@ -473,41 +894,145 @@ class RecProcessHandler():
 
             df_process_jobs = df_process_jobs.reset_index(drop=True)
 
+        if active:
+            # Join with jobs from previous call and keep them for next one
+            if len(cached_jobs) > 0:
+                df_process_jobs = pd.concat([df_process_jobs, pd.DataFrame(cached_jobs)], ignore_index=True)
+                df_process_jobs = df_process_jobs.sort_values(by='job_id').reset_index(drop=True)
+
+            print('active jobs fetched', len(changed_jobs), 'active jobs from previous call', len(cached_jobs))
+            RecProcessHandler.active_jobs_cache = {x['job_id']: copy.deepcopy(x) for x in df_process_jobs.to_dict(orient='records')}
+            RecProcessHandler.active_jobs_markers = job_markers
+            RecProcessHandler.save_handler_cache()
+
         print(df_process_jobs)
 
         return df_process_jobs
 
+    @staticmethod
+    def get_active_jobs_markers(jobs_active):
+        '''
+        Cheap change marker of each active job: hash (computed in the DB) of all fields of the job and its recording,
+        plus its parameter set ids. Any edit (params, paths, reset to the same status) changes the marker.
+        Input:
+            jobs_active (dj query): recording.Recording * recording_process.Processing active jobs
+        Return:
+            job_markers (dict): {job_id: marker}
+        '''
+
+        marker_fields = jobs_active.heading.secondary_attributes
+        marker_sql = "MD5(CONCAT_WS('|', " + ", ".join(["IFNULL(`" + x + "`, 'NULL')" for x in marker_fields]) + "))"
+        job_ids, job_hashes = jobs_active.proj(change_marker=marker_sql).fetch('job_id', 'change_marker')
+        job_markers = {x: [y] for x, y in zip(job_ids, job_hashes)}
+
+        for params_table in [recording_process.Processing.EphysParams, recording_process.Processing.ImagingParams]:
+            for job_params in (params_table & jobs_active.proj()).fetch(as_dict=True, order_by='job_id'):
+                if job_params['job_id'] in job_markers:
+                    job_markers[job_params['job_id']].append(params_table.__name__ + str(sorted(job_params.items())))
+
+        return {x: '|'.join(marker) for x, marker in job_markers.items()}
+
+    @staticmethod
+    def get_handler_cache_file():
+        return pathlib.Path(config.handler_cache_filepath, config.handler_cache_filename)
+
+    @staticmethod
+    def load_handler_cache():
+        '''
+        Load active jobs & parameter sets cached by the previous handler call if it was in another process (cron job)
+        Cached jobs are only used while their change marker does not change, so a stale file only costs extra fetches
+        '''
+
+        cache_file = RecProcessHandler.get_handler_cache_file()
+        if len(RecProcessHandler.active_jobs_cache) > 0 or not cache_file.exists():
+            return
+
+        try:
+            with open(cache_file, 'rb') as f:
+                handler_cache = pickle.load(f)
+            RecProcessHandler.active_jobs_cache = handler_cache['active_jobs']
+            RecProcessHandler.active_jobs_markers = handler_cache.get('active_jobs_markers', dict())
+            for params_name, params in handler_cache['params'].items():
+                RecProcessHandler.params_cache[params_name].update(params)
+        except Exception as e:
+            print('Handler cache could not be read, all active jobs will be fetched:', e)
+            RecProcessHandler.active_jobs_cache = dict()
+            RecProcessHandler.active_jobs_markers = dict()
+
+    @staticmethod
+    def save_handler_cache():
+        '''
+        Write active jobs & parameter sets for the next handler call (file is replaced only when completely written)
+        '''
+
+        cache_file = RecProcessHandler.get_handler_cache_file()
+        try:
+            cache_file.parent.mkdir(parents=True, exist_ok=True)
+            tmp_cache_file = cache_file.with_suffix('.' + str(os.getpid()) + '.tmp')
+            with open(tmp_cache_file, 'wb') as f:
+                pickle.dump(dict(active_jobs=RecProcessHandler.active_jobs_cache,
+                                 active_jobs_markers=RecProcessHandler.active_jobs_markers,
+                                 params=RecProcessHandler.params_cache), f)
+            tmp_cache_file.replace(cache_file)
+        except OSError as e:
+            print('Handler cache could not be written:', e)
+
     @staticmethod
     def get_ephys_params_jobs(rec_process_keys):
         '''
         get all parameters (precluster & cluster) for each of the recording process
         Join precluster param list into a list
+        Parameter sets are immutable, they are fetched once and cached in RecProcessHandler.params_cache
         Args:
             rec_process_keys (dict): key to find recording_process records
         Return:
             params_df (pd.DataFrame): recording_process & params df
         '''
 
-        # Get cluster param sets
-        params_df = pd.DataFrame((ephys_pipeline.ephys_element.ClusteringParamSet.proj('params', 'clustering_method') * \
-        recording_process.Processing.EphysParams.proj('paramset_idx') & rec_process_keys).fetch(as_dict=True))
-        params_df = params_df.drop('paramset_idx', axis=1)
-
-        #Insert clustering method in params itself (for BrainCogsEphysSorters)
-        params_df['params'] = params_df.apply(lambda x: {**x['params'], **{'clustering_method':x['clustering_method']}},axis=1)
-
-        # Get precluster param sets
-        preparams_df = pd.DataFrame((ephys_pipeline.ephys_element.PreClusterParamSteps * \
-        utility.smart_dj_join(ephys_pipeline.ephys_element.PreClusterParamSteps.Step, ephys_pipeline.ephys_element.PreClusterParamSet.proj('precluster_method', 'params')) *
-        recording_process.Processing.EphysParams.proj('precluster_param_steps_id') & rec_process_keys).fetch(as_dict=True))
-
-        # Join precluster params for the same recording_process
-        preparams_df['preparams'] = preparams_df.apply(lambda x : {x['precluster_method']: x['params']}, axis=1)
-        preparams_df = preparams_df.sort_values(by=['job_id', 'step_number'])
-        preparams_df = preparams_df[['job_id', 'preparams']].groupby("job_id").agg(lambda x: list(x))
-        preparams_df = preparams_df.reset_index()
-
-        params_df = params_df.merge(preparams_df)
+        jobs_params = (recording_process.Processing.EphysParams & rec_process_keys).fetch(as_dict=True)
+
+        # Get cluster param sets not in cache
+        params_cache = RecProcessHandler.params_cache['ephys_params']
+        missing_params = [dict(paramset_idx=x) for x in set([x['paramset_idx'] for x in jobs_params]) if x not in params_cache]
+        if len(missing_params) > 0:
+            params_list = (ephys_pipeline.ephys_element.ClusteringParamSet.proj('params', 'clustering_method') & missing_params).fetch(as_dict=True)
+            for this_params in params_list:
+                #Insert clustering method in params itself (for BrainCogsEphysSorters)
+                this_params['params'] = {**this_params['params'], **{'clustering_method':this_params['clustering_method']}}
+                params_cache[this_params['paramset_idx']] = this_params
+
+        # Get precluster param sets not in cache
+        preparams_cache = RecProcessHandler.params_cache['ephys_preparams']
+        missing_preparams = [dict(precluster_param_steps_id=x) for x in set([x['precluster_param_steps_id'] for x in jobs_params])\
+            if x not in preparams_cache]
+        if len(missing_preparams) > 0:
+            preparams_df = pd.DataFrame((ephys_pipeline.ephys_element.PreClusterParamSteps * \
+            utility.smart_dj_join(ephys_pipeline.ephys_element.PreClusterParamSteps.Step, ephys_pipeline.ephys_element.PreClusterParamSet.proj('precluster_method', 'params')) \
+            & missing_preparams).fetch(as_dict=True))
+
+            # Join precluster params for the same precluster steps
+            for this_steps in missing_preparams:
+                preparams_cache[this_steps['precluster_param_steps_id']] = list()
+            if preparams_df.shape[0] > 0:
+                preparams_df = preparams_df.sort_values(by=['precluster_param_steps_id', 'step_number'])
+                for _, this_step in preparams_df.iterrows():
+                    preparams_cache[this_step['precluster_param_steps_id']].append({this_step['precluster_method']: this_step['params']})
+
+        params_list = list()
+        for this_job in jobs_params:
+            this_params = params_cache.get(this_job['paramset_idx'], None)
+            this_preparams = preparams_cache.get(this_job['precluster_param_steps_id'], list())
+
+            # Jobs without precluster steps are not included (as in the joined query)
+            if this_params is None or len(this_preparams) == 0:
+                continue
+
+            params_list.append({'job_id': this_job['job_id'],
+                                'clustering_method': this_params['clustering_method'],
+                                'params': copy.deepcopy(this_params['params']),
+                                'preparams': copy.deepcopy(this_preparams)})
+
+        params_df = pd.DataFrame(params_list, columns=['job_id', 'clustering_method', 'params', 'preparams'])
 
         return params_df
 
@@ -516,46 +1041,66 @@ class RecProcessHandler():
         '''
         get all parameters (precluster & cluster) for each of the recording process
         Join precluster param steps into a list
+        Parameter sets are immutable, they are fetched once and cached in RecProcessHandler.params_cache
         Args:
             rec_process_keys (dict): key to find recording_process records
         Return:
             params_df (pd.DataFrame): recording_process & params df
         '''
 
-        params_df = pd.DataFrame((imaging_pipeline.imaging_element.ProcessingParamSet.proj('params', 'processing_method') * \
-        recording_process.Processing.ImagingParams.proj('paramset_idx') & rec_process_keys).fetch(as_dict=True))
-        params_df = params_df.drop('paramset_idx', axis=1)
+        jobs_params = (recording_process.Processing.ImagingParams & rec_process_keys).fetch(as_dict=True)
+
+        # Get processing param sets not in cache
+        params_cache = RecProcessHandler.params_cache['imaging_params']
+        missing_params = [dict(paramset_idx=x) for x in set([x['paramset_idx'] for x in jobs_params]) if x not in params_cache]
+        if len(missing_params) > 0:
+            params_list = (imaging_pipeline.imaging_element.ProcessingParamSet.proj('params', 'processing_method') & missing_params).fetch(as_dict=True)
+            for this_params in params_list:
+                #Insert processing_method in params itself (for BrainCogsImagingSorters)
+                this_params['params'] = {**this_params['params'], **{'processing_method':this_params['processing_method']}}
+                params_cache[this_params['paramset_idx']] = this_params
+
+        # Get preprocess param sets not in cache
+        preparams_cache = RecProcessHandler.params_cache['imaging_preparams']
+        missing_preparams = [dict(preprocess_param_steps_id=x) for x in set([x['preprocess_param_steps_id'] for x in jobs_params])\
+            if x not in preparams_cache]
+        if len(missing_preparams) > 0:
+            preparams_df = pd.DataFrame((imaging_pipeline.imaging_element.PreprocessParamSteps * \
+            utility.smart_dj_join(imaging_pipeline.imaging_element.PreprocessParamSteps.Step, imaging_pipeline.imaging_element.PreprocessParamSet.proj('preprocess_method', 'params')) \
+            & missing_preparams).fetch(as_dict=True))
 
-        #Insert processing_method in params itself (for BrainCogsImagingSorters)
-        params_df['params'] = params_df.apply(lambda x: {**x['params'], **{'processing_method':x['processing_method']}},axis=1)
+            # Join preprocess params for the same preprocess steps
+            for this_steps in missing_preparams:
+                preparams_cache[this_steps['preprocess_param_steps_id']] = list()
+            if preparams_df.shape[0] > 0:
+                preparams_df = preparams_df.sort_values(by=['preprocess_param_steps_id', 'step_number'])
+                for _, this_step in preparams_df.iterrows():
+                    preparams_cache[this_step['preprocess_param_steps_id']].append({this_step['preprocess_method']: this_step['params']})
 
-        # Get preprocess param sets
-        preparams_df = pd.DataFrame((imaging_pipeline.imaging_element.PreprocessParamSteps * \
-        utility.smart_dj_join(imaging_pipeline.imaging_element.PreprocessParamSteps.Step, imaging_pipeline.imaging_element.PreprocessParamSet.proj('preprocess_method', 'params')) *
-        recording_process.Processing.ImagingParams.proj('preprocess_param_steps_id') & rec_process_keys).fetch(as_dict=True))
+        params_list = list()
+        for this_job in jobs_params:
+            this_params = params_cache.get(this_job['paramset_idx'], None)
+            this_preparams = preparams_cache.get(this_job['preprocess_param_steps_id'], list())
 
-        #If there is no preprocess steps for this jobs fill with empty values
-        if preparams_df.shape[0] > 0:
+            if this_params is None:
+                continue
 
-            # Join precluster params for the same recording_process
-            preparams_df['preparams'] = preparams_df.apply(lambda x : {x['preprocess_method']: x['params']}, axis=1)
-            preparams_df = preparams_df.sort_values(by=['job_id', 'step_number'])
-            preparams_df = preparams_df[['job_id', 'preparams']].groupby("job_id").agg(lambda x: list(x))
-            preparams_df = preparams_df.reset_index()
+            #If there is no preprocess steps for this job fill with empty values
+            if len(this_preparams) == 0:
+                this_preparams = None
 
-        else:
-            preparams_df = pd.DataFrame((imaging_pipeline.imaging_element.PreprocessParamSteps * \
-                    recording_process.Processing.ImagingParams.proj('preprocess_param_steps_id') & rec_process_keys).fetch(as_dict=True))
-            preparams_df['preparams'] = None
+            params_list.append({'job_id': this_job['job_id'],
+                                'processing_method': this_params['processing_method'],
+                                'params': copy.deepcopy(this_params['params']),
+                                'preparams': copy.deepcopy(this_preparams)})
 
-        preparams_df = preparams_df[['job_id', 'preparams']]
-        params_df = params_df.merge(preparams_df)
+        params_df = pd.DataFrame(params_list, columns=['job_id', 'processing_method', 'params', 'preparams'])
 
         return params_df
 
 
     @staticmethod
-    def update_status_pipeline(recording_process_key_dict, status, update_field=None, update_value=None):
+    def update_status_pipeline(recording_process_key_dict, status, update_field=None, update_value=None, batch_writer=None, expected_status=None):
         """
         Update recording_process.Processing table status and optional task field
         Args:
@@ -563,8 +1108,14 @@ class RecProcessHandler():
             status                     (int):  value of the status to be updated
             update_field               (str):  name of the field to be updated as extra (only applicable to some status)
             update_value             (str|int):  field value to be inserted on in task_field
+            batch_writer  (StatusBatchWriter):  if given, update is queued in batch_writer
+            expected_status            (int):  status read for the record (for batch_writer optimistic update)
         """
 
+        if batch_writer is not None:
+            batch_writer.update_status(recording_process_key_dict, status, expected_status, update_field, update_value)
+            return
+
         if update_field is not None:
             update_task_id_dict = recording_process_key_dict.copy()
             update_task_id_dict[update_field] = update_value
@@ -576,11 +1127,11 @@ class RecProcessHandler():
 
 
     @staticmethod
-    def update_job_id_log(job_id, current_status, next_status, error_info_dict):
+    def update_job_id_log(job_id, current_status, next_status, error_info_dict, batch_writer=None):
         """
         Update recording_process.LogStatus table status and optional task field
         Args:
-
+            batch_writer  (StatusBatchWriter):  if given, log row is queued in batch_writer
         """
 
         now = datetime.now()
@@ -603,7 +1154,10 @@ class RecProcessHandler():
         key['error_exception'] = error_info_dict['error_exception']
         key['error_message'] = error_info_dict['error_message']
 
-        recording_process.LogStatus.insert1(key)
+        if batch_writer is not None:
+            batch_writer.insert_log(dict(job_id=job_id), key)
+        else:
+            recording_process.LogStatus.insert1(key)
 
 
     @staticmethod
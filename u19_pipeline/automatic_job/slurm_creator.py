@@ -9,6 +9,7 @@ import re
 import u19_pipeline.automatic_job.clusters_paths_and_transfers as ft
 from u19_pipeline.utility import create_str_from_dict, is_this_spock
 import u19_pipeline.automatic_job.params_config as config
+import u19_pipeline.utils.scp_transfers as scp_tr
 from u19_pipeline.utils.file_utils import write_file
 
 # Functions to create slurm jobs
@@ -90,19 +91,23 @@ def queue_slurm_file(job_id, program_selection_params, raw_directory, proc_direc
     , slurm_location
     ]
 
+    print(command)
     if program_selection_params['process_cluster'] == 'spock' and is_this_spock():
         command = command[2:]
-
-    print(command)
-    p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    #p = os.popen(command_new).read()
-    p.wait()
-    stdout, stderr = p.communicate()
+        p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        #p = os.popen(command_new).read()
+        p.wait()
+        stdout, stderr = p.communicate()
+        returncode = p.returncode
+    else:
+        # Same remote command line ssh would build (arguments joined by spaces)
+        remote_client = scp_tr.get_remote_client(cluster_vars['user'], cluster_vars['hostname'])
+        returncode, stdout, stderr = remote_client.exec_command(' '.join(command[2:]))
 
     print(stdout)
     print(stderr)
 
-    if p.returncode == config.system_process['SUCCESS']:
+    if returncode == config.system_process['SUCCESS']:
         error_message = ''
         batch_job_sentence = stdout.decode('UTF-8')
         print('batch_job_sentence', batch_job_sentence)
@@ -111,40 +116,75 @@ def queue_slurm_file(job_id, program_selection_params, raw_directory, proc_direc
     else:
         error_message = stderr.decode('UTF-8')
 
-    return p.returncode, id_slurm_job, error_message
+    return returncode, id_slurm_job, error_message
 
 
-def check_slurm_job(ssh_user, host, jobid, local_user=False):
+def check_slurm_jobs(ssh_user, host, jobids, local_user=False):
+    '''
+    Get state of many slurm jobs with a single sacct call (one ssh connection)
+    Returns:
+        slurm_states_dict (dict): {jobid: slurm state (e.g. RUNNING, COMPLETED)}, None if sacct call failed
+    '''
+
+    jobids = [str(x) for x in jobids]
+    if len(jobids) == 0:
+        return dict()
 
+    command = ['sacct', '-j', ','.join(jobids), '--format=JobID,State', '--parsable2', '--noheader']
     if local_user:
-        command = ['sacct', '--job', jobid, '--format=state']
+        p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        stdout, stderr = p.communicate()
+        returncode = p.returncode
     else:
-        command = ['ssh', ssh_user+'@'+host, 'sacct', '--job', jobid, '--format=state']
+        returncode, stdout, stderr = scp_tr.get_remote_client(ssh_user, host).exec_command(' '.join(command))
 
-    p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    p.wait()
-    stdout, stderr = p.communicate()
-    stdout = stdout.decode('UTF-8')
+    if returncode != config.system_process['SUCCESS']:
+        print('Failed to retrieve slurm job status', stderr.decode('UTF-8'))
+        return None
 
-    print('p.returncode !!!!!!!!!!!!', p.returncode)
-    print("config.system_process['SUCCESS']", config.system_process['SUCCESS'])
+    slurm_states_dict = dict()
+    for line in stdout.decode('UTF-8').split("\n"):
+        fields = line.strip().split('|')
+        if len(fields) < 2:
+            continue
+        # Steps of the job (e.g. 1234.batch, 1234.0) have their own line, keep job line only
+        jobid, state = fields[0], fields[1]
+        if jobid in jobids and state:
+            # e.g. "CANCELLED by 1234" -> "CANCELLED"
+            slurm_states_dict[jobid] = state.split()[0]
 
-    if p.returncode == config.system_process['SUCCESS']:
-        state_slurm_job = stdout.split("\n")[2].strip()
+    return slurm_states_dict
 
-        state_pipeline = config.slurm_states[state_slurm_job]['pipeline_status']
-        error_message  = config.slurm_states[state_slurm_job]['message']
 
-        print('state_pipeline ....', state_pipeline)
-        print('error_message', error_message)
+def get_slurm_job_pipeline_state(slurm_state):
+    '''
+    Translate slurm state to pipeline state and message (config.slurm_states)
+    '''
 
-    else:
+    if slurm_state is None:
         state_pipeline = config.status_update_idx['ERROR_STATUS']
         error_message  = 'Failed to retrieve slurm job status'
+    else:
+        state_pipeline = config.slurm_states[slurm_state]['pipeline_status']
+        error_message  = config.slurm_states[slurm_state]['message']
+
+    print('state_pipeline ....', state_pipeline)
+    print('error_message', error_message)
 
     return state_pipeline, error_message
 
 
+def check_slurm_job(ssh_user, host, jobid, local_user=False):
+
+    slurm_states_dict = check_slurm_jobs(ssh_user, host, [jobid], local_user=local_user)
+
+    slurm_state = None
+    if slurm_states_dict is not None:
+        slurm_state = slurm_states_dict.get(str(jobid), None)
+
+    return get_slurm_job_pipeline_state(slurm_state)
+
+
 def transfer_slurm_file(slurm_file_local_path, slurm_destination, cluster_vars):
     '''
     Create scp command from cluster directories and local slurm file
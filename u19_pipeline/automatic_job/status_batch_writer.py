@@ -0,0 +1,196 @@
+import hashlib
+import time
+import uuid
+
+
+def to_native(value):
+    # numpy scalars (from pandas series) to python types for query arguments
+    if hasattr(value, 'item'):
+        return value.item()
+    return value
+
+
+class StatusBatchWriter:
+    '''
+    Collect all status updates and log rows produced in one handler call and write them in a single transaction.
+    Status updates are optimistic: a record is only updated if its status is still the one read at the start
+    of the handler call. If another instance of the handler already changed it, the update, its log row and its
+    notifications are dropped.
+    Process functions with side effects outside the DB (sbatch, globus transfer) can not be undone by dropping the
+    update: those records are claimed (claim) before the function runs and flushed (flush(keys)) right after it,
+    updates of other records stay queued.
+    '''
+
+    def __init__(self, table, status_field, log_table):
+        '''
+        Input:
+        table        (dj.Table) = Table with status of records (recording.Recording, recording_process.Processing)
+        status_field (str)      = Status field of table (status_recording_id, status_processing_id)
+        log_table    (dj.Table) = Table where status changes are logged (recording.LogStatus, recording_process.LogStatus)
+        '''
+        self.table = table
+        self.status_field = status_field
+        self.log_table = log_table
+        self.key_fields = list(table.primary_key)
+
+        self.status_updates = list()
+        self.log_rows = list()
+        self.after_flush_calls = list()
+        self.flush_stats = dict()
+
+    def get_key_tuple(self, key):
+        return tuple(to_native(key[x]) for x in self.key_fields)
+
+    def update_status(self, key, status, expected_status, update_field=None, update_value=None):
+        '''
+        Queue status update (and optional extra field) of a record
+        Input:
+        key             (dict)    = Primary key of the record
+        status          (int)     = New status
+        expected_status (int)     = Status the record had when it was read (update is dropped if it changed)
+        update_field    (str)     = Extra field to be updated (only applicable to some status)
+        update_value  (str|int)   = Value of update_field
+        '''
+        self.status_updates.append(dict(key=key, status=to_native(status), expected_status=to_native(expected_status),
+                                        update_field=update_field, update_value=to_native(update_value)))
+
+    def insert_log(self, key, log_row):
+        '''
+        Queue log row of a status change of record key
+        '''
+        self.log_rows.append((self.get_key_tuple(key), log_row))
+
+    def after_flush(self, key, function, *args):
+        '''
+        Queue function call (e.g. slack notification) to be executed only if update of record key was written
+        '''
+        self.after_flush_calls.append((self.get_key_tuple(key), function, args))
+
+    def get_key_condition(self, key_tuples):
+        condition = ' OR '.join(['(' + ' AND '.join(['`' + x + '`=%s' for x in self.key_fields]) + ')'] * len(key_tuples))
+        args = [value for key_tuple in key_tuples for value in key_tuple]
+        return condition, args
+
+    def get_lock_name(self, key):
+        # MySQL lock names are limited to 64 characters
+        lock_id = self.table.full_table_name + str(self.get_key_tuple(key))
+        return 'status_claim_' + hashlib.md5(lock_id.encode('UTF-8')).hexdigest()
+
+    def claim(self, key, expected_status):
+        '''
+        Claim record before running a process function with side effects outside the DB.
+        Takes a named DB lock for the record (without waiting) and checks its status is still expected_status,
+        so only one instance of the handler runs the function.
+        Claimed records have to be released (release) after their update is written (flush).
+        Returns:
+        claimed (bool) = True if record was claimed, False if other process has it or its status changed
+        '''
+        connection = self.table.connection
+        lock_name = self.get_lock_name(key)
+        if connection.query('SELECT GET_LOCK(%s, 0)', args=(lock_name,)).fetchone()[0] != 1:
+            print('Record claimed by other process, skipped:', self.get_key_tuple(key))
+            return False
+
+        condition, args = self.get_key_condition([self.get_key_tuple(key)])
+        query = 'SELECT `' + self.status_field + '` FROM ' + self.table.full_table_name + ' WHERE ' + condition
+        current_status = connection.query(query, args=args).fetchone()
+        if current_status is None or current_status[0] != to_native(expected_status):
+            print('Status of record changed by other process, skipped:', self.get_key_tuple(key))
+            self.release(key)
+            return False
+
+        return True
+
+    def release(self, key):
+        '''
+        Release record claimed with claim
+        '''
+        self.table.connection.query('SELECT RELEASE_LOCK(%s)', args=(self.get_lock_name(key),))
+
+    def get_sql_value(self, field, value):
+        # uuid fields are stored as binary
+        if value is not None and self.table.heading.attributes[field].uuid:
+            value = uuid.UUID(str(value)).bytes
+        return value
+
+    def flush(self, keys=None):
+        '''
+        Write queued status updates and log rows in a single transaction
+        Input:
+        keys (list) = Only write updates, log rows and notifications of these records (others stay queued), default all
+        Returns:
+        flush_stats (dict) = Number of updates, conflicts, log rows and seconds spent writing
+        '''
+
+        flush_keys = None if keys is None else {self.get_key_tuple(x) for x in keys}
+
+        def is_flushed(key_tuple):
+            return flush_keys is None or key_tuple in flush_keys
+
+        status_updates = [x for x in self.status_updates if is_flushed(self.get_key_tuple(x['key']))]
+        log_rows = [x for x in self.log_rows if is_flushed(x[0])]
+        after_flush_calls = [x for x in self.after_flush_calls if is_flushed(x[0])]
+        self.status_updates = [x for x in self.status_updates if not is_flushed(self.get_key_tuple(x['key']))]
+        self.log_rows = [x for x in self.log_rows if not is_flushed(x[0])]
+        self.after_flush_calls = [x for x in self.after_flush_calls if not is_flushed(x[0])]
+
+        start_time = time.time()
+        conflict_keys = set()
+
+        if len(status_updates) > 0 or len(log_rows) > 0:
+
+            connection = self.table.connection
+            with connection.transaction:
+
+                # Lock records and check status is still the expected one
+                key_tuples = list(dict.fromkeys([self.get_key_tuple(x['key']) for x in status_updates]))
+                current_status = dict()
+                if len(key_tuples) > 0:
+                    condition, args = self.get_key_condition(key_tuples)
+                    query = 'SELECT ' + ', '.join(['`' + x + '`' for x in self.key_fields + [self.status_field]]) +\
+                        ' FROM ' + self.table.full_table_name + ' WHERE ' + condition + ' FOR UPDATE'
+                    for row in connection.query(query, args=args).fetchall():
+                        current_status[tuple(row[:-1])] = row[-1]
+
+                # Group updates that set same values into a single statement
+                update_groups = dict()
+                for this_update in status_updates:
+                    key_tuple = self.get_key_tuple(this_update['key'])
+                    if current_status.get(key_tuple) != this_update['expected_status']:
+                        conflict_keys.add(key_tuple)
+                        continue
+                    group = (this_update['status'], this_update['update_field'], this_update['update_value'])
+                    update_groups.setdefault(group, list()).append(key_tuple)
+
+                for (status, update_field, update_value), group_keys in update_groups.items():
+                    set_fields = '`' + self.status_field + '`=%s'
+                    set_args = [status]
+                    if update_field is not None:
+                        set_fields += ', `' + update_field + '`=%s'
+                        set_args.append(self.get_sql_value(update_field, update_value))
+                    condition, args = self.get_key_condition(group_keys)
+                    query = 'UPDATE ' + self.table.full_table_name + ' SET ' + set_fields + ' WHERE ' + condition
+                    connection.query(query, args=set_args + args)
+
+                insert_rows = [log_row for key_tuple, log_row in log_rows if key_tuple not in conflict_keys]
+                if len(insert_rows) > 0:
+                    self.log_table.insert(insert_rows)
+
+        write_secs = time.time() - start_time
+
+        if len(conflict_keys) > 0:
+            print('Status of records changed by other process, updates dropped:', sorted(conflict_keys))
+
+        for key_tuple, function, args in after_flush_calls:
+            if key_tuple not in conflict_keys:
+                function(*args)
+
+        self.flush_stats = dict()
+        self.flush_stats['status_updates'] = len(status_updates) - len([x for x in status_updates\
+            if self.get_key_tuple(x['key']) in conflict_keys])
+        self.flush_stats['conflicts'] = len(conflict_keys)
+        self.flush_stats['log_rows'] = len([x for x in log_rows if x[0] not in conflict_keys])
+        self.flush_stats['write_secs'] = write_secs
+        print('status batch writer', self.table.full_table_name, self.flush_stats)
+
+        return self.flush_stats
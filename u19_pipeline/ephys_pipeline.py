@@ -9,12 +9,11 @@ import datajoint as dj
 import numpy as np
 from element_array_ephys import ephys_precluster as ephys_element
 from element_array_ephys import probe as probe_element
-from element_array_ephys.readers import spikeglx
 from element_interface.utils import find_full_path
 
-import u19_pipeline.utils.DemoReadSGLXData.readSGLX as readSGLX
 import u19_pipeline.utils.ephys_fix_sync_code as efsc
 import u19_pipeline.utils.ephys_utils as ephys_utils
+import u19_pipeline.utils.spikeglx_meta_cache as spikeglx_meta_cache
 from u19_pipeline import recording
 
 schema = dj.schema(dj.config["custom"]["database.prefix"] + "ephys_pipeline")
@@ -203,10 +202,10 @@ def get_spikeglx_meta_filepath(ephys_recording_key):
                 ephys_element.ProbeInsertion * ephys_element.probe.Probe & ephys_recording_key
             ).fetch1("probe")
 
-            spikeglx_meta_filepaths = [fp for fp in session_dir.rglob("*.ap.meta")]
+            spikeglx_meta_filepaths = spikeglx_meta_cache.find_meta_files(session_dir, "*.ap.meta")
             for meta_filepath in spikeglx_meta_filepaths:
-                spikeglx_meta = spikeglx.SpikeGLXMeta(meta_filepath)
-                if str(spikeglx_meta.probe_SN) == inserted_probe_serial_number:
+                _, geometry = spikeglx_meta_cache.read_meta_geometry(meta_filepath)
+                if str(geometry["probe_serial_number"]) == inserted_probe_serial_number:
                     spikeglx_meta_filepath = meta_filepath
                     break
             else:
@@ -246,9 +245,9 @@ def get_full_vectors_from_key(rec_key, single_vec_mode=False):
         return
 
     # Get sampling rate and calculate channels and samples
-    nidq_meta, nidq_sampling_rate = ephys_utils.read_nidq_meta_samp_rate(full_session_path)
-    nChan = int(nidq_meta["nSavedChans"])
-    num_samples = int(int(nidq_meta["fileSizeBytes"]) / (2 * nChan))
+    _, geometry = spikeglx_meta_cache.read_meta_geometry(full_session_path)
+    nidq_sampling_rate = geometry["sampling_rate"]
+    num_samples = geometry["n_file_samples"]
 
     # Read behavior sync record
     try:
@@ -258,14 +257,11 @@ def get_full_vectors_from_key(rec_key, single_vec_mode=False):
         return
 
 
-    trial_index_nidq_virmen, iteration_index_nidq_virmen =\
-        ephys_utils.get_full_vector_samples(sync_data['iteration_idx_vector_from_virmen'],nidq_sampling_rate,num_samples)
+    trial_index_nidq_virmen, iteration_index_nidq_virmen, _ =\
+        ephys_utils.BehaviorSyncSampleMap(sync_data['iteration_idx_vector_from_virmen'],nidq_sampling_rate,num_samples).materialize()
 
-    trial_index_nidq, iteration_index_nidq =\
-        ephys_utils.get_full_vector_samples(sync_data['iteration_idx_vector'],nidq_sampling_rate,num_samples)
-
-
-    time_vector = ephys_utils.get_time_vector(trial_index_nidq, nidq_sampling_rate)
+    trial_index_nidq, iteration_index_nidq, time_vector =\
+        ephys_utils.BehaviorSyncSampleMap(sync_data['iteration_idx_vector'],nidq_sampling_rate,num_samples).materialize()
 
     #Calculate time for iteration start samples
     trial_times_ind, trial_times_full =\
@@ -303,6 +299,94 @@ def get_full_vectors_from_key(rec_key, single_vec_mode=False):
     return all_vectors
 
 
+def get_sample_map_from_key(rec_key, sync_vector="iteration_idx_vector"):
+    """
+    Get a lazy nidq sample -> (trial, iteration, time) mapping from a recording key.
+    Use it instead of get_full_vectors_from_key when only some samples (e.g. spike times) need to be mapped.
+
+    Args:
+        rec_key (dict): Dictionrary with recording_id key to fetch data from e.g. {'recording_id':500}
+        sync_vector (str): 'iteration_idx_vector' ("pulse only sync") or 'iteration_idx_vector_from_virmen' ("virmen assisted sync")
+
+    Returns:
+        sample_map (ephys_utils.BehaviorSyncSampleMap): mapping object, call sample_map.lookup(samples) to query
+    """
+
+    nidq_sampling_rate, sync_data = (BehaviorSync & rec_key).fetch1("nidq_sampling_rate", "sync_data")
+
+    # Only meta file is read to get total # of samples
+    full_session_path = get_full_session_directory(rec_key)
+    _, geometry = spikeglx_meta_cache.read_meta_geometry(full_session_path)
+    num_samples = geometry["n_file_samples"]
+
+    return ephys_utils.BehaviorSyncSampleMap(sync_data[sync_vector], nidq_sampling_rate, num_samples)
+
+
+def get_sync_path(regular_sync_status, fixed_sync_status):
+    # Which method produced the sync vectors to use for a BehaviorSync record
+    if regular_sync_status > 0:
+        return "regular"
+    elif fixed_sync_status > 0:
+        return "fixed"
+    else:
+        return "virmen"
+
+
+def get_sync_diagnostics(restriction=None, per_trial=True):
+    """
+    Get sync quality diagnostics of many recordings in a single fetch (no nidq file is read)
+
+    Args:
+        restriction: any restriction on BehaviorSync, e.g. 'recording_id > 500' or list of recording keys
+        per_trial (bool): True: one row per trial (SyncTrialDiagnostics), False: one row per recording (SyncSummary)
+
+    Returns:
+        diagnostics (pd.DataFrame): diagnostics joined with sync status columns of BehaviorSync
+    """
+
+    if restriction is None:
+        restriction = {}
+
+    sync_status = BehaviorSync.proj("regular_sync_status", "fixed_sync_status", "virmen_sync_status") & restriction
+    if per_trial:
+        diagnostics_query = sync_status * BehaviorSync.SyncSummary.proj("sync_path") * BehaviorSync.SyncTrialDiagnostics
+    else:
+        diagnostics_query = sync_status * BehaviorSync.SyncSummary
+
+    return diagnostics_query.fetch(format="frame")
+
+
+def insert_sync_diagnostics(restriction=None):
+    """
+    Fill diagnostics of BehaviorSync records populated before diagnostics tables existed.
+    Computed from stored sync_data and behavior trial_time (no nidq file is read), regular sync numbers are left null.
+    """
+
+    if restriction is None:
+        restriction = {}
+
+    behavior = dj.create_virtual_module("behavior", "u19_behavior")
+
+    missing_keys = ((BehaviorSync & restriction) - BehaviorSync.SyncSummary).fetch("KEY")
+    for key in missing_keys:
+        nidq_sampling_rate, sync_data, regular_sync_status, fixed_sync_status = (BehaviorSync & key).fetch1(
+            "nidq_sampling_rate", "sync_data", "regular_sync_status", "fixed_sync_status"
+        )
+
+        behavior_key = (recording.Recording.BehaviorSession & key).fetch1()
+        behavior_key.pop("recording_id")
+        behavior_time = (behavior.TowersBlock().Trial() & behavior_key).fetch("trial_time")
+
+        trial_diagnostics = [
+            dict(key, **x)
+            for x in efsc.get_sync_trial_diagnostics(sync_data["iteration_idx_vector"], behavior_time, nidq_sampling_rate)
+        ]
+
+        with BehaviorSync.connection.transaction:
+            BehaviorSync.SyncSummary.insert1(dict(key, sync_path=get_sync_path(regular_sync_status, fixed_sync_status)))
+            BehaviorSync.SyncTrialDiagnostics.insert(trial_diagnostics)
+
+
 # downstream tables for ephys element
 @schema
 class BehaviorSync(dj.Imported):
@@ -330,6 +414,29 @@ class BehaviorSync(dj.Imported):
         ephys_sampling_rate: float     # sampling rate of the headstage of a probe, imSampRate in imec meta file
         """
 
+    class SyncSummary(dj.Part):
+        definition = """
+        -> master
+        ---
+        sync_path                    : enum('regular', 'fixed', 'virmen')  # which method produced the usable sync vectors
+        regular_sync_eval=null       : tinyint      # evaluate_sync_process on regular sync (1 perfect, 0 fixable, -1 failed)
+        trial_count_diff=null        : int          # abs(# trials found in nidq - # trials in behavior) on regular sync
+        num_trials_diff_small=null   : int          # trials where regular sync missed < 6 iterations
+        num_trials_diff_big=null     : int          # trials where regular sync missed >= 6 iterations
+        """
+
+    class SyncTrialDiagnostics(dj.Part):
+        definition = """
+        -> master
+        trial_idx                           : int        # trial index in behavior (0 based, as in sync_data vectors)
+        ---
+        iteration_count_behavior            : int        # iterations in behavior trial_time
+        iteration_count_diff_regular=null   : int        # behavior - nidq iterations found by regular sync
+        iteration_count_diff=null           : int        # behavior - nidq iterations in stored iteration_idx_vector
+        drift_median=null                   : float      # median (nidq - virmen) iteration time in trial (s)
+        drift_deciles=null                  : blob       # median drift of each tenth of the trial relative to drift_median (s)
+        """
+
     def make(self, key, **kwargs):
         # Pull the Nidaq file/record
         print(key)
@@ -366,20 +473,21 @@ class BehaviorSync(dj.Imported):
             # 1: load meta data, and the content of the NIDAQ file. Its content is digital.
             nidq_meta, nidq_sampling_rate = ephys_utils.read_nidq_meta_samp_rate(ephys_session_fullpath)
 
-            trial_pulse_signal, iteration_pulse_signal = ephys_utils.load_trial_iteration_signals(
-                ephys_session_fullpath, nidq_meta
-            )
-
-            print("after reading spikeglx data")
-
             # Synchronize between pulses and get iteration # vector for each sample
             recent_recording = behavior_key["session_date"] > datetime.date(2021, 6, 1)  # Everything past June 1 2021
             if recent_recording:
+                edge_table, trial_line, iteration_line = ephys_utils.load_trial_iteration_edges(
+                    ephys_session_fullpath, nidq_meta
+                )
+
+                print("after reading spikeglx data")
+
                 # New synchronization method: digital_array[1,2] contain pulses for trial and frame number.
                 mode = None
-                iteration_dict = ephys_utils.get_iteration_sample_vector_from_digital_lines_pulses(
-                    trial_pulse_signal,
-                    iteration_pulse_signal,
+                iteration_dict = ephys_utils.get_iteration_sample_vector_from_edge_table(
+                    edge_table,
+                    trial_line,
+                    iteration_line,
                     nidq_sampling_rate,
                     behavior_time.shape[0],
                     behavior_time,
@@ -387,8 +495,17 @@ class BehaviorSync(dj.Imported):
                 )
             else:
                 # Old synchronization: digital_array[0:7] contain a digital word that counts the virmen frames.
-                raise ValueError("Old sessions < 2022 not suported anymore")
-                # iteration_dict = ephys_utils.get_iteration_sample_vector_from_digital_lines_word(digital_array, behavior_time, iterstart)
+                digital_array = ephys_utils.spice_glx_utility.load_spice_glx_digital_file_chunked(
+                    ephys_session_fullpath, nidq_meta
+                )
+
+                print("after reading spikeglx data")
+
+                iteration_dict = ephys_utils.get_iteration_sample_vector_from_digital_lines_word(
+                    digital_array, behavior_time, iterstart, nidq_sampling_rate
+                )
+                counter_trial_start_idx = iteration_dict["counter_trial_start_idx"]
+                del digital_array
 
             # Check # of trials (from database record of behavior in `behavior_time`) and iterations (extracted from NIDAQ in `iter_start_idx`) match
             trial_count_diff, trials_diff_iteration_big, trials_diff_iteration_small = (
@@ -402,6 +519,16 @@ class BehaviorSync(dj.Imported):
                 trial_count_diff, trials_diff_iteration_big, trials_diff_iteration_small, behavior_time.shape[0]
             )
 
+            # Keep regular sync numbers for diagnostics (iteration_dict is replaced if fix is needed)
+            sync_summary = dict(
+                key,
+                regular_sync_eval=status,
+                trial_count_diff=trial_count_diff,
+                num_trials_diff_small=len(trials_diff_iteration_small),
+                num_trials_diff_big=len(trials_diff_iteration_big),
+            )
+            regular_iter_start_idx = iteration_dict["iter_start_idx"]
+
             if status == 1:
                 iteration_dict["trial_start_idx"] = ephys_utils.get_index_trial_vector_from_iteration(
                     iteration_dict["iter_start_idx"]
@@ -431,15 +558,31 @@ class BehaviorSync(dj.Imported):
                 dictionary_sync_data["trial_idx_vector"] = []
                 dictionary_sync_data["iteration_idx_vector"] = []
 
-            iteration_dict["trial_start_idx_virmen"], iteration_dict["iter_start_idx_virmen"] = (
-                ephys_utils.get_iteration_intertrial_from_virmen_time(
-                    trial_pulse_signal, nidq_sampling_rate, behavior_time.shape[0], behavior_time
+            if recent_recording:
+                iteration_dict["trial_start_idx_virmen"], iteration_dict["iter_start_idx_virmen"] = (
+                    ephys_utils.get_iteration_intertrial_from_virmen_time_edges(
+                        edge_table, trial_line, nidq_sampling_rate, behavior_time.shape[0], behavior_time
+                    )
+                )
+            else:
+                # Old sessions have no trial pulse, trial starts come from the frame counter
+                iteration_dict["trial_start_idx_virmen"], iteration_dict["iter_start_idx_virmen"] = (
+                    ephys_utils.get_iteration_intertrial_from_trial_start(
+                        counter_trial_start_idx, nidq_sampling_rate, behavior_time.shape[0], behavior_time
+                    )
                 )
-            )
 
             dictionary_sync_data["trial_idx_vector_from_virmen"] = iteration_dict["trial_start_idx_virmen"]
             dictionary_sync_data["iteration_idx_vector_from_virmen"] = iteration_dict["iter_start_idx_virmen"]
 
+            sync_summary["sync_path"] = get_sync_path(status_regular, status_fix)
+            trial_diagnostics = [
+                dict(key, **x)
+                for x in efsc.get_sync_trial_diagnostics(
+                    dictionary_sync_data["iteration_idx_vector"], behavior_time, nidq_sampling_rate, regular_iter_start_idx
+                )
+            ]
+
             final_key = dict(
                 key,
                 nidq_sampling_rate=nidq_sampling_rate,
@@ -458,12 +601,16 @@ class BehaviorSync(dj.Imported):
 
             if 'populate' not in kwargs or kwargs['populate'] == True:
                 BehaviorSync.insert1(final_key,allow_direct_insert=True)
+                self.SyncSummary.insert1(sync_summary)
+                self.SyncTrialDiagnostics.insert(trial_diagnostics)
                 self.insert_imec_sampling_rate(key, ephys_session_fullpath.parent)
             else:
                 return final_key
 
         except Exception as e:
+            # Let populate record the error (jobs table when reserve_jobs=True)
             print(e)
+            raise
 
     def insert_imec_sampling_rate(self, key, session_dir):
         # get the imec sampling rate for a particular probe
@@ -484,5 +631,62 @@ class BehaviorSync(dj.Imported):
                 else:  # If this fails too, no imec file exists at the path.
                     raise NameError("No imec meta file found.")
 
-            imec_meta = readSGLX.readMeta(imec_bin_filepath)
+            imec_meta = spikeglx_meta_cache.read_meta(imec_bin_filepath)
             self.ImecSamplingRate.insert1(dict(probe_insertion, ephys_sampling_rate=imec_meta["imSampRate"]))
+
+
+@schema
+class CuratedClustersIteration(dj.Computed):
+    definition = """
+    -> ephys_element.CuratedClustering
+    -> BehaviorSync
+    """
+
+    @property
+    def key_source(self):
+        return ephys_element.CuratedClustering * (BehaviorSync & "regular_sync_status = 1 OR fixed_sync_status = 1")
+
+    class Unit(dj.Part):
+        definition = """
+        -> master
+        -> ephys_element.CuratedClustering.Unit
+        ---
+        spike_counts_iteration:   longblob   # number of spikes during each iteration. have length as the number of iterations - 1
+        firing_rate_before_first_iteration: float
+        firing_rate_after_last_iteration: float
+        """
+
+    def make(self, key):
+        # Replaces the per unit logic of ephys_sync.CuratedClustersIteration:
+        # all units of the probe are aligned to behavior in a single batched call.
+        # Per spike trial/iteration is not stored, it is recomputed with get_sample_map_from_key(key).align_spikes
+        sample_map = get_sample_map_from_key(key)
+        imec_sampling_rate = (BehaviorSync.ImecSamplingRate & key).fetch1("ephys_sampling_rate")
+
+        unit_keys, spike_times = (ephys_element.CuratedClustering.Unit & key).fetch("KEY", "spike_times")
+        unit_spike_samples = [np.round(x * imec_sampling_rate).astype(np.int64) for x in spike_times]
+
+        unit_alignment = sample_map.align_spikes(unit_spike_samples, imec_sampling_rate)
+
+        nidq_sampling_rate = sample_map.nidq_sampling_rate
+        time_first_iteration = sample_map.session_start_sample / nidq_sampling_rate
+        time_last_iteration = sample_map.iteration_start_samples[-1] / nidq_sampling_rate
+        time_end = sample_map.total_samples / nidq_sampling_rate
+
+        unit_entries = []
+        for unit_key, alignment in zip(unit_keys, unit_alignment):
+            spikes_before = np.sum(alignment["nidq_sample"] < sample_map.session_start_sample)
+            spikes_after = np.sum(alignment["nidq_sample"] >= sample_map.iteration_start_samples[-1])
+
+            unit_entries.append(
+                dict(
+                    unit_key,
+                    # Spikes of the last iteration are counted in firing_rate_after_last_iteration (as ephys_sync)
+                    spike_counts_iteration=alignment["spike_counts_iteration"][:-1],
+                    firing_rate_before_first_iteration=spikes_before / time_first_iteration,
+                    firing_rate_after_last_iteration=spikes_after / (time_end - time_last_iteration),
+                )
+            )
+
+        self.insert1(key)
+        self.Unit.insert(unit_entries)
@@ -7,6 +7,7 @@ from u19_pipeline.ephys_pipeline import ephys_element, get_session_directory
 
 import u19_pipeline.utils.DemoReadSGLXData.readSGLX as readSGLX
 import u19_pipeline.utils.ephys_utils as ephys_utils
+import u19_pipeline.utils.spikeglx_meta_cache as spikeglx_meta_cache
 import u19_pipeline.utils.path_utils as pu
 import u19_pipeline.automatic_job.params_config as config
 
@@ -40,7 +41,7 @@ class BehaviorSync(dj.Imported):
         behavior_time, iterstart = thissession.fetch('trial_time', 'vi_start')
 
         # 1: load meta data, and the content of the NIDAQ file. Its content is digital.
-        nidq_meta          = readSGLX.readMeta(nidq_bin_full_path)
+        nidq_meta          = spikeglx_meta_cache.read_meta(nidq_bin_full_path)
         nidq_sampling_rate = readSGLX.SampRate(nidq_meta)
 
         if nidq_meta['typeThis'] == 'nidq':
@@ -91,7 +92,7 @@ class BehaviorSync(dj.Imported):
                 else:   # If this fails too, no imec file exists at the path.
                     raise NameError("No imec meta file found.")
 
-            imec_meta = readSGLX.readMeta(imec_bin_filepath)
+            imec_meta = spikeglx_meta_cache.read_meta(imec_bin_filepath)
             self.ImecSamplingRate.insert1(
                 dict(probe_insertion,
                         ephys_sampling_rate=imec_meta['imSampRate']))
@@ -150,7 +151,7 @@ class CuratedClustersIteration(dj.Computed):
         # get end of time from nidq metadata
         session_dir = pathlib.Path(get_session_directory(key))
         nidq_bin_full_path = list(session_dir.glob('*nidq.bin*'))[0]
-        nidq_meta = readSGLX.readMeta(nidq_bin_full_path)
+        nidq_meta = spikeglx_meta_cache.read_meta(nidq_bin_full_path)
         t_end = np.float(nidq_meta['fileTimeSecs'])
 
         unit_spike_counts = []
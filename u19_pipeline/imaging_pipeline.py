@@ -2,10 +2,12 @@
 import datajoint as dj
 import pathlib
 import subprocess
+import tempfile
 
 from u19_pipeline import lab, acquisition, subject, recording
 import u19_pipeline.automatic_job.params_config as config
 import u19_pipeline.utils.dj_shortcuts as dj_short
+import u19_pipeline.utils.scanimage_header as si_header
 
 from element_calcium_imaging import scan as scan_element
 from element_calcium_imaging import imaging_preprocess as imaging_element
@@ -33,7 +35,6 @@ class ImagingPipelineSession(dj.Computed):
 class AcquiredTiff(dj.Imported):
     definition = """
     # metainfo about imaging session
-    # `make` function is declared in the `U19-pipeline-matlab`
     -> ImagingPipelineSession
     ---
     file_name_base       : varchar(255)                 # base name of the file
@@ -59,8 +60,8 @@ class AcquiredTiff(dj.Imported):
     fov_corner_points    : blob                         # coordinates of the corners of the full 5mm FOV, in microns
     nfovs                : int                          # number of field of view
     nframes              : int                          # number of frames in the scan
-    nframes_good         : int                          # number of frames in the scan before acceptable sample bleaching threshold is crossed
-    last_good_file       : int                          # number of the file containing the last good frame because of bleaching
+    nframes_good=null    : int                          # number of frames in the scan before acceptable sample bleaching threshold is crossed (null if not computed)
+    last_good_file=null  : int                          # number of the file containing the last good frame because of bleaching (null if not computed)
     motion_correction_enabled=0 : tinyint               # 
     motion_correction_mode='N/A': varchar(64)           # 
     stacks_enabled=0            : tinyint               # 
@@ -69,15 +70,53 @@ class AcquiredTiff(dj.Imported):
     """
 
     def make(self, key):
+        """
+        Read ScanImage headers of the recording tiff files, split them by field of view
+        and insert AcquiredTiff, TiffSplit and TiffSplit.File
+        Bleaching cutoff (nframes_good, last_good_file) is only computed by the MATLAB ingestion,
+        python ingestion (config.acquired_tiff_python_ingestion) leaves it null
+        """
+
+        if not config.acquired_tiff_python_ingestion:
+            self.make_matlab(key)
+            return
+
+        recording_directory = (recording.Recording & key).fetch1('recording_directory')
+        scan_directory = find_full_path(get_imaging_root_data_dir(), recording_directory)
+
+        tiff_files = si_header.get_scan_tiff_files(scan_directory)
+        if len(tiff_files) == 0:
+            raise FileNotFoundError(f'No tiff files found in {scan_directory}')
+
+        scan_info, fovs, file_frames = si_header.read_scan_headers(tiff_files)
+
+        # FOV files are written to a temporary directory (same filesystem) and moved into place after the inserts
+        with tempfile.TemporaryDirectory(prefix='.tiff_split_', dir=scan_directory) as split_directory:
+            fov_files = si_header.split_fov_files(tiff_files, scan_info, fovs, file_frames, scan_directory,
+                                                  split_directory=split_directory)
+
+            self.insert1({**key, **scan_info}, ignore_extra_fields=True)
+
+            for fov_idx, fov in enumerate(fovs):
+                tiff_split_key = {**key, 'tiff_split': fov_idx + 1}
+                TiffSplit.insert1({**tiff_split_key, **fov, 'tiff_split_directory': fov_files[fov_idx][0]['tiff_split_directory']},
+                                  ignore_extra_fields=True, allow_direct_insert=True)
+                TiffSplit.File.insert([{**tiff_split_key, 'file_number': file_idx + 1, **this_file}
+                                       for file_idx, this_file in enumerate(fov_files[fov_idx])],
+                                      ignore_extra_fields=True, allow_direct_insert=True)
+
+            si_header.move_fov_files(split_directory, scan_directory, fovs)
+
+    def make_matlab(self, key):
+        """
+        Populate AcquiredTiff and TiffSplit with the MATLAB ingestion (U19-pipeline-matlab)
+        """
 
         str_key = dj_short.get_string_key(key)
         command = [config.ingest_scaninfo_script, config.startup_pipeline_matlab_dir, str_key]
         print(command)
         p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        p.wait()
-        print('aftercommand before comm')
         stdout, stderr = p.communicate()
-        print('aftercommand after comm')
         print(stdout.decode('UTF-8'))
         print(stderr.decode('UTF-8'))
 
@@ -86,7 +125,7 @@ class AcquiredTiff(dj.Imported):
 class TiffSplit(dj.Imported):
     definition = """
     # meta-info about specific FOV within mesoscope imaging session
-    # `make` function is declared in the `U19-pipeline-matlab` repository
+    # populated by AcquiredTiff.make (python ingestion) or the `U19-pipeline-matlab` repository
     -> AcquiredTiff
     tiff_split           : tinyint                      # number of the tiff split in this scan
     ---
@@ -101,19 +140,6 @@ class TiffSplit(dj.Imported):
     power_percent           :  float                    # percentage of power used for this field of view
     """
 
-    #def populate(self, key):
-
-    #    str_key = dj_short.get_string_key(key)
-    #    command = [config.ingest_scaninfo_script, config.startup_pipeline_matlab_dir, str_key]
-    #    print(command)
-    #    p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    #    p.wait()
-    #    print('aftercommand before comm')
-    #    stdout, stderr = p.communicate()
-    #    print('aftercommand after comm')
-    #    print(stdout.decode('UTF-8'))
-    #    print(stderr.decode('UTF-8'))
-
     class File(dj.Part):
         definition = """
         # list of files per tiff split
@@ -355,6 +355,59 @@ class Trace(dj.Imported):
     """
 
 
+@schema
+class TraceStore(dj.Computed):
+    definition = """
+    # activity traces of all ROIs of a segmentation in one chunked & compressed file (ROI x frame, float32)
+    -> Segmentation
+    ---
+    trace_store_file     : varchar(255)                 # file path relative to the trace store root
+    n_rois               : int                          # number of ROIs in the file
+    n_frames             : int                          # number of frames of each trace
+    """
+
+    @property
+    def key_source(self):
+        return Segmentation & Trace
+
+    def make(self, key):
+        from u19_pipeline.utils import trace_store
+
+        roi_values = (Trace & key).fetch('roi_idx', *trace_store.roi_attributes, order_by='roi_idx')
+        roi_idx = roi_values[0]
+
+        trace_store_file = trace_store.get_trace_store_filename(key)
+        with trace_store.TraceStoreWriter(trace_store.get_trace_store_root() / trace_store_file, roi_idx) as writer:
+
+            # One attribute and block of ROIs at a time, all traces of the segmentation do not fit in memory
+            for attribute in trace_store.trace_attributes:
+                for first_row in range(0, len(roi_idx), trace_store.write_roi_block_size):
+                    block_roi_idx = roi_idx[first_row:first_row + trace_store.write_roi_block_size]
+                    block_query = Trace & key & f'roi_idx >= {block_roi_idx[0]} and roi_idx <= {block_roi_idx[-1]}'
+                    block_values = block_query.fetch(attribute, order_by='roi_idx')
+                    writer.write_traces(attribute, first_row,
+                                        np.vstack([np.ravel(x).astype(np.float32) for x in block_values]))
+
+            for attribute, attribute_values in zip(trace_store.roi_attributes, roi_values[1:]):
+                attribute_values = np.array([np.ravel(x) for x in attribute_values])
+                if attribute_values.shape[1] == 1:
+                    attribute_values = attribute_values[:, 0]
+                writer.write_roi_values(attribute, attribute_values)
+
+            n_frames = writer.n_frames
+
+        self.insert1({**key, 'trace_store_file': trace_store_file, 'n_rois': len(roi_idx), 'n_frames': n_frames})
+
+    def get_reader(self, key=None):
+        """
+        Lazy reader of the traces of a segmentation (e.g. reader.get('dff_roi', roi_idx=[1, 5], frames=slice(0, 1000)))
+        """
+        from u19_pipeline.utils import trace_store
+
+        trace_store_file = ((self & key) if key is not None else self).fetch1('trace_store_file')
+        return trace_store.TraceStoreReader(trace_store.get_trace_store_root() / trace_store_file)
+
+
 
 
 if __name__ == '__main__':
@@ -1,5 +1,8 @@
 import datajoint as dj
-from u19_pipeline import meso
+import numpy as np
+import pandas as pd
+from u19_pipeline import meso, behavior
+import u19_pipeline.utils.meso_analysis_utils as mau
 
 schema = dj.schema('u19_meso_analysis')
 
@@ -118,6 +121,20 @@ class Trialstats(dj.Computed):
     iti_end_meso_frame=null : int                          # imaging frame id corresponding to end of ITI (last frame before next trial)
     """
 
+    @property
+    def key_source(self):
+        return meso.Scan & meso.SyncImagingBehavior
+
+    def make(self, key):
+
+        # Behavior of all trials of the session in a single query
+        trials, block_by_frame, trial_by_frame, iter_by_frame = get_trialstats_inputs(key)
+        if len(trials) == 0:
+            return
+
+        rows = mau.get_trialstats(trials, block_by_frame, trial_by_frame, iter_by_frame)
+        self.insert([{**key, **row} for row in rows])
+
 
 @schema
 class BinnedBehavior(dj.Computed):
@@ -178,3 +195,164 @@ class RoiStatsParamsSet(dj.Lookup):
     min_active_fraction  : float
     min_active_seconds   : float
     """
+
+
+def get_segmentation_roi_idx(key):
+    """
+    roi_idx of all ROIs of a segmentation (from meso.TraceStore if populated)
+    """
+    if meso.TraceStore & key:
+        with (meso.TraceStore & key).get_reader() as reader:
+            return reader.roi_idx
+    return (meso.Trace & key).fetch('roi_idx', order_by='roi_idx')
+
+
+def get_segmentation_dff_blocks(key, roi_idx, block_size=mau.roi_block_size):
+    """
+    dff of some ROIs of a segmentation, block_size ROIs at a time (from meso.TraceStore if populated)
+    Yields:
+        first_row (int): position of the block in roi_idx, dff (np.array): block ROI x frame
+    """
+    if meso.TraceStore & key:
+        with (meso.TraceStore & key).get_reader() as reader:
+            for first_row in range(0, len(roi_idx), block_size):
+                yield first_row, reader.get('dff_roi', roi_idx=roi_idx[first_row:first_row + block_size])
+        return
+    for first_row in range(0, len(roi_idx), block_size):
+        block_roi_idx = roi_idx[first_row:first_row + block_size]
+        dff = (meso.Trace & key & [{'roi_idx': int(x)} for x in block_roi_idx]).fetch('dff_roi', order_by='roi_idx')
+        yield first_row, np.vstack([np.ravel(x) for x in dff])
+
+
+def get_trialstats_inputs(key):
+    """
+    Behavior of all trials of a scan (single query) and its imaging / behavior sync (same for all FOVs)
+    Returns:
+        trials (pd.DataFrame), block_by_frame, trial_by_frame, iter_by_frame (np.array)
+    """
+    trials = pd.DataFrame((behavior.TowersBlock.Trial * behavior.TowersBlock & key).fetch(
+        *mau.trialstats_behavior_fields, as_dict=True, order_by=('block', 'trial_idx')))
+    block_by_frame, trial_by_frame, iter_by_frame = [x[0] for x in (meso.SyncImagingBehavior & key).fetch(
+        'sync_behav_block_by_im_frame', 'sync_behav_trial_by_im_frame', 'sync_behav_iter_by_im_frame',
+        order_by='fov', limit=1)]
+    return trials, block_by_frame, trial_by_frame, iter_by_frame
+
+
+def check_trialstats_parity(key, rtol=1e-5, atol=1e-8):
+    """
+    Compare Trialstats computed in Python (meso_analysis_utils.get_trialstats) with the rows populated by MATLAB
+    for a reference scan (scripts/check_trialstats_parity.py checks it against a fixture session without database)
+    Returns:
+        parity (pd.DataFrame): per column mismatches (see meso_analysis_utils.compare_trialstats)
+    """
+    key = (meso.Scan & key).fetch1('KEY')
+    python_rows = mau.get_trialstats(*get_trialstats_inputs(key))
+    matlab_rows = (Trialstats & key).fetch(as_dict=True, order_by='trial_idx')
+    return mau.compare_trialstats(python_rows, matlab_rows, rtol, atol)
+
+
+def get_good_morphology_rois(key):
+    """
+    roi_idx of blobs and doughnuts (manual classification overrides automatic one)
+    """
+    morphology = dict(zip(*(meso.Segmentation.RoiMorphologyAuto & key).fetch('roi_idx', 'morphology'), strict=True))
+    morphology.update(dict(zip(*(meso.SegmentationRoiMorphologyManual & key).fetch('roi_idx', 'morphology'), strict=True)))
+    return np.array([roi for roi, roi_morphology in morphology.items() if roi_morphology in mau.good_morphologies])
+
+
+@schema
+class BinnedTraceSegmentation(dj.Computed):
+    definition = """
+    # time binned activity of all ROIs and trials of a segmentation in a single array (check_binned_trace_parity compares it with BinnedTrace)
+    -> StandardizedTime
+    -> TrialSelectionParameters
+    ---
+    global_roi_idx       : longblob                     # roi_idx of each row of binned_dff
+    trial_idx            : longblob                     # trial_idx of each column of binned_dff
+    binned_dff           : blob@meso                    # binned Dff, ROI x trial x bin (float32)
+    """
+
+    def make(self, key):
+
+        epoch_binning, good_morpho_only = (BinningParameters & key).fetch1('epoch_binning', 'good_morpho_only')
+        selection_params = (TrialSelectionParameters & key).fetch1()
+        standardized_time = np.ravel((StandardizedTime & key).fetch1('standardized_time'))
+
+        trials = pd.DataFrame((Trialstats & key).fetch(
+            'trial_idx', 'meso_frame_unique_ids', 'block_id', 'is_towers_task', 'is_visguided_task',
+            'mean_perf_block', 'mean_bias_block', 'is_excess_travel', as_dict=True, order_by='trial_idx'))
+        if len(trials) > 0:
+            trials = trials[mau.select_trials(trials, selection_params)]
+        trial_idx = trials['trial_idx'].values.astype(int) if len(trials) > 0 else np.array([], dtype=int)
+
+        roi_idx = np.asarray(get_segmentation_roi_idx(key))
+        if good_morpho_only:
+            roi_idx = roi_idx[np.isin(roi_idx, get_good_morphology_rois(key))]
+
+        # Bin of each trial frame from the standardized time of the session
+        frames, frame_trials = mau.get_frame_trials(trials['meso_frame_unique_ids'] if len(trials) else [])
+        in_session = (frames >= 1) & (frames <= len(standardized_time))
+        frame_time = np.full(len(frames), np.nan)
+        frame_time[in_session] = standardized_time[frames[in_session] - 1]
+        frame_bins = mau.get_frame_bins(frame_time, epoch_binning)
+
+        # dff is read and binned by blocks of ROIs, only binned values of all ROIs are held in memory
+        n_bins = int(np.sum(epoch_binning))
+        binned_dff = np.full((len(roi_idx), len(trial_idx), n_bins), np.nan, dtype=np.float32)
+        for first_row, dff in get_segmentation_dff_blocks(key, roi_idx):
+            binned_dff[first_row:first_row + dff.shape[0]] = mau.bin_traces(dff, frames, frame_trials, frame_bins,
+                                                                            len(trial_idx), n_bins)
+
+        self.insert1({**key, 'global_roi_idx': roi_idx, 'trial_idx': trial_idx, 'binned_dff': binned_dff})
+
+    def get_binned_dff(self, global_roi_idx=None, trial_idx=None):
+        """
+        Binned dff of a segmentation for some ROIs and trials
+        Returns:
+            binned_dff (np.array): ROI x trial x bin, rows & columns in the order of global_roi_idx & trial_idx
+        """
+        roi_values, trial_values, binned_dff = self.fetch1('global_roi_idx', 'trial_idx', 'binned_dff')
+        if global_roi_idx is not None:
+            binned_dff = binned_dff[[int(np.flatnonzero(roi_values == x)[0]) for x in np.atleast_1d(global_roi_idx)]]
+        if trial_idx is not None:
+            binned_dff = binned_dff[:, [int(np.flatnonzero(trial_values == x)[0]) for x in np.atleast_1d(trial_idx)]]
+        return binned_dff
+
+    def fetch_binned_trace(self, global_roi_idx=None, trial_idx=None):
+        """
+        Rows with the fields of BinnedTrace (one per ROI and trial) for all segmentations in this query
+        """
+        rows = list()
+        for key, roi_values, trial_values, binned_dff in zip(*self.fetch('KEY', 'global_roi_idx', 'trial_idx',
+                                                                         'binned_dff'), strict=True):
+            roi_positions = np.arange(len(roi_values)) if global_roi_idx is None \
+                else np.flatnonzero(np.isin(roi_values, global_roi_idx))
+            trial_positions = np.arange(len(trial_values)) if trial_idx is None \
+                else np.flatnonzero(np.isin(trial_values, trial_idx))
+            for roi_position in roi_positions:
+                for trial_position in trial_positions:
+                    rows.append({**key, 'global_roi_idx': int(roi_values[roi_position]),
+                                 'trial_idx': int(trial_values[trial_position]),
+                                 'binned_dff': binned_dff[roi_position, trial_position]})
+        return rows
+
+
+def check_binned_trace_parity(key, rtol=1e-5, atol=1e-8):
+    """
+    Compare BinnedTraceSegmentation with the BinnedTrace rows populated by MATLAB for a segmentation,
+    binning & trial selection parameters
+    Returns:
+        parity (pd.DataFrame): global_roi_idx, trial_idx and match (binned_dff equal, NaN in the same bins) per
+                               BinnedTrace row
+    """
+    key = (BinnedTraceSegmentation & key).fetch1('KEY')
+    python_dff = {(x['global_roi_idx'], x['trial_idx']): x['binned_dff']
+                  for x in (BinnedTraceSegmentation & key).fetch_binned_trace()}
+    parity = list()
+    for global_roi_idx, trial_idx, binned_dff in zip(*(BinnedTrace & key).fetch(
+            'global_roi_idx', 'trial_idx', 'binned_dff', order_by=('global_roi_idx', 'trial_idx')), strict=True):
+        python_value = python_dff.get((int(global_roi_idx), int(trial_idx)))
+        match = python_value is not None and np.allclose(np.ravel(python_value), np.ravel(binned_dff).astype(float),
+                                                         rtol=rtol, atol=atol, equal_nan=True)
+        parity.append({'global_roi_idx': int(global_roi_idx), 'trial_idx': int(trial_idx), 'match': match})
+    return pd.DataFrame(parity, columns=['global_roi_idx', 'trial_idx', 'match'])
@@ -308,6 +308,135 @@ def GainCorrectIM(dataArray, chanList, meta):
         convArray[i, :] = dataArray[i, :]*conv
     return(convArray)
 
+# Return the conversion factor (to volts) for each saved channel in chanList.
+# Vectorized equivalent of the per channel loops in GainCorrectNI/OBX/IM,
+# the factor of chanList[i] is exactly the conv used for row i there.
+#
+def ChanConvNI(chanList, meta):
+    MN, MA, XA, DW = ChannelCountsNI(meta)
+    fI2V = Int2Volts(meta)
+    chanList = np.asarray(chanList)
+    gain = np.ones(chanList.shape, dtype=float)
+    isMN = chanList < MN
+    isMA = (chanList >= MN) & (chanList < MN + MA)
+    if np.any(isMN):
+        gain[isMN] = float(meta['niMNGain'])
+    if np.any(isMA):
+        gain[isMA] = float(meta['niMAGain'])
+    return(fI2V/gain)
+
+
+def ChanConvOBX(chanList, meta):
+    fI2V = Int2Volts(meta)
+    return(np.full(len(chanList), fI2V, dtype=float))
+
+
+def ChanConvIM(chanList, meta):
+    chans = OriginalChans(meta)
+    APgain, LFgain, _, _ = ChanGainsIM(meta)
+    nAP = len(APgain)
+    nNu = nAP * 2
+    fI2V = Int2Volts(meta)
+
+    k = chans[np.asarray(chanList, dtype=int)]    # acquisition index
+    conv = np.ones(k.shape, dtype=float)
+    isAP = k < nAP
+    isLF = (k >= nAP) & (k < nNu)
+    conv[isAP] = fI2V / APgain[k[isAP]]
+    conv[isLF] = fI2V / LFgain[k[isLF] - nAP]
+    return(conv)
+
+
+def ChanConv(chanList, meta):
+    if meta['typeThis'] == 'imec':
+        conv = ChanConvIM(chanList, meta)
+    elif meta['typeThis'] == 'nidq':
+        conv = ChanConvNI(chanList, meta)
+    elif meta['typeThis'] == 'obx':
+        conv = ChanConvOBX(chanList, meta)
+    else:
+        print('Error: unknown stream type')
+        conv = np.ones(len(chanList), dtype=float)
+    return(conv)
+
+
+# Vectorized versions of GainCorrectNI/OBX/IM. The conversion vector is
+# built once and applied with broadcasting, no per channel python loop.
+# - dtype: output type, 'float64' matches the original functions exactly,
+#    'float32' halves the memory of the output.
+# - out: optional preallocated [len(chanList) X nSamp] array to write into
+#    (its dtype takes precedence over dtype).
+#
+def GainCorrectVec(dataArray, chanList, meta, dtype='float64', out=None):
+    conv = ChanConv(chanList, meta)
+    if out is not None:
+        dtype = out.dtype
+    conv = conv.astype(dtype)[:, np.newaxis]
+    # dataArray contains only the channels in chanList
+    return(np.multiply(dataArray, conv, out=out, dtype=dtype))
+
+
+def GainCorrectNIVec(dataArray, chanList, meta, dtype='float64', out=None):
+    return(GainCorrectVec(dataArray, chanList, dict(meta, typeThis='nidq'), dtype, out))
+
+
+def GainCorrectOBXVec(dataArray, chanList, meta, dtype='float64', out=None):
+    return(GainCorrectVec(dataArray, chanList, dict(meta, typeThis='obx'), dtype, out))
+
+
+def GainCorrectIMVec(dataArray, chanList, meta, dtype='float64', out=None):
+    return(GainCorrectVec(dataArray, chanList, dict(meta, typeThis='imec'), dtype, out))
+
+
+# Number of samples per chunk so that one int16 chunk plus its converted
+# copy (dtype) of nChan channels fits in chunkBytes.
+#
+def ChunkSamples(nChan, dtype, chunkBytes):
+    bytesPerSamp = max(nChan, 1) * (2 + np.dtype(dtype).itemsize)
+    return(max(int(chunkBytes // bytesPerSamp), 1))
+
+
+# Gain correct a time window [firstSamp, lastSamp] (inclusive, as in
+# ExtractDigital) of the channels in chanList straight from the memmap
+# returned by makeMemMapRaw, reading one chunk at a time. Only one int16
+# chunk is held in memory besides the output.
+# - chunkBytes: memory budget of a chunk (int16 read + converted copy),
+#    128 MiB is ~58000 samples of a full 385 channel imec AP stream.
+# - chunkSamp: optional fixed number of samples per chunk (overrides chunkBytes).
+# GainCorrectChunks yields (chunkFirstSamp, convChunk) so long windows can
+# be reduced on the fly; GainCorrectWindow fills a single output array.
+#
+def GainCorrectChunks(rawData, chanList, firstSamp, lastSamp, meta,
+                      dtype='float32', chunkSamp=None, chunkBytes=2**27):
+    conv = ChanConv(chanList, meta).astype(dtype)[:, np.newaxis]
+    chanList = np.asarray(chanList, dtype=int)
+    if chunkSamp is None:
+        chunkSamp = ChunkSamples(len(chanList), dtype, chunkBytes)
+    chunkSamp = int(chunkSamp)
+    for chunkStart in range(firstSamp, lastSamp+1, chunkSamp):
+        chunkEnd = min(chunkStart + chunkSamp, lastSamp+1)
+        selectData = rawData[chanList, chunkStart:chunkEnd]
+        yield chunkStart, np.multiply(selectData, conv, dtype=dtype)
+
+
+def GainCorrectWindow(rawData, chanList, firstSamp, lastSamp, meta,
+                      dtype='float32', out=None, chunkSamp=None, chunkBytes=2**27):
+    nSamp = lastSamp - firstSamp + 1
+    if out is None:
+        out = np.empty((len(chanList), nSamp), dtype=dtype)
+    conv = ChanConv(chanList, meta).astype(out.dtype)[:, np.newaxis]
+    chanList = np.asarray(chanList, dtype=int)
+    if chunkSamp is None:
+        chunkSamp = ChunkSamples(len(chanList), out.dtype, chunkBytes)
+    chunkSamp = int(chunkSamp)
+    for chunkStart in range(firstSamp, lastSamp+1, chunkSamp):
+        chunkEnd = min(chunkStart + chunkSamp, lastSamp+1)
+        selectData = rawData[chanList, chunkStart:chunkEnd]
+        np.multiply(selectData, conv,
+                    out=out[:, chunkStart-firstSamp:chunkEnd-firstSamp])
+    return(out)
+
+
 # Return memmap for the raw data
 # Fortran ordering is used to match the MATLAB version
 # of these tools.
@@ -1,5 +1,6 @@
 
 import datetime
+import multiprocessing
 import pathlib
 import numpy as np
 
@@ -114,6 +115,115 @@ def get_shift_vector(synced_time_vector, behavior_time_vector, base_size=40,init
     return new_synced_time_vector, vec_shift, [min_diff, median_diff, max_diff]
 
 
+# # of shifts evaluated at once per window in get_shift_vector_vectorized
+SHIFT_BLOCK_SIZE = 8
+
+
+def get_window_medians(synced_time_vector, behavior_time_vector, window_start, shift, window_size):
+    # median(synced_time_vector[start+shift:start+shift+window_size] - behavior_time_vector[start:start+window_size])
+    # for every (window_start, shift) pair, all computed in a batch.
+    # Windows running past the end of synced_time_vector are truncated (as in get_shift_vector), empty ones are nan
+
+    num_synced = synced_time_vector.shape[0]
+    valid_size = np.clip(num_synced - window_start - shift, 0, window_size)
+
+    offsets = np.arange(window_size)
+    synced_idx = np.clip(window_start[:, np.newaxis] + shift[:, np.newaxis] + offsets, 0, num_synced-1)
+    diff_windows = synced_time_vector[synced_idx] - behavior_time_vector[window_start[:, np.newaxis] + offsets]
+
+    medians = np.full(window_start.shape[0], np.nan)
+    for this_size in np.unique(valid_size):
+        if this_size == 0:
+            continue
+        rows = valid_size == this_size
+        medians[rows] = np.median(diff_windows[rows, :this_size], axis=1)
+
+    return medians
+
+
+def get_shift_vector_vectorized(synced_time_vector, behavior_time_vector, base_size=40, initial_sample=0, samples_shift=100):
+    # Same output as get_shift_vector. Instead of looping window by window and shift by shift,
+    # medians of all windows (sliding_window_view) and blocks of candidate shifts for all unresolved windows are computed at once
+
+    num_synced = synced_time_vector.shape[0]
+    num_windows = num_synced - base_size
+    window_size = base_size - initial_sample
+
+    # Degenerate cases (loop version errors out or windows don't fit in behavior vector) are left to the loop version
+    if num_windows <= 0 or window_size < 2 or initial_sample < 0 or num_synced > behavior_time_vector.shape[0]:
+        return get_shift_vector(synced_time_vector, behavior_time_vector, base_size, initial_sample, samples_shift)
+
+    baseline_diff = synced_time_vector[initial_sample:base_size] - behavior_time_vector[initial_sample:base_size]
+
+    median_diff = np.median(baseline_diff)
+    max_diff = np.median(baseline_diff)+0.007
+    min_diff = np.median(baseline_diff)-0.007
+
+    # Window i covers [initial_sample+i+1, base_size+i+1)
+    window_start = initial_sample + np.arange(num_windows) + 1
+    diff_windows = np.lib.stride_tricks.sliding_window_view(synced_time_vector - behavior_time_vector[:num_synced], window_size)
+    median_ori = np.median(diff_windows[window_start], axis=1)
+
+    # Windows out of range search shifts towards the baseline: +1 forward, -1 backward
+    sign = np.where(median_ori < min_diff, 1, -1)
+    sign[(median_ori >= min_diff) & (median_ori < max_diff)] = 0
+
+    vec_shift = np.zeros((num_windows), dtype=int)
+    unresolved = np.flatnonzero(sign != 0)
+
+    for block_start in range(1, samples_shift, SHIFT_BLOCK_SIZE):
+
+        if unresolved.shape[0] == 0:
+            break
+
+        shifts = np.arange(block_start, min(block_start+SHIFT_BLOCK_SIZE, samples_shift))
+        this_sign = sign[unresolved][:, np.newaxis]
+        signed_shifts = (this_sign*shifts).flatten()
+        this_window_start = np.repeat(window_start[unresolved], shifts.shape[0])
+
+        medians = get_window_medians(synced_time_vector, behavior_time_vector,
+                                     this_window_start, signed_shifts, window_size).reshape(-1, shifts.shape[0])
+
+        # Forward search continues while still below range, backward while not below max
+        keep_searching = np.where(this_sign == 1, medians < min_diff, ~(medians < max_diff))
+        found = ~keep_searching
+        has_found = np.any(found, axis=1)
+        idx_found = np.argmax(found, axis=1)
+
+        # Backward shifts before the first sample make the loop version fail, let it handle (and raise) it
+        before_start = (this_window_start + signed_shifts < 0).reshape(-1, shifts.shape[0])
+        last_searched = np.where(has_found, idx_found, shifts.shape[0]-1)
+        if np.any(before_start & (np.arange(shifts.shape[0]) <= last_searched[:, np.newaxis])):
+            return get_shift_vector(synced_time_vector, behavior_time_vector, base_size, initial_sample, samples_shift)
+
+        rows = unresolved[has_found]
+        median_now = medians[has_found, idx_found[has_found]]
+        shift_now = shifts[idx_found[has_found]]*sign[rows]
+
+        # Search crossed the whole range: keep the closest to the baseline median
+        in_range = (median_now >= min_diff) & (median_now < max_diff)
+        keep_original = ~in_range & (np.abs(median_ori[rows]-median_diff) < np.abs(median_now-median_diff))
+        vec_shift[rows] = np.where(keep_original, 0, shift_now)
+
+        unresolved = unresolved[~has_found]
+
+    # Never found in range
+    if samples_shift > 1:
+        vec_shift[unresolved] = (samples_shift-1)*sign[unresolved]
+
+    new_synced_time_vector = synced_time_vector.copy()
+    mid_point = int(initial_sample+base_size/2)
+    idx_shifted = mid_point + np.arange(vec_shift.shape[0])
+    new_synced_time_vector[idx_shifted] = synced_time_vector[idx_shifted + vec_shift]
+
+    idx_end = mid_point+vec_shift.shape[0]-1
+    idx_last = np.arange(idx_end, new_synced_time_vector.shape[0])
+    idx_last = idx_last[idx_last + vec_shift[-1] < new_synced_time_vector.shape[0]]
+    new_synced_time_vector[idx_last] = synced_time_vector[idx_last + vec_shift[-1]]
+
+    return new_synced_time_vector, vec_shift, [min_diff, median_diff, max_diff]
+
+
 def fix_shifted_sync_vector(synced_time_vector, behavior_time_vector, vec_shift, initial_sample=0, base_size=40):
 
     mid_point = int(initial_sample+base_size/2)
@@ -272,24 +382,28 @@ def fix_iter_vector(synced_iteration_vector, synced_time_vector, original_time_v
     return new_synced_iteration_vector
 
 
-def sync_evaluation_process2(synced_time_vector, behavior_time_vector):
+def get_sync_drift_deciles(synced_time_vector, behavior_time_vector, num_div=10):
+    # Median drift (nidq - virmen iteration times) of a trial and median drift of each of its num_div parts relative to it
 
-    status = 1
     diff_vector = synced_time_vector - behavior_time_vector[:synced_time_vector.shape[0]]
     num_iter = diff_vector.shape[0]
 
     #max_diff = max(diff_vector)
     median_general = np.median(diff_vector)
 
-    num_div= 10
-    median_diff_percent = np.empty([num_div])
     median_diff_abs = np.empty([num_div])
     for j in range(num_div):
         start_iter = int(j*num_iter/num_div)
         end_iter = int((j+1)*num_iter/num_div)
-        median_diff_percent[j] = (np.median(diff_vector[start_iter:end_iter])-median_general)*100/median_general
         median_diff_abs[j] = (np.median(diff_vector[start_iter:end_iter])-median_general)
 
+    return median_general, median_diff_abs
+
+
+def sync_evaluation_process2(synced_time_vector, behavior_time_vector):
+
+    status = 1
+    median_general, median_diff_abs = get_sync_drift_deciles(synced_time_vector, behavior_time_vector)
 
     if np.max(np.abs(median_diff_abs)) < 0.005:
         pass
@@ -300,32 +414,86 @@ def sync_evaluation_process2(synced_time_vector, behavior_time_vector):
     return status
 
 
-def main_ephys_fix_sync_code(iter_start_idx, iter_times_idx, behavior_time, nidq_sampling_rate):
+def get_sync_trial_diagnostics(iter_start_idx, behavior_time, nidq_sampling_rate, regular_iter_start_idx=None):
+    # Per trial sync diagnostics (rows for BehaviorSync.SyncTrialDiagnostics)
+    # Inputs
+    # iter_start_idx         = final (stored) iteration start samples per trial, [] if sync failed
+    # behavior_time          = behavior trial_time per trial
+    # regular_iter_start_idx = iteration start samples found by regular sync (before fix), None if unknown
 
-    iteration_dict = dict()
-    iteration_dict['iter_start_idx']  = list()
-    iteration_dict['iter_times_idx']  = list()
+    trial_diagnostics = list()
+    for i in range(behavior_time.shape[0]):
+        behavior_time_vector = behavior_time[i].flatten()
 
-    for i in range(len(iter_start_idx)):
+        this_trial = dict()
+        this_trial['trial_idx'] = i
+        this_trial['iteration_count_behavior'] = behavior_time_vector.shape[0]
+        this_trial['iteration_count_diff_regular'] = None
+        this_trial['iteration_count_diff'] = None
+        this_trial['drift_median'] = None
+        this_trial['drift_deciles'] = None
 
-        #print('fixing trial ',i)
-        behavior_time_vector = behavior_time[i].flatten()
+        if regular_iter_start_idx is not None and i < len(regular_iter_start_idx):
+            this_trial['iteration_count_diff_regular'] = behavior_time_vector.shape[0] - len(regular_iter_start_idx[i])
 
-        synced_time_vector, shift_vec, median_vec = get_shift_vector(iter_times_idx[i],behavior_time_vector)
-        
+        if i < len(iter_start_idx) and len(iter_start_idx[i]) > 0:
+            iter_samples = np.asarray(iter_start_idx[i]).flatten()
+            this_trial['iteration_count_diff'] = behavior_time_vector.shape[0] - iter_samples.shape[0]
 
-        synced_time_vector,_ =\
-            fix_shifted_sync_vector(synced_time_vector, behavior_time_vector, shift_vec)
+            # Drift on common iterations, times as in iter_times_idx
+            num_common = min(iter_samples.shape[0], behavior_time_vector.shape[0])
+            synced_time_vector = (iter_samples[:num_common] - iter_samples[0])/nidq_sampling_rate
+            if num_common >= 10:
+                median_general, median_diff_abs = get_sync_drift_deciles(synced_time_vector, behavior_time_vector[:num_common])
+                this_trial['drift_median'] = median_general
+                this_trial['drift_deciles'] = median_diff_abs
 
-        #synced_time_vector, trial_stats_dict['borrow_step3'] =\
-        #    fix_sync_vector_greater(synced_time_vector, behavior_time_vector)
-        synced_time_vector,_ =\
-            complete_last_part_sync_vec(synced_time_vector, behavior_time_vector)
+        trial_diagnostics.append(this_trial)
 
-        synced_iteration_vector =\
-            fix_iter_vector(iter_start_idx[i],synced_time_vector, iter_times_idx[i], nidq_sampling_rate)
-        
+    return trial_diagnostics
+
+
+def fix_sync_trial(iter_start_idx_trial, iter_times_idx_trial, behavior_time_vector, nidq_sampling_rate, vectorized=True):
+    # Fix iteration vector of a single trial (main_ephys_fix_sync_code per trial step, top level to run in a process pool)
+
+    if vectorized:
+        synced_time_vector, shift_vec, median_vec = get_shift_vector_vectorized(iter_times_idx_trial,behavior_time_vector)
+    else:
+        synced_time_vector, shift_vec, median_vec = get_shift_vector(iter_times_idx_trial,behavior_time_vector)
+
+    synced_time_vector,_ =\
+        fix_shifted_sync_vector(synced_time_vector, behavior_time_vector, shift_vec)
+
+    #synced_time_vector, trial_stats_dict['borrow_step3'] =\
+    #    fix_sync_vector_greater(synced_time_vector, behavior_time_vector)
+    synced_time_vector,_ =\
+        complete_last_part_sync_vec(synced_time_vector, behavior_time_vector)
+
+    synced_iteration_vector =\
+        fix_iter_vector(iter_start_idx_trial,synced_time_vector, iter_times_idx_trial, nidq_sampling_rate)
+
+    return synced_iteration_vector, synced_time_vector
+
+
+def main_ephys_fix_sync_code(iter_start_idx, iter_times_idx, behavior_time, nidq_sampling_rate, processes=1, vectorized=True):
+    # processes > 1: trials are fixed in parallel in a process pool
+    # vectorized = False: use the loop version of get_shift_vector
+
+    iteration_dict = dict()
+    iteration_dict['iter_start_idx']  = list()
+    iteration_dict['iter_times_idx']  = list()
+
+    trial_args = [(iter_start_idx[i], iter_times_idx[i], behavior_time[i].flatten(), nidq_sampling_rate, vectorized)
+                  for i in range(len(iter_start_idx))]
+
+    if processes > 1 and len(trial_args) > 1:
+        ctx = multiprocessing.get_context('spawn')
+        with ctx.Pool(processes=processes) as pool:
+            trial_results = pool.starmap(fix_sync_trial, trial_args, chunksize=max(1, len(trial_args)//(4*processes)))
+    else:
+        trial_results = [fix_sync_trial(*this_args) for this_args in trial_args]
 
+    for synced_iteration_vector, synced_time_vector in trial_results:
         iteration_dict['iter_start_idx'].append(synced_iteration_vector.copy())
         iteration_dict['iter_times_idx'].append(synced_time_vector.copy())
 
@@ -0,0 +1,436 @@
+"""
+Offline benchmark for the ephys behavior sync path (BehaviorSync.make).
+
+Generates synthetic SpikeGLX nidq .bin/.meta pairs (trial & iteration pulses on digital lines 1 & 2)
+together with the matching behavior `trial_time` arrays, runs every stage of the sync pipeline on them,
+and reports time, peak memory and correctness (against the injected pulses) for each stage as JSON.
+No database or rig recording needed.
+
+Example:
+    python -m u19_pipeline.utils.ephys_sync_benchmark --duration 600 --mode pulse_signal --missing-pulses 2 --output bench.json
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import pathlib
+import platform
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+import warnings
+
+import numpy as np
+
+import u19_pipeline.utils.ephys_fix_sync_code as efsc
+import u19_pipeline.utils.ephys_utils as ephys_utils
+
+# Digital lines used by the rig: 0 = NPX sync, 1 = trial start pulse, 2 = iteration pulse (or bit0 counter)
+SYNC_LINE = 0
+TRIAL_LINE = 1
+ITERATION_LINE = 2
+
+TRIAL_PULSE_MS = 5
+ITERATION_PULSE_MS = 1
+
+# Counter bit0 readers in ephys_utils search iteration edges from this many ms after the trial pulse
+COUNTER_BIT0_WINDOW_MS = 1
+
+WRITE_CHUNK_SAMPLES = 4000000
+
+
+def make_synthetic_behavior(duration, iteration_period=1/60, iterations_per_trial=(80, 200),
+                            iteration_jitter=0.002, inter_trial_interval=0.5, seed=0):
+    """
+    Generate fake behavior trial_time arrays (as fetched from behavior.TowersBlock.Trial) filling `duration` seconds
+    Returns:
+        behavior_time (np.array of objects): one [n_iterations x 1] array per trial with iteration times (s) from trial start
+    """
+
+    rng = np.random.default_rng(seed)
+
+    behavior_time = []
+    total_time = 0
+    while True:
+        n_iterations = int(rng.integers(iterations_per_trial[0], iterations_per_trial[1]+1))
+        periods = iteration_period + rng.uniform(-iteration_jitter, iteration_jitter, n_iterations-1)
+        trial_time = np.concatenate(([0], np.cumsum(periods)))
+        trial_length = trial_time[-1] + iteration_period + inter_trial_interval
+        if total_time + trial_length > duration and len(behavior_time) > 0:
+            break
+        behavior_time.append(trial_time[:, np.newaxis])
+        total_time += trial_length
+
+    behavior_time_obj = np.empty(len(behavior_time), dtype=object)
+    for i, trial_time in enumerate(behavior_time):
+        behavior_time_obj[i] = trial_time
+
+    return behavior_time_obj
+
+
+def get_pulse_line(pulse_start_samples, pulse_samples, num_samples):
+    """
+    Digital line (uint8) that is 1 for pulse_samples samples after each pulse start
+    """
+    pulse_edges = np.zeros(num_samples+1, dtype=np.int64)
+    np.add.at(pulse_edges, pulse_start_samples, 1)
+    np.add.at(pulse_edges, np.minimum(pulse_start_samples + pulse_samples, num_samples), -1)
+    return (np.cumsum(pulse_edges[:-1]) > 0).astype(np.uint8)
+
+
+def make_synthetic_nidq(directory, behavior_time, nidq_sampling_rate=25000.0, mode='pulse_signal',
+                        iteration_period=1/60, inter_trial_interval=0.5, lead_time=1.0, tail_time=1.0,
+                        missing_pulses=0, trial_glitches=0, iteration_glitches=0, n_analog=8,
+                        file_stem='synthetic_g0_t0', seed=0):
+    """
+    Write a synthetic SpikeGLX nidq .bin/.meta pair with trial & iteration pulses matching behavior_time
+    Args:
+        mode (str): 'pulse_signal' (one pulse per iteration) or 'counter_bit0' (iteration line is bit0 of iteration # in trial)
+        missing_pulses (int): # of iteration pulses removed at random (never the first one of a trial)
+        trial_glitches (int): # of single sample pulses injected on the trial line
+        iteration_glitches (int): # of single sample pulses injected on the iteration line (pulse_signal mode only)
+    Returns:
+        bin_path (pathlib.Path): path of the .bin file
+        truth (dict): 'trial_start_idx' and 'iter_start_idx' (np.array of objects) of the real pulses,
+                      'line_iter_start_idx' iteration starts as read from the iteration line (get_line_truth),
+                      'missing_pulses' [(trial, iteration)] removed from the file, 'num_samples' of the file
+    """
+
+    rng = np.random.default_rng(seed)
+
+    # Sample of each iteration start
+    trial_start_idx = []
+    iter_start_idx = []
+    trial_start = int(lead_time*nidq_sampling_rate)
+    for trial_time in behavior_time:
+        trial_time = trial_time.flatten()
+        trial_start_idx.append(trial_start)
+        iter_start_idx.append(trial_start + np.round(trial_time*nidq_sampling_rate).astype(np.int64))
+        trial_start = trial_start + int((trial_time[-1] + iteration_period + inter_trial_interval)*nidq_sampling_rate)
+    num_samples = trial_start + int(tail_time*nidq_sampling_rate)
+
+    # Remove some iteration pulses (not first iteration of a trial, that one is aligned with trial pulse)
+    missing = []
+    candidates = [(i, j) for i in range(len(iter_start_idx)) for j in range(1, iter_start_idx[i].shape[0])]
+    for c in rng.choice(len(candidates), size=min(missing_pulses, len(candidates)), replace=False):
+        missing.append(candidates[c])
+    missing_set = set(missing)
+
+    trial_pulse_samples = int(nidq_sampling_rate*TRIAL_PULSE_MS/1000)
+    iteration_pulse_samples = max(1, int(nidq_sampling_rate*ITERATION_PULSE_MS/1000))
+
+    keep_pulses = [np.array([(i, j) not in missing_set for j in range(x.shape[0])]) for i, x in enumerate(iter_start_idx)]
+    iteration_samples = np.concatenate([x[keep] for x, keep in zip(iter_start_idx, keep_pulses, strict=True)])
+
+    trial_line = get_pulse_line(np.array(trial_start_idx), trial_pulse_samples, num_samples)
+    if mode == 'pulse_signal':
+        iteration_line = get_pulse_line(iteration_samples, iteration_pulse_samples, num_samples)
+    else:
+        # Line is bit0 of the iteration # in trial (first iteration = 1), held until next iteration
+        iteration_bit0 = np.concatenate([(np.arange(1, x.shape[0]+1) % 2)[keep] for x, keep in zip(iter_start_idx, keep_pulses, strict=True)])
+        hold_samples = np.diff(np.append(iteration_samples, num_samples))
+        iteration_line = np.concatenate((np.zeros(iteration_samples[0], dtype=np.uint8),
+                                         np.repeat(iteration_bit0.astype(np.uint8), hold_samples)))
+
+    # Single sample glitches, away from real pulses
+    for line, num_glitches in [(trial_line, trial_glitches), (iteration_line, iteration_glitches if mode == 'pulse_signal' else 0)]:
+        glitch_samples = rng.integers(trial_start_idx[0], num_samples-1, size=num_glitches)
+        for sample in glitch_samples:
+            if line[sample-1] == 0 and line[sample+1] == 0:
+                line[sample] = 1
+
+    # NPX sync line, 1Hz square wave
+    sync_line = ((np.arange(num_samples) // int(nidq_sampling_rate/2)) % 2).astype(np.uint16)
+
+    digital_word = (sync_line << SYNC_LINE) | (trial_line.astype(np.uint16) << TRIAL_LINE) | \
+                   (iteration_line.astype(np.uint16) << ITERATION_LINE)
+    del trial_line, iteration_line, sync_line
+
+    # Write interleaved int16 file: n_analog channels (noise) + 1 digital word, by chunks
+    directory = pathlib.Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    bin_path = pathlib.Path(directory, file_stem + '.nidq.bin')
+    n_chan = n_analog + 1
+    with open(bin_path, 'wb') as f:
+        for chunk_start in range(0, num_samples, WRITE_CHUNK_SAMPLES):
+            chunk_end = min(chunk_start + WRITE_CHUNK_SAMPLES, num_samples)
+            chunk = np.empty((chunk_end - chunk_start, n_chan), dtype=np.int16)
+            chunk[:, :n_analog] = rng.integers(-500, 500, size=(chunk_end - chunk_start, n_analog), dtype=np.int16)
+            chunk[:, n_analog] = digital_word[chunk_start:chunk_end].view(np.int16)
+            chunk.tofile(f)
+
+    meta = dict()
+    meta['typeThis'] = 'nidq'
+    meta['niSampRate'] = nidq_sampling_rate
+    meta['nSavedChans'] = n_chan
+    meta['fileSizeBytes'] = 2*n_chan*num_samples
+    meta['fileTimeSecs'] = num_samples/nidq_sampling_rate
+    meta['snsMnMaXaDw'] = '0,0,' + str(n_analog) + ',1'
+    meta['snsSaveChanSubset'] = 'all'
+    meta['niXDChans1'] = '0:7'
+    meta['niMaxInt'] = 32768
+    meta['niAiRangeMax'] = 5
+    with open(bin_path.with_suffix('.meta'), 'w') as f:
+        f.write('\n'.join(key + '=' + str(value) for key, value in meta.items()) + '\n')
+
+    truth = dict()
+    truth['trial_start_idx'] = np.array(trial_start_idx, dtype=np.int64)
+    truth['iter_start_idx'] = np.asarray(iter_start_idx, dtype=object)
+    truth['line_iter_start_idx'] = get_line_truth(iter_start_idx, nidq_sampling_rate, mode)
+    truth['missing_pulses'] = [(int(i), int(j)) for i, j in missing]
+    truth['num_samples'] = num_samples
+
+    return bin_path, truth
+
+
+def get_line_truth(iter_start_idx, nidq_sampling_rate, mode):
+    """
+    Iteration start samples as the pipeline reads them from the iteration line.
+    pulse_signal: the real iteration starts.
+    counter_bit0: the counter readers (get_idx_iter_start_counterbit(_edges)) report edges as the sample before the
+    line changes (np.diff index) and relative to a window starting COUNTER_BIT0_WINDOW_MS after the trial pulse,
+    first iteration is the trial pulse (also the sample before the rise).
+    Returns:
+        line_iter_start_idx (np.array of objects): one array of iteration start samples per trial
+    """
+
+    if mode != 'counter_bit0':
+        return np.asarray(iter_start_idx, dtype=object)
+
+    window_samples = int(nidq_sampling_rate*(COUNTER_BIT0_WINDOW_MS/1000))
+    line_iter_start_idx = []
+    for trial_iter_start_idx in iter_start_idx:
+        trial_line_idx = trial_iter_start_idx - 1
+        trial_line_idx[1:] -= window_samples
+        line_iter_start_idx.append(trial_line_idx)
+
+    return np.asarray(line_iter_start_idx, dtype=object)
+
+
+def evaluate_iteration_vector(iter_start_idx, truth, tolerance_samples=2, truth_field='line_iter_start_idx'):
+    """
+    Compare synced iteration start samples with the real (injected) ones
+    Args:
+        truth_field (str): 'line_iter_start_idx' for stages reading the iteration line, 'iter_start_idx' for
+                           stages built from behavior times
+    Returns:
+        metrics (dict): # trials found/expected, # trials with right iteration count, # trials where every
+                        iteration start is within tolerance_samples, max abs error on trials with right count
+    """
+
+    true_iter_start_idx = truth[truth_field]
+
+    trials_count_ok = 0
+    trials_exact = 0
+    max_error = 0
+    for i in range(min(len(iter_start_idx), len(true_iter_start_idx))):
+        this_iter = np.asarray(iter_start_idx[i]).flatten()
+        if this_iter.shape[0] != true_iter_start_idx[i].shape[0]:
+            continue
+        trials_count_ok += 1
+        error = int(np.max(np.abs(this_iter.astype(np.int64) - true_iter_start_idx[i])))
+        max_error = max(max_error, error)
+        if error <= tolerance_samples:
+            trials_exact += 1
+
+    metrics = dict()
+    metrics['trials_found'] = int(len(iter_start_idx))
+    metrics['trials_expected'] = int(len(true_iter_start_idx))
+    metrics['trials_count_ok'] = trials_count_ok
+    metrics['trials_within_tolerance'] = trials_exact
+    metrics['max_error_samples'] = max_error
+
+    return metrics
+
+
+def measure_stage(stage_name, func, results, trace_memory=False, verbose=False):
+    """
+    Run func() recording wall time (and tracemalloc peak if trace_memory) in results[stage_name]
+    """
+
+    if trace_memory:
+        tracemalloc.start()
+
+    stdout = sys.stdout if verbose else io.StringIO()
+    start_time = time.perf_counter()
+    with contextlib.redirect_stdout(stdout), warnings.catch_warnings():
+        if not verbose:
+            warnings.simplefilter('ignore')
+        output = func()
+    elapsed_time = time.perf_counter() - start_time
+
+    stage = results.setdefault(stage_name, dict(times=[]))
+    stage['times'].append(elapsed_time)
+    if trace_memory:
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        stage['peak_memory_mb'] = peak / 1024**2
+
+    return output
+
+
+def run_sync_pipeline(bin_path, behavior_time, truth, results, trace_memory=False, dense=True, verbose=False):
+    """
+    Run BehaviorSync.make stages (recent recording path) on a synthetic file.
+    If dense, also run the legacy full length signal path (get_iteration_sample_vector_from_digital_lines_pulses)
+    Returns:
+        correctness (dict): evaluate_iteration_vector metrics per stage output
+    """
+
+    def measure(stage_name, func):
+        return measure_stage(stage_name, func, results, trace_memory, verbose)
+
+    num_trials = behavior_time.shape[0]
+    correctness = dict()
+
+    nidq_meta, nidq_sampling_rate = measure('read_meta', lambda: ephys_utils.read_nidq_meta_samp_rate(bin_path))
+
+    edge_table, trial_line, iteration_line = measure(
+        'load_edges', lambda: ephys_utils.load_trial_iteration_edges(bin_path, nidq_meta))
+
+    iteration_dict = measure('iteration_vector_edges', lambda: ephys_utils.get_iteration_sample_vector_from_edge_table(
+        edge_table, trial_line, iteration_line, nidq_sampling_rate, num_trials, behavior_time))
+    correctness['iteration_vector_edges'] = evaluate_iteration_vector(iteration_dict['iter_start_idx'], truth)
+
+    if dense:
+        trial_pulse_signal, iteration_pulse_signal = measure(
+            'load_signals_dense', lambda: ephys_utils.load_trial_iteration_signals(bin_path, nidq_meta))
+        iteration_dict_dense = measure('iteration_vector_dense', lambda: ephys_utils.get_iteration_sample_vector_from_digital_lines_pulses(
+            trial_pulse_signal, iteration_pulse_signal, nidq_sampling_rate, num_trials, behavior_time))
+        correctness['iteration_vector_dense'] = evaluate_iteration_vector(iteration_dict_dense['iter_start_idx'], truth)
+        del trial_pulse_signal, iteration_pulse_signal
+
+    def evaluate_sync():
+        trial_count_diff, trials_diff_iteration_big, trials_diff_iteration_small = \
+            ephys_utils.assert_iteration_samples_count(iteration_dict['iter_start_idx'], behavior_time)
+        return ephys_utils.evaluate_sync_process(trial_count_diff, trials_diff_iteration_big, trials_diff_iteration_small, num_trials)
+    status = measure('evaluate_sync', evaluate_sync)
+    correctness['regular_sync_status'] = int(status == 1)
+
+    # Fix stage always runs, so its cost is measured even if regular sync succeeded
+    status_fix, fixed_iteration_dict = measure('fix_sync', lambda: efsc.main_ephys_fix_sync_code(
+        iteration_dict['iter_start_idx'], iteration_dict['iter_times_idx'], behavior_time, nidq_sampling_rate))
+    correctness['fixed_sync_status'] = int(status_fix)
+    correctness['fix_sync'] = evaluate_iteration_vector(fixed_iteration_dict['iter_start_idx'], truth)
+
+    _, iter_start_idx_virmen = measure('virmen_vectors', lambda: ephys_utils.get_iteration_intertrial_from_virmen_time_edges(
+        edge_table, trial_line, nidq_sampling_rate, num_trials, behavior_time))
+    correctness['virmen_vectors'] = evaluate_iteration_vector(iter_start_idx_virmen, truth, truth_field='iter_start_idx')
+
+    measure('materialize_vectors', lambda: ephys_utils.BehaviorSyncSampleMap(
+        iteration_dict['iter_start_idx'], nidq_sampling_rate, edge_table.num_samples).materialize())
+
+    return correctness
+
+
+def assert_clean_correctness(correctness):
+    """
+    On a file without missing pulses or glitches every stage has to sync all trials within tolerance
+    """
+
+    for stage_name, metrics in correctness.items():
+        if isinstance(metrics, dict):
+            assert metrics['trials_within_tolerance'] == metrics['trials_expected'], \
+                f'{stage_name}: {metrics["trials_within_tolerance"]} of {metrics["trials_expected"]} trials within tolerance on clean data'
+        else:
+            assert metrics == 1, f'{stage_name}: sync status {metrics} on clean data'
+
+
+def run_benchmark(duration=600, nidq_sampling_rate=25000.0, mode='pulse_signal', missing_pulses=0,
+                  trial_glitches=0, iteration_glitches=0, repeats=3, profile_memory=True, dense=True,
+                  directory=None, seed=0, verbose=False):
+    """
+    Generate a synthetic recording and benchmark the sync pipeline on it.
+    Clean files (no missing pulses or glitches) must be synced perfectly by every stage (assert_clean_correctness)
+    Returns:
+        benchmark (dict): 'config', 'file' (geometry of synthetic file), 'stages' (time min/median & peak memory per stage),
+                          'correctness' (per stage metrics), 'max_rss_mb'
+    """
+
+    config = dict(duration=duration, nidq_sampling_rate=nidq_sampling_rate, mode=mode, missing_pulses=missing_pulses,
+                  trial_glitches=trial_glitches, iteration_glitches=iteration_glitches, repeats=repeats,
+                  profile_memory=profile_memory, dense=dense, seed=seed)
+
+    with tempfile.TemporaryDirectory(dir=directory) as tmp_directory:
+
+        behavior_time = make_synthetic_behavior(duration, seed=seed)
+        start_time = time.perf_counter()
+        bin_path, truth = make_synthetic_nidq(tmp_directory, behavior_time, nidq_sampling_rate, mode=mode,
+                                              missing_pulses=missing_pulses, trial_glitches=trial_glitches,
+                                              iteration_glitches=iteration_glitches, seed=seed)
+        generation_time = time.perf_counter() - start_time
+
+        results = dict()
+        for _ in range(repeats):
+            correctness = run_sync_pipeline(bin_path, behavior_time, truth, results, dense=dense, verbose=verbose)
+
+        # Memory is traced in a separate run, tracemalloc slows down numpy heavy code
+        if profile_memory:
+            memory_results = dict()
+            run_sync_pipeline(bin_path, behavior_time, truth, memory_results, trace_memory=True, dense=dense, verbose=verbose)
+
+        file_info = dict(num_samples=int(truth['num_samples']), num_trials=int(behavior_time.shape[0]),
+                         num_iterations=int(sum(x.shape[0] for x in behavior_time)),
+                         file_size_mb=bin_path.stat().st_size/1024**2, generation_time=generation_time)
+
+    if missing_pulses == 0 and trial_glitches == 0 and (iteration_glitches == 0 or mode == 'counter_bit0'):
+        assert_clean_correctness(correctness)
+
+    stages = dict()
+    for stage_name, stage in results.items():
+        stages[stage_name] = dict(time_min=float(np.min(stage['times'])), time_median=float(np.median(stage['times'])))
+        if profile_memory:
+            stages[stage_name]['peak_memory_mb'] = memory_results[stage_name]['peak_memory_mb']
+
+    benchmark = dict()
+    benchmark['config'] = config
+    benchmark['file'] = file_info
+    benchmark['stages'] = stages
+    benchmark['correctness'] = correctness
+    benchmark['max_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024
+    benchmark['python'] = platform.python_version()
+    benchmark['numpy'] = np.__version__
+
+    return benchmark
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark ephys behavior sync on synthetic SpikeGLX nidq files')
+    parser.add_argument('--duration', type=float, nargs='+', default=[600], help='recording duration(s) in seconds')
+    parser.add_argument('--sampling-rate', type=float, default=25000.0, help='nidq sampling rate')
+    parser.add_argument('--mode', choices=['pulse_signal', 'counter_bit0'], nargs='+', default=['pulse_signal'])
+    parser.add_argument('--missing-pulses', type=int, default=0, help='# of iteration pulses removed')
+    parser.add_argument('--trial-glitches', type=int, default=0, help='# of single sample glitches on trial line')
+    parser.add_argument('--iteration-glitches', type=int, default=0, help='# of single sample glitches on iteration line')
+    parser.add_argument('--repeats', type=int, default=3, help='timing repetitions per configuration')
+    parser.add_argument('--no-memory', action='store_true', help='skip tracemalloc memory profiling run')
+    parser.add_argument('--no-dense', action='store_true', help='skip legacy full length signal stages')
+    parser.add_argument('--directory', default=None, help='where synthetic files are written (default system temp)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=None, help='JSON output file (default stdout)')
+    parser.add_argument('--verbose', action='store_true', help='show pipeline prints')
+    args = parser.parse_args()
+
+    all_benchmarks = []
+    for duration in args.duration:
+        for mode in args.mode:
+            all_benchmarks.append(run_benchmark(
+                duration=duration, nidq_sampling_rate=args.sampling_rate, mode=mode,
+                missing_pulses=args.missing_pulses, trial_glitches=args.trial_glitches,
+                iteration_glitches=args.iteration_glitches, repeats=args.repeats,
+                profile_memory=not args.no_memory, dense=not args.no_dense,
+                directory=args.directory, seed=args.seed, verbose=args.verbose))
+
+    output = json.dumps(all_benchmarks, indent=2)
+    if args.output is None:
+        print(output)
+    else:
+        with open(args.output, 'w') as f:
+            f.write(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -9,22 +9,22 @@ from scipy import signal as sp
 from scipy.io import loadmat
 from scipy.spatial.transform import Rotation as R
 
-from bitstring import BitArray
 from element_array_ephys import ephys as ephys_element
 
 import u19_pipeline.utils.DemoReadSGLXData.readSGLX as readSGLX
+import u19_pipeline.utils.spikeglx_meta_cache as spikeglx_meta_cache
+
+# Samples of the digital word read from the memmap at a time (~8MB of int16 per window)
+DIGITAL_CHUNK_SAMPLES = 4000000
+
+# Trial start pulses are 5ms long, shorter pulses are glitches
+TRIAL_PULSE_MIN_WIDTH_MS = 1
 
 
 class spice_glx_utility:
 
     @staticmethod
-    def load_spice_glx_digital_file(file_path, nidq_meta, d_line_list=None):
-        # Read NIDAQ digital file.
-        # Inputs
-        # file_path   = path for the spike glx file
-        # nidq_meta   = meta file read from readMeta spike glx utility
-        # d_line_list = digital channels to read from the file
-
+    def get_digital_line_list(nidq_meta, d_line_list=None):
         # Get all digitial channels if not provided
         if d_line_list is None:
             list_start_end_chan = nidq_meta['niXDChans1'].split(sep=':')
@@ -34,15 +34,52 @@ class spice_glx_utility:
             else:
                 raise ValueError('Could not infer channel list from nidq_meta["niXDChans1"] ')
 
-        nidq_sampling_rate = readSGLX.SampRate(nidq_meta)
+        return d_line_list
 
+    @staticmethod
+    def get_file_sample_range(nidq_meta):
         #Get first and last sample idx from the file
+        nidq_sampling_rate = readSGLX.SampRate(nidq_meta)
         t_start = 0
         t_end = np.float64(nidq_meta['fileTimeSecs'])
-        dw = 0
         first_sample_index = int(nidq_sampling_rate * t_start)
         last_sample_index = int(nidq_sampling_rate * t_end) - 1
 
+        return first_sample_index, last_sample_index
+
+    @staticmethod
+    def get_digital_word_channel(nidq_meta, dw=0):
+        # Get saved channel index of digital word dw (same lookup as readSGLX.ExtractDigital)
+        if nidq_meta['typeThis'] == 'imec':
+            AP, LF, SY = readSGLX.ChannelCountsIM(nidq_meta)
+            if SY == 0:
+                raise ValueError('No imec sync channel saved')
+            return AP + LF + dw
+        elif nidq_meta['typeThis'] == 'nidq':
+            MN, MA, XA, DW = readSGLX.ChannelCountsNI(nidq_meta)
+            if dw > DW-1:
+                raise ValueError('Maximum digital word in file = ' + str(DW-1))
+            return MN + MA + XA + dw
+        elif nidq_meta['typeThis'] == 'obx':
+            XA, DW, SY = readSGLX.ChannelCountsOBX(nidq_meta)
+            if dw > DW-1:
+                raise ValueError('Maximum digital word in file = ' + str(DW-1))
+            return XA + dw
+        else:
+            raise ValueError('Unknown data stream: ' + nidq_meta['typeThis'])
+
+    @staticmethod
+    def load_spice_glx_digital_file(file_path, nidq_meta, d_line_list=None):
+        # Read NIDAQ digital file.
+        # Inputs
+        # file_path   = path for the spike glx file
+        # nidq_meta   = meta file read from readMeta spike glx utility
+        # d_line_list = digital channels to read from the file
+
+        d_line_list = spice_glx_utility.get_digital_line_list(nidq_meta, d_line_list)
+        first_sample_index, last_sample_index = spice_glx_utility.get_file_sample_range(nidq_meta)
+        dw = 0
+
         #Read binary and digital
         nidq_raw_data = readSGLX.makeMemMapRaw(file_path, nidq_meta)  # Pull raw bin data
         digital_array = readSGLX.ExtractDigital(                               # extract interation index
@@ -50,13 +87,145 @@ class spice_glx_utility:
             dw, d_line_list, nidq_meta)
 
         return digital_array
-    
+
+    @staticmethod
+    def iter_spice_glx_digital_chunks(file_path, nidq_meta, d_line_list=None, chunk_samples=DIGITAL_CHUNK_SAMPLES):
+        # Walk the digital word of a spike glx file in fixed-size windows.
+        # Only the requested bits are masked out of each window, the 16 x nSamp unpacked matrix is never built.
+        # Yields
+        # chunk_start   = first sample index of the window
+        # digital_chunk = [lines x window samples] uint8 array, same values as readSGLX.ExtractDigital
+
+        d_line_list = spice_glx_utility.get_digital_line_list(nidq_meta, d_line_list)
+        first_sample_index, last_sample_index = spice_glx_utility.get_file_sample_range(nidq_meta)
+        digital_channel = spice_glx_utility.get_digital_word_channel(nidq_meta, dw=0)
+
+        nidq_raw_data = readSGLX.makeMemMapRaw(file_path, nidq_meta)
+
+        for chunk_start in range(first_sample_index, last_sample_index+1, chunk_samples):
+            chunk_end = min(chunk_start+chunk_samples, last_sample_index+1)
+            word_chunk = np.ascontiguousarray(nidq_raw_data[digital_channel, chunk_start:chunk_end]).view(np.uint16)
+
+            digital_chunk = np.empty((len(d_line_list), word_chunk.shape[0]), dtype=np.uint8)
+            for i, d_line in enumerate(d_line_list):
+                digital_chunk[i, :] = (word_chunk >> d_line) & 1
+
+            yield chunk_start, digital_chunk
+
+    @staticmethod
+    def load_spice_glx_digital_file_chunked(file_path, nidq_meta, d_line_list=None, chunk_samples=DIGITAL_CHUNK_SAMPLES):
+        # Read NIDAQ digital file window by window into a preallocated [lines x samples] uint8 array.
+        # Output is identical to load_spice_glx_digital_file, but peak memory is the output plus one window.
+
+        d_line_list = spice_glx_utility.get_digital_line_list(nidq_meta, d_line_list)
+        first_sample_index, last_sample_index = spice_glx_utility.get_file_sample_range(nidq_meta)
+
+        digital_array = np.zeros((len(d_line_list), last_sample_index-first_sample_index+1), dtype=np.uint8)
+        for chunk_start, digital_chunk in spice_glx_utility.iter_spice_glx_digital_chunks(
+                file_path, nidq_meta, d_line_list, chunk_samples):
+            idx_start = chunk_start - first_sample_index
+            digital_array[:, idx_start:idx_start+digital_chunk.shape[1]] = digital_chunk
+
+        return digital_array
+
+
+class DigitalEdgeTable:
+    '''
+    Compact representation of SpikeGLX digital lines: sorted int64 sample indices of rising and falling edges per line.
+    Edges follow np.diff convention on the dense signal:
+      rise at i -> signal[i] == 0 and signal[i+1] == 1
+      fall at i -> signal[i] == 1 and signal[i+1] == 0
+    '''
+
+    def __init__(self, rise, fall, initial_level, num_samples):
+        self.rise = rise                    # dict line -> int64 array of rising edge indices
+        self.fall = fall                    # dict line -> int64 array of falling edge indices
+        self.initial_level = initial_level  # dict line -> value of the line at first sample
+        self.num_samples = num_samples
+
+    @classmethod
+    def from_digital_array(cls, digital_array, d_line_list):
+        # Build edge table from a dense [lines x samples] digital array
+        rise = dict()
+        fall = dict()
+        initial_level = dict()
+        for i, d_line in enumerate(d_line_list):
+            diff_line = np.diff(digital_array[i].astype(np.int8))
+            rise[d_line] = np.flatnonzero(diff_line == 1).astype(np.int64)
+            fall[d_line] = np.flatnonzero(diff_line == -1).astype(np.int64)
+            initial_level[d_line] = int(digital_array[i, 0]) if digital_array.shape[1] > 0 else 0
+
+        return cls(rise, fall, initial_level, digital_array.shape[1])
+
+    @classmethod
+    def from_spice_glx_file(cls, file_path, nidq_meta, d_line_list=None, chunk_samples=DIGITAL_CHUNK_SAMPLES):
+        # Build edge table in a single streaming pass over the spike glx memmap
+        d_line_list = spice_glx_utility.get_digital_line_list(nidq_meta, d_line_list)
+
+        rise_chunks = [[] for _ in d_line_list]
+        fall_chunks = [[] for _ in d_line_list]
+        initial_level = dict()
+        last_value = None
+        num_samples = 0
+        for chunk_start, digital_chunk in spice_glx_utility.iter_spice_glx_digital_chunks(
+                file_path, nidq_meta, d_line_list, chunk_samples):
+
+            if last_value is None:
+                initial_level = {d_line: int(digital_chunk[i, 0]) for i, d_line in enumerate(d_line_list)}
+                diff_chunk = np.diff(digital_chunk.astype(np.int8), axis=1)
+                offset = chunk_start
+            else:
+                # Prepend last sample of previous window so edges across windows are not lost
+                diff_chunk = np.diff(np.hstack([last_value, digital_chunk]).astype(np.int8), axis=1)
+                offset = chunk_start - 1
+
+            for i in range(len(d_line_list)):
+                rise_chunks[i].append(np.flatnonzero(diff_chunk[i] == 1) + offset)
+                fall_chunks[i].append(np.flatnonzero(diff_chunk[i] == -1) + offset)
+
+            last_value = digital_chunk[:, -1:]
+            num_samples += digital_chunk.shape[1]
+
+        rise = dict()
+        fall = dict()
+        for i, d_line in enumerate(d_line_list):
+            rise[d_line] = np.concatenate(rise_chunks[i]).astype(np.int64) if rise_chunks[i] else np.empty(0, dtype=np.int64)
+            fall[d_line] = np.concatenate(fall_chunks[i]).astype(np.int64) if fall_chunks[i] else np.empty(0, dtype=np.int64)
+            initial_level.setdefault(d_line, 0)
+
+        return cls(rise, fall, initial_level, num_samples)
+
+    def get_edges(self, d_line, edge_type, idx_start=0, idx_end=None):
+        # Edges np.diff would find on signal[idx_start:idx_end] (absolute sample indices, idx_start <= e <= idx_end-2)
+        edges = self.rise[d_line] if edge_type == 'rise' else self.fall[d_line]
+        if idx_end is None:
+            idx_end = self.num_samples
+        idx_start = max(idx_start, 0)
+        idx_end = min(idx_end, self.num_samples)
+
+        first = np.searchsorted(edges, idx_start, side='left')
+        last = np.searchsorted(edges, idx_end-1, side='left')
+        return edges[first:max(first, last)].copy()
+
+    def count_edges(self, d_line, edge_type, idx_start=0, idx_end=None):
+        return self.get_edges(d_line, edge_type, idx_start, idx_end).shape[0]
+
+    def level_at(self, d_line, sample):
+        # Value of the digital line at a given sample (last edge before the sample defines it)
+        idx_rise = np.searchsorted(self.rise[d_line], sample, side='left')
+        idx_fall = np.searchsorted(self.fall[d_line], sample, side='left')
+        if idx_rise == 0 and idx_fall == 0:
+            return self.initial_level[d_line]
+        last_rise = self.rise[d_line][idx_rise-1] if idx_rise > 0 else -1
+        last_fall = self.fall[d_line][idx_fall-1] if idx_fall > 0 else -1
+        return 1 if last_rise > last_fall else 0
+
 
 def read_nidq_meta_samp_rate(ephys_session_fullpath):
 
-    #Nidaq file
-    nidq_meta          = readSGLX.readMeta(ephys_session_fullpath)
-    nidq_sampling_rate = readSGLX.SampRate(nidq_meta)
+    #Nidaq file (parsed meta and sampling rate come from the meta index)
+    nidq_meta, geometry = spikeglx_meta_cache.read_meta_geometry(ephys_session_fullpath)
+    nidq_sampling_rate = geometry['sampling_rate']
 
     return nidq_meta, nidq_sampling_rate
 
@@ -67,10 +236,10 @@ def load_trial_iteration_signals(ephys_session_fullpath, nidq_meta):
     new_iteration_channel = 2
     # If PXIe card (nidq) card use for recording deduce digital channels
     if nidq_meta['typeThis'] == 'nidq':
-        digital_array      = spice_glx_utility.load_spice_glx_digital_file(ephys_session_fullpath, nidq_meta)
+        digital_array      = spice_glx_utility.load_spice_glx_digital_file_chunked(ephys_session_fullpath, nidq_meta)
     # If onebox card (obx) card use for recording digital channels are 0-2
     else:
-        digital_array      = spice_glx_utility.load_spice_glx_digital_file(ephys_session_fullpath, nidq_meta, d_line_list=[0,1])
+        digital_array      = spice_glx_utility.load_spice_glx_digital_file_chunked(ephys_session_fullpath, nidq_meta, d_line_list=[0,1])
         # If no sync pulse found trial and iteration signals are 0 & 1 respectively
         channel0_pulses = np.where(np.diff(digital_array[0])==1)[0].shape[0]
         channel1_pulses = np.where(np.diff(digital_array[1])==1)[0].shape[0]
@@ -85,29 +254,72 @@ def load_trial_iteration_signals(ephys_session_fullpath, nidq_meta):
     return digital_array[new_trial_channel,:], digital_array[new_iteration_channel,:]
 
 
-def get_idx_trial_start(trial_pulse_signal):
+def load_trial_iteration_edges(ephys_session_fullpath, nidq_meta):
+    # Same as load_trial_iteration_signals but returns an edge table instead of dense signals
+    # Returns edge_table, trial line #, iteration line #
+
+    # If PXIe card (nidq) card use for recording deduce digital channels
+    if nidq_meta['typeThis'] == 'nidq':
+        d_line_list = spice_glx_utility.get_digital_line_list(nidq_meta)
+        trial_line = d_line_list[1]
+        iteration_line = d_line_list[2]
+        edge_table = DigitalEdgeTable.from_spice_glx_file(ephys_session_fullpath, nidq_meta, d_line_list=[trial_line, iteration_line])
+    # If onebox card (obx) card use for recording digital channels are 0-2
+    else:
+        edge_table = DigitalEdgeTable.from_spice_glx_file(ephys_session_fullpath, nidq_meta, d_line_list=[0,1])
+        # If no sync pulse found trial and iteration signals are 0 & 1 respectively
+        channel0_pulses = edge_table.count_edges(0, 'rise')
+        channel1_pulses = edge_table.count_edges(1, 'rise')
+
+        if channel0_pulses > channel1_pulses:
+            trial_line = 1
+            iteration_line = 0
+        else:
+            trial_line = 0
+            iteration_line = 1
+
+    return edge_table, trial_line, iteration_line
+
+
+def get_min_pulse_samples(nidq_sampling_rate=None, min_pulse_width_ms=TRIAL_PULSE_MIN_WIDTH_MS):
+    # Minimum # of samples a trial pulse has to stay high to be considered real
+    # If no sampling rate is given, keep the legacy 9 sample window
+    if nidq_sampling_rate is None:
+        return 9
+
+    return max(1, int(round(nidq_sampling_rate*min_pulse_width_ms/1000)))
+
+
+def classify_trial_start_pulses(trial_start_idx, fall_idx, num_samples, min_pulse_samples):
+    # Pair each rising edge with the falling edge that closes it and reject pulses shorter than min_pulse_samples
+    # Inputs
+    # trial_start_idx   = sorted rising edge indexes of trial signal
+    # fall_idx          = sorted falling edge indexes of trial signal
+    # num_samples       = length of the signal (end of pulses that never fall)
+    # min_pulse_samples = minimum # of samples (after rising edge) the pulse should be high
+
+    idx_next_fall = np.searchsorted(fall_idx, trial_start_idx, side='right')
+    trial_start_pulse_end_idx = np.append(fall_idx, num_samples).astype(np.int64)[idx_next_fall]
+
+    #Detect fake trial init pulses (a single sample in 1 instead of 5ms signal)
+    real_trial_init = (trial_start_pulse_end_idx - trial_start_idx) >= min_pulse_samples
+
+    return trial_start_idx[real_trial_init], trial_start_pulse_end_idx[real_trial_init]
+
+
+def get_idx_trial_start(trial_pulse_signal, nidq_sampling_rate=None, min_pulse_width_ms=TRIAL_PULSE_MIN_WIDTH_MS):
     #Get index of samples when trial has started based on a pulse signal
 
+    diff_trial_pulse_signal = np.diff(trial_pulse_signal.astype(np.int8))
+
     #Get idx samples trial starts
-    trial_start_idx = np.where(np.diff(trial_pulse_signal) == 1)
-    trial_start_idx = trial_start_idx[0]
+    trial_start_idx = np.flatnonzero(diff_trial_pulse_signal == 1)
 
     #Get idx samples trial pulse start end
-    trial_start_pulse_end_idx = np.where(np.diff(trial_pulse_signal) == 255)
-    trial_start_pulse_end_idx = trial_start_pulse_end_idx[0]
-
-    #Detect fake trial init pulses (a single sample in 1 instead of 5ms signal)
-    fake_trial_init = []
-    for idx, sample in enumerate(trial_start_idx):
-        #Get the mean value of next samples after rising edge detected
-        mean_pulse = np.mean(trial_pulse_signal[sample+1:sample+10])
-        # Average value should be 1
-        if mean_pulse < 0.9:
-            fake_trial_init.append(idx)
+    trial_start_pulse_end_idx = np.flatnonzero(diff_trial_pulse_signal == -1)
 
-    trial_start_idx = np.delete(trial_start_idx, fake_trial_init)
-    trial_start_pulse_end_idx = np.delete(trial_start_pulse_end_idx, fake_trial_init)
-    return trial_start_idx, trial_start_pulse_end_idx
+    min_pulse_samples = get_min_pulse_samples(nidq_sampling_rate, min_pulse_width_ms)
+    return classify_trial_start_pulses(trial_start_idx, trial_start_pulse_end_idx, trial_pulse_signal.shape[0], min_pulse_samples)
 
 
 def get_idx_iter_start_pulsesignal(iteration_pulse_signal_trial, iteration_pulse_start_signal,trial_start_idx, samples_before_pulse_start, behavior_iterations):
@@ -182,6 +394,70 @@ def get_trial_signal_mode(iteration_pulse_signal_trial, behavior_time_vector_tri
     return mode
 
 
+def get_idx_trial_start_edges(edge_table, trial_line, nidq_sampling_rate=None, min_pulse_width_ms=TRIAL_PULSE_MIN_WIDTH_MS):
+    #Get index of samples when trial has started based on the trial line edges
+
+    min_pulse_samples = get_min_pulse_samples(nidq_sampling_rate, min_pulse_width_ms)
+    return classify_trial_start_pulses(edge_table.rise[trial_line], edge_table.fall[trial_line], edge_table.num_samples, min_pulse_samples)
+
+
+def get_idx_iter_start_pulsesignal_edges(edge_table, iteration_line, trial_start_idx, idx_start_before, idx_start, idx_end, behavior_iterations):
+    #Get index of iteration starts on a trial based on a pulse start signal (edge table version)
+
+    #Get idx of iteration start during trial (pulse signal after trial start signal)
+    iter_samples = edge_table.get_edges(iteration_line, 'rise', idx_start, idx_end)
+
+    iter_start_samples = edge_table.get_edges(iteration_line, 'rise', idx_start_before, idx_start)
+
+    # If we find some kind of pulse at the start of
+    if iter_start_samples.size > 0:
+        iter_samples = np.insert(iter_samples, 0, trial_start_idx)
+    else:
+        iter_samples[0] = trial_start_idx
+
+    if behavior_iterations < iter_samples.shape[0]:
+        iter_samples = iter_samples[:-1]
+
+    return iter_samples
+
+
+def get_idx_iter_start_counterbit_edges(edge_table, iteration_line, trial_start_idx, idx_start, idx_end):
+    #Get index of iteration starts on a trial based on a iteration bit0 counter (edge table version)
+
+    #Get idx of odd iteration during trial
+    iter_samples = edge_table.get_edges(iteration_line, 'rise', idx_start, idx_end) - idx_start + trial_start_idx
+
+    if edge_table.level_at(iteration_line, idx_start) == 1:
+        #If last iteration was odd, insert a iteration at start
+        iter_samples = np.insert(iter_samples, 0, trial_start_idx)
+    else:
+        # First iteration is at trial start, just align first trial start
+        iter_samples[0] = trial_start_idx
+
+    #Get idx of even iteration during trial
+    iter_samples2 = edge_table.get_edges(iteration_line, 'fall', idx_start, idx_end) - idx_start + trial_start_idx
+
+    iter_samples = np.concatenate([iter_samples, iter_samples2])
+    iter_samples = np.sort(iter_samples)
+
+    return iter_samples
+
+
+def get_trial_signal_mode_edges(edge_table, iteration_line, idx_start, idx_end, behavior_time_vector_trial):
+
+    # If iterations in trial are less than the ones in behavior, the mode was the counterbit
+    num_iter_samples = edge_table.count_edges(iteration_line, 'rise', idx_start, idx_end)
+
+    if num_iter_samples < (behavior_time_vector_trial.shape[0]*3/4):
+        mode = 'counter_bit0'
+    else:
+        mode = 'pulse_signal'
+
+    print('mode deduction: ', mode)
+
+    return mode
+
+
 def get_iteration_sample_vector_from_digital_lines_pulses(trial_pulse_signal, iteration_pulse_signal, nidq_sampling_rate, num_behavior_trials, behavior_time_vector, mode=None) -> dict:
 
     #Output as a dictionary
@@ -192,7 +468,7 @@ def get_iteration_sample_vector_from_digital_lines_pulses(trial_pulse_signal, it
     #iteration_vector_output['trialnumber_vector_samples'] = np.zeros(trial_pulse_signal.shape[0])*np.nan
 
     #Get idx samples trial starts
-    trial_start_idx, trial_end_pulse_idx = get_idx_trial_start(trial_pulse_signal)
+    trial_start_idx, trial_end_pulse_idx = get_idx_trial_start(trial_pulse_signal, nidq_sampling_rate)
 
     print('len trial_start_idx', trial_start_idx.shape)
 
@@ -258,65 +534,233 @@ def get_iteration_sample_vector_from_digital_lines_pulses(trial_pulse_signal, it
     return iteration_vector_output
 
 
-def get_iteration_sample_vector_from_digital_lines_word(digital_array, time, iterstart):
+def get_iteration_sample_vector_from_edge_table(edge_table, trial_line, iteration_line, nidq_sampling_rate, num_behavior_trials, behavior_time_vector, mode=None) -> dict:
+    # Same as get_iteration_sample_vector_from_digital_lines_pulses, but windows are searched in the edge table
+    # instead of slicing full length signals
+
+    #Output as a dictionary
+    iteration_vector_output = dict()
+
+    #Get idx samples trial starts
+    trial_start_idx, trial_end_pulse_idx = get_idx_trial_start_edges(edge_table, trial_line, nidq_sampling_rate)
+
+    print('len trial_start_idx', trial_start_idx.shape)
+
+    if mode is None:
+        mode = get_trial_signal_mode_edges(edge_table, iteration_line, trial_start_idx[0], trial_start_idx[1], behavior_time_vector[0])
+
+    # Just to make sure we get corresponding iter pulse (trial and iter pulse at same time !!)
+    if mode == 'counter_bit0':
+        ms_after_trial_start_pulse = 1
+        ms_before_trial_end = 1
+    else:
+        ms_after_trial_start_pulse = -4
+        ms_before_trial_end = 4
+
+    samples_after_pulse_start = int(nidq_sampling_rate*(ms_after_trial_start_pulse/1000))
+    samples_before_pulse_end = int(nidq_sampling_rate*(ms_before_trial_end/1000))
+
+    # num Trials to sync (if behavior stopped before last trial was saved)
+    num_trials_sync = min([trial_start_idx.shape[0], num_behavior_trials])
+
+    iter_start_idx = []
+    iter_times_idx = []
+    for i in range(num_trials_sync):
+        #Trial starts for iteration signal when trial pulse ends ()
+        idx_start = trial_end_pulse_idx[i]
+        idx_start_before = trial_start_idx[i] + samples_after_pulse_start
+        if i < trial_start_idx.shape[0]-1:
+            idx_end = trial_start_idx[i+1] -samples_before_pulse_end
+        else:
+            idx_end = edge_table.num_samples - samples_before_pulse_end
+
+        #Get idx of iteration start of current trial
+        if mode == 'counter_bit0':
+            iter_samples = get_idx_iter_start_counterbit_edges(edge_table, iteration_line, trial_start_idx[i], idx_start_before, idx_end)
+        else:
+            iter_samples = get_idx_iter_start_pulsesignal_edges(edge_table, iteration_line, trial_start_idx[i], idx_start_before, idx_start, idx_end, behavior_time_vector[i].shape[0])
+
+        #Append as an array of arrays (each trial is an array with idx of iterations)
+        iter_start_idx.append(iter_samples)
+        #Calculate time for each iteration start
+        times = iter_samples/nidq_sampling_rate
+        times = times - times[0]
+        iter_times_idx.append(times)
+
+    iteration_vector_output['iter_start_idx'] = np.asarray(iter_start_idx.copy(), dtype=object)
+    iteration_vector_output['iter_times_idx'] = np.asarray(iter_times_idx.copy(), dtype=object)
+
+    return iteration_vector_output
+
+
+def decode_digital_word(digital_array, bit_start):
+    # Transform digital lines [bit_start:] into a number for every sample (bit_start line is the least significant bit)
+    # Bits are packed 8 lines at a time instead of building a BitArray per sample
+    packed_lines = np.packbits(digital_array[bit_start:], axis=0, bitorder='little')
+    iterations_raw = np.zeros(digital_array.shape[1], dtype=np.int64)
+    for i in range(packed_lines.shape[0]):
+        iterations_raw |= packed_lines[i].astype(np.int64) << (8*i)
+
+    return iterations_raw
+
+
+def decode_frame_counter_trials(iterations_raw, trial_iterations, max_count, recording_start, recording_end, transition_frame, zero_overflow_offset=0, window_samples=2**16):
+    # Transform `iterations_raw` (virmen frame counter, resets at max_count) into `framenumber_in_trial` and `trialnumber`
+    # Same rules as the original sample by sample loop, evaluated one trial at a time with array operations:
+    #   overflow:   counter goes max_count -> 0 (or max_count -> x -> 0 if sampled in the middle of the reset)
+    #   transition: previous sample frame == # iterations of current trial and current frame is transition_frame
+    # Inputs
+    # iterations_raw       = decoded counter value for every sample
+    # trial_iterations     = # of behavior iterations for each trial
+    # recording_start/end  = only samples in (recording_start, recording_end) are decoded
+    # transition_frame     = boolean array, True for samples where counter value can start a new trial
+    # zero_overflow_offset = added to framenumber while no overflow happened in the trial
+    # Returns framenumber_in_trial, trialnumber (NaN outside recording) and start sample of each trial
+
+    num_samples = iterations_raw.shape[0]
+    counter_period = max_count + 1
+    recording_end = min(recording_end, num_samples)
+
+    framenumber_in_trial = np.zeros(num_samples)*np.nan
+    trialnumber = np.zeros(num_samples)*np.nan
+
+    # Overflow events do not depend on the trial, find them once
+    raw_prev = np.roll(iterations_raw, 1)
+    raw_prev2 = np.roll(iterations_raw, 2)
+    raw_prev[:1] = -1
+    raw_prev2[:2] = -1
+    regular_reset = (iterations_raw == 0) & (raw_prev == max_count)
+    # Unlucky reset if happened to be sampled at the wrong time
+    unlucky_reset = (iterations_raw == 0) & (raw_prev != max_count) & (raw_prev != 0) & (raw_prev2 == max_count)
+    overflow_event = regular_reset.astype(np.int64) + unlucky_reset
+
+    trial_start_idx = []
+    current_trial = 0
+    idx_start = recording_start + 1
+    first_trial = True
+    this_window = window_samples
+    while idx_start < recording_end:
+
+        idx_end = min(idx_start + this_window, recording_end)
+
+        # Overflow events at the transition sample belong to the previous trial
+        overflow_window = overflow_event[idx_start:idx_end].copy()
+        if not first_trial:
+            overflow_window[0] = 0
+        overflow = np.cumsum(overflow_window)
+
+        framenumber_window = (iterations_raw[idx_start:idx_end] + overflow*counter_period - 1).astype(np.float64)
+        framenumber_window[overflow == 0] += zero_overflow_offset
+        # In case of unlucky reset, the previous sample has to be corrected
+        unlucky_window = np.flatnonzero(unlucky_reset[idx_start+1:idx_end]) + 1
+        framenumber_window[unlucky_window-1] = overflow[unlucky_window]*counter_period - 1
+
+        # Trial end has been reached & next trial should start at zero again
+        if current_trial < len(trial_iterations):
+            end_flag = framenumber_window[:-1] == trial_iterations[current_trial]
+            transition = np.flatnonzero(end_flag & transition_frame[idx_start+1:idx_end]) + 1
+        else:
+            transition = np.empty(0, dtype=np.int64)
+
+        if transition.shape[0] > 0:
+            idx_transition = idx_start + transition[0]
+            framenumber_in_trial[idx_start:idx_transition] = framenumber_window[:transition[0]]
+            trialnumber[idx_start:idx_transition] = current_trial
+            if first_trial:
+                trial_start_idx.append(idx_start)
+            trial_start_idx.append(idx_transition)
+
+            current_trial += 1
+            idx_start = idx_transition
+            first_trial = False
+            this_window = window_samples
+        elif idx_end == recording_end:
+            framenumber_in_trial[idx_start:idx_end] = framenumber_window
+            trialnumber[idx_start:idx_end] = current_trial
+            if first_trial:
+                trial_start_idx.append(idx_start)
+            break
+        else:
+            # No transition in this window, look further
+            this_window *= 2
+
+    return framenumber_in_trial, trialnumber, np.array(trial_start_idx, dtype=np.int64)
+
+
+def find_frame_counter_glitches(framenumber_in_trial, trialnumber):
+    # Find the glitches: single samples where the iteration number is corrupted
+    # ... likely because sampling happened faster than output of the behavior PC.
+    # This is also where skipped frames are detected (trial transitions are not glitches)
+    with np.errstate(invalid='ignore'):
+        din = np.diff(framenumber_in_trial)
+        trial_transitions = np.diff(trialnumber) != 0
+        glitches = np.flatnonzero(((din > 1) | (din < 0)) & ~trial_transitions)
+
+    return glitches
+
+
+def fix_frame_counter_glitches(framenumber_in_trial, glitches):
+    # Attempt to remove glitches (in place), returns # of skipped frames found
+    # Consecutive glitches depend on each other, so glitches are fixed by their position in a run of consecutive glitches
+    glitches = glitches[glitches+2 < framenumber_in_trial.shape[0]]
+    if glitches.shape[0] == 0:
+        return 0
+
+    run_start = np.r_[True, np.diff(glitches) != 1]
+    run_position = np.arange(glitches.shape[0]) - np.maximum.accumulate(np.where(run_start, np.arange(glitches.shape[0]), 0))
+
+    skipped_frames = 0
+    for position in range(run_position.max()+1):
+        g = glitches[run_position == position]
+        before = framenumber_in_trial[g]
+        after = framenumber_in_trial[g+2]
+        increasing = before < after
+        skipped_frame = increasing & (after - before == 2)  # skipped frame, should be very rare
+        # If random number, nidaq sample in the middle of update.
+        framenumber_in_trial[g[increasing]+1] = np.where(skipped_frame, before+1, before)[increasing]
+        skipped_frames += np.sum(skipped_frame)
+
+    return skipped_frames
+
+
+def get_last_sample_each_trial(trialnumber):
+    # Index of last sample of each trial in trialnumber (trial blocks are contiguous)
+    finite_idx = np.flatnonzero(np.isfinite(trialnumber))
+    change_idx = np.flatnonzero(np.diff(trialnumber[finite_idx]) != 0)
+    return finite_idx[np.r_[change_idx, finite_idx.shape[0]-1]]
+
+
+def get_iter_start_idx_from_frame_counter(framenumber_in_trial, trialnumber, trial_start_idx):
+    # Iteration start samples for each trial from decoded counter vectors:
+    # first iteration at trial start, next ones whenever framenumber increases (to 2 or more) inside the trial
+    with np.errstate(invalid='ignore'):
+        new_frame = (np.diff(framenumber_in_trial) > 0) & (np.diff(trialnumber) == 0) & (framenumber_in_trial[1:] >= 2)
+    new_frame_idx = np.flatnonzero(new_frame) + 1
+
+    split_idx = np.searchsorted(new_frame_idx, trial_start_idx[1:], side='left')
+    iter_start_idx = [np.insert(x, 0, trial_start_idx[i]) for i, x in enumerate(np.split(new_frame_idx, split_idx))]
+
+    return iter_start_idx
+
+
+def get_iteration_sample_vector_from_digital_lines_word(digital_array, time, iterstart, nidq_sampling_rate=None):
 
     # First, transform digital lines into a number, save in an array of integers
     #      ... and also get start and end time
-    framenumber = np.zeros(digital_array.shape[1])
-    for i in range(digital_array.shape[1]):
-        a = BitArray(np.flip(digital_array[1:, i])) # ignore 0-bit, as this is the NPX sync puls, and not virmen.
-        framenumber[i] = a.uint
-    iterations_raw = np.array(framenumber, dtype=np.int32) # Transform frames into integer
+    # ignore 0-bit, as this is the NPX sync puls, and not virmen.
+    iterations_raw = decode_digital_word(digital_array, 1).astype(np.int32) # Transform frames into integer
     recording_start = np.min(np.where(iterations_raw>0)) #first chane of testlist
     recording_end = np.where(np.abs(np.diff(iterations_raw))>0)[0][-1] + 200 # Adding a random 200 measurements, so ~40ms at our usual 5kHz sampling rate.
 
     # Second, transform `iterations_raw` into `framenumber_in_trial` and `trialnumber`
-    framenumber_in_trial = np.zeros(len(iterations_raw))*np.nan
-    trialnumber = np.zeros(len(iterations_raw))*np.nan
-    current_trial = 0
-    overflow = 0
-    iter_start_idx = []
-    for idx, frame_number in enumerate(iterations_raw):
-        if (idx>recording_start) & (idx<recording_end):
-            if (frame_number==0) & (iterations_raw[idx-1]==127): # At the reset, add 128
-                overflow = overflow + 1
-            if (frame_number==0) & (iterations_raw[idx-1]!=127) & (iterations_raw[idx-1]!=0) &  (iterations_raw[idx-2]==127): # Unlucky reset if happened to be sampled at the wrong time
-                overflow = overflow + 1
-                framenumber_in_trial[idx-1] = frame_number + overflow*128 - 1 # In case this happened, the previous sample has to be corrected
-            # Keep track of trial number
-            endflag = framenumber_in_trial[idx-1] == (len(time[current_trial])) #Trial end has been reached.
-            transitionflag = frame_number < 3 # Next trial should start at zero again
-            if endflag & transitionflag:      # Only at the transitions
-                current_trial = current_trial + 1  # Increases trial count
-                overflow = 0                       # Reset the 7 bit counter
-                iter_start_idx.append(idx)         # Make a note when this happened
-            framenumber_in_trial[idx] = frame_number + overflow*128 - 1
-            trialnumber[idx] = current_trial
-    trial_list = np.array(np.unique(trialnumber[np.isfinite(trialnumber)]), dtype = np.int32)
+    trial_iterations = np.array([len(x) for x in time])
+    framenumber_in_trial, trialnumber, trial_start_idx = decode_frame_counter_trials(
+        iterations_raw, trial_iterations, 127, recording_start, recording_end, iterations_raw < 3)
 
     # Fourth, find and remove the nidaq glitches
-    # These are single samples where the iteration number is corrupted
-    # ... likely because sampling happened faster than output of the behavior PC.
-    # This is also where skipped frames are detected.
-
-    # Find the glitches
-    din = np.diff(framenumber_in_trial)
-    trial_transitions = np.where(np.diff(trialnumber))
-    glitches = []
-    for candidate in np.where( np.logical_or(din>1, din<0) )[0]: # skipped frames or counting down
-        if np.sum(candidate == trial_transitions) == 0:
-            glitches = np.append(glitches, candidate)
-    glitches = np.array(glitches, dtype = np.int32)
-
-    # Attempt to remove them
-    skipped_frames = 0
-    for g in glitches:
-        if framenumber_in_trial[g] < framenumber_in_trial[g+2]:
-            if framenumber_in_trial[g+2] -  framenumber_in_trial[g] == 2:  # skipped frame, should be very rare
-                framenumber_in_trial[g+1] = framenumber_in_trial[g]+1
-                skipped_frames = skipped_frames + 1
-            else:                          # If random number, nidaq sample in the middle of update.
-                framenumber_in_trial[g+1] = framenumber_in_trial[g]
+    glitches = find_frame_counter_glitches(framenumber_in_trial, trialnumber)
+    skipped_frames = fix_frame_counter_glitches(framenumber_in_trial, glitches)
+    print('skipped frames', skipped_frames)
 
     # This point we have framenumber_in_trial and trialnumber. Now just some refactoring to fit into the usual data structure
     iteration_vector_output = dict()
@@ -324,10 +768,13 @@ def get_iteration_sample_vector_from_digital_lines_word(digital_array, time, ite
     iteration_vector_output['trialnumber_vector_samples'] = trialnumber
     iteration_vector_output['framenumber_vector_samples'] = framenumber_in_trial
 
-    iter_start_idx = []
-    for t in trial_list:
-        iter_start_idx.append( np.arange(0, framenumber_in_trial[trialnumber==t][-1], 1))
+    iter_start_idx = get_iter_start_idx_from_frame_counter(framenumber_in_trial, trialnumber, trial_start_idx)
     iteration_vector_output['iter_start_idx'] = np.asarray(iter_start_idx.copy(), dtype=object)
+    iteration_vector_output['counter_trial_start_idx'] = trial_start_idx
+
+    if nidq_sampling_rate is not None:
+        iter_times_idx = [x/nidq_sampling_rate - x[0]/nidq_sampling_rate for x in iter_start_idx]
+        iteration_vector_output['iter_times_idx'] = np.asarray(iter_times_idx.copy(), dtype=object)
 
     return iteration_vector_output
 
@@ -499,13 +946,9 @@ def behavior_sync_frame_counter_method(digital_array, behavior_time_vector, sess
 
   # 2: transform the digital lines into a number, save in an array of integers
     #      ... and also get start and end time
-    framenumber = np.zeros(digital_array.shape[1])
-    for i in range(digital_array.shape[1]):
-        a = BitArray(np.flip(digital_array[bit_start:, i])) # ignore 0-bit, as this is the NPX sync puls, and not virmen.
-        framenumber[i] = a.uint
-    iterations_raw = np.array(framenumber, dtype=np.int) # Transform frames into integer
+    iterations_raw = decode_digital_word(digital_array, bit_start) # ignore 0-bit, as this is the NPX sync puls, and not virmen.
     recording_start = np.min(np.where(iterations_raw>0)) #Get start of recording: first change of testlist
-    dt = np.int(0.04*nidq_sampling_rate)
+    dt = int(0.04*nidq_sampling_rate)
     recording_end = np.where(np.abs(np.diff(iterations_raw))>0)[0][-1] + dt  #Get end of recording
 
     # 3: transform `iterations_raw` into `framenumber_in_trial` and `trialnumber`
@@ -514,66 +957,28 @@ def behavior_sync_frame_counter_method(digital_array, behavior_time_vector, sess
     # trialnumber has the length of the number of samples of the NIDAQ card, and every entry is the current trial.
     #
     # NOTE: some minor glitches have to be catched, if a NIDAQ sample happenes to be recorded while the VR System updates the iteration number.
-    framenumber_in_trial = np.zeros(len(iterations_raw))*np.nan
-    trialnumber = np.zeros(len(iterations_raw))*np.nan
-    current_trial = 0
-    overflow = 0 # This variable keep track whenever the reset from max_count to 0 happens.
-    for idx, frame_number in enumerate(iterations_raw):
-        if (idx>recording_start) & (idx<recording_end):
-            #print(iterations_raw2[idx], frame_number)
-            if (frame_number==0) & (iterations_raw[idx-1]==max_count): # At the reset, add max_count+1
-                overflow = overflow + 1
-            if (frame_number==0) & (iterations_raw[idx-1]!=max_count) & (iterations_raw[idx-1]!=0) &  (iterations_raw[idx-2]==max_count): # Unlucky reset if happened to be sampled at the wrong time
-                overflow = overflow + 1
-                framenumber_in_trial[idx-1] = frame_number + overflow*(max_count+1) - 1 # In case this happened, the previous sample has to be corrected
-            # Keep track of trial number
-            endflag = framenumber_in_trial[idx-1] == (len(behavior_time_vector[current_trial])) # Trial end has been reached.
-
-            transitionflag = frame_number == 2 # Next trial should start at zero again (it starts with two ??)
-            if endflag & transitionflag:      # Only at the transitions
-
-                current_trial = current_trial + 1  # Increases trial count
-                overflow = 0                       # Reset the 7 bit counter for the next trial
-
-            if overflow == 0:
-                framenumber_in_trial[idx] = frame_number
-            else:
-                framenumber_in_trial[idx] = frame_number + overflow*(max_count+1) -1
-
-            trialnumber[idx] = current_trial
+    # Next trial should start at zero again (it starts with two ??)
+    trial_iterations = np.array([len(x) for x in behavior_time_vector])
+    framenumber_in_trial, trialnumber, _ = decode_frame_counter_trials(
+        iterations_raw, trial_iterations, max_count, recording_start, recording_end, iterations_raw == 2, zero_overflow_offset=1)
     trial_list = np.array(np.unique(trialnumber[np.isfinite(trialnumber)]), dtype = np.int64)
 
     # 4: find and remove additional NIDAQ glitches of two types:
     # a) single samples where the iteration number is corrupted because sampling happened faster than output of the behevior PC.
     # b) Skipped frames are detected and filled in.
-    # Find the glitches
-    din = np.diff(framenumber_in_trial)
-    trial_transitions = np.where(np.diff(trialnumber))
-    glitches = []
-    for candidate in np.where( np.logical_or(din>1, din<0) )[0]: # skipped frames or counting down
-        if np.sum(candidate == trial_transitions) == 0:
-            glitches = np.append(glitches, candidate)
-    glitches = np.array(glitches, dtype = np.int)
-    # Attempt to remove them
-    skipped_frames = 0
-    for g in glitches:
-        if framenumber_in_trial[g] < framenumber_in_trial[g+2]:
-            if framenumber_in_trial[g+2] -  framenumber_in_trial[g] == 2:  # skipped frame, should be very rare
-                pass
-                framenumber_in_trial[g+1] = framenumber_in_trial[g]+1
-                skipped_frames = skipped_frames + 1
-            else:                          # If random number, nidaq sample in the middle of update.
-                framenumber_in_trial[g+1] = framenumber_in_trial[g]
+    glitches = find_frame_counter_glitches(framenumber_in_trial, trialnumber)
+    skipped_frames = fix_frame_counter_glitches(framenumber_in_trial, glitches)
 
     # A set of final asserts, making sure that the code worked as intended
     assert len(trial_list) == len(session_trial_keys)          # Make sure the trial number is correct.
     assert np.sum(np.diff(framenumber_in_trial)>1) == 0 # No frames should be skipped
     assert np.sum(np.diff(framenumber_in_trial)<0)<len(trial_list) # Negative iterations only at trial transitions
-    iterations_test = 0
+    last_frame_trial = framenumber_in_trial[get_last_sample_each_trial(trialnumber)]
+    samples_trial = np.bincount(trialnumber[np.isfinite(trialnumber)].astype(np.int64), minlength=len(trial_list))
+    iterations_test = np.sum(last_frame_trial)  # Integrate number of iterations
     for t in trial_list:
-        iterations_test = iterations_test + framenumber_in_trial[trialnumber==t][-1]  # Integrate number of iterations
-        assert framenumber_in_trial[trialnumber==t][-1] == len(behavior_time_vector[t])  # Make sure number of nidaq-frames in each trial is identical to dj record:
-        nidaqtime = np.sum(trialnumber == t)/nidq_sampling_rate
+        assert last_frame_trial[t] == len(behavior_time_vector[t])  # Make sure number of nidaq-frames in each trial is identical to dj record:
+        nidaqtime = samples_trial[t]/nidq_sampling_rate
         matlabtime = np.max(behavior_time_vector[t])
         assert ((nidaqtime - matlabtime) / matlabtime) < 0.1 # # Make sure the nidaq-trial-duration and dj records are consistent; 10% arbitrarily chosen
     nidaq_duration = iterations_test + skipped_frames
@@ -624,7 +1029,20 @@ def load_open_ephys_digital_file(file_path):
 def get_iteration_intertrial_from_virmen_time(trial_pulse_signal, nidq_sampling_rate, num_behavior_trials, behavior_time_vector):
 
     #Get idx samples trial starts
-    trial_start_idx,_ = get_idx_trial_start(trial_pulse_signal)
+    trial_start_idx,_ = get_idx_trial_start(trial_pulse_signal, nidq_sampling_rate)
+
+    return get_iteration_intertrial_from_trial_start(trial_start_idx, nidq_sampling_rate, num_behavior_trials, behavior_time_vector)
+
+
+def get_iteration_intertrial_from_virmen_time_edges(edge_table, trial_line, nidq_sampling_rate, num_behavior_trials, behavior_time_vector):
+
+    #Get idx samples trial starts
+    trial_start_idx,_ = get_idx_trial_start_edges(edge_table, trial_line, nidq_sampling_rate)
+
+    return get_iteration_intertrial_from_trial_start(trial_start_idx, nidq_sampling_rate, num_behavior_trials, behavior_time_vector)
+
+
+def get_iteration_intertrial_from_trial_start(trial_start_idx, nidq_sampling_rate, num_behavior_trials, behavior_time_vector):
 
     iter_start_idx = []
     for i in range(num_behavior_trials):
@@ -702,6 +1120,127 @@ def get_time_vector(trial_index_nidq, nidq_sampling_rate):
     return time_vector
 
 
+class BehaviorSyncSampleMap:
+    '''
+    Lazy "nidq sample -> (trial, iteration, time)" mapping backed by the per trial iteration start vectors
+    stored in BehaviorSync.sync_data (e.g. 'iteration_idx_vector').
+    Lookups give the same values as get_full_vector_samples & get_time_vector, but full length vectors
+    are only built when materialize is called.
+    Trial and iteration numbers are 1 based, samples outside of the synced session are NaN.
+    '''
+
+    def __init__(self, iteration_idx_vector, nidq_sampling_rate, total_samples=None):
+
+        iteration_idx_vector = [np.asarray(x).flatten().astype(np.int64) for x in iteration_idx_vector]
+        iterations_per_trial = np.array([x.shape[0] for x in iteration_idx_vector], dtype=np.int64)
+        non_empty_trials = np.flatnonzero(iterations_per_trial > 0)
+        if non_empty_trials.shape[0] == 0:
+            raise ValueError('No iterations found in iteration_idx_vector')
+
+        self.nidq_sampling_rate = nidq_sampling_rate
+        self.total_samples = total_samples
+
+        # Flat (sorted) table of all iteration starts in the session
+        self.iteration_start_samples = np.concatenate(iteration_idx_vector)
+        self.trial_number = np.repeat(np.arange(1, len(iteration_idx_vector)+1), iterations_per_trial)
+        self.iteration_number = np.concatenate([np.arange(1, x+1) for x in iterations_per_trial])
+        self.trial_start_samples = np.array([x[0] if x.shape[0] > 0 else -1 for x in iteration_idx_vector], dtype=np.int64)
+
+        # Session starts at first iteration of first trial, last trial finishes 1s after its last iteration
+        self.session_start_sample = iteration_idx_vector[non_empty_trials[0]][0]
+        self.session_end_sample = iteration_idx_vector[non_empty_trials[-1]][-1] + int(nidq_sampling_rate)
+        if total_samples is not None:
+            self.session_end_sample = min(self.session_end_sample, total_samples)
+
+    def get_iteration_index(self, samples):
+        # Index in the flat iteration table for each sample, and whether sample is inside the synced session
+        idx_iteration = np.searchsorted(self.iteration_start_samples, samples, side='right') - 1
+        in_session = (idx_iteration >= 0) & (samples < self.session_end_sample)
+
+        return idx_iteration, in_session
+
+    def lookup(self, samples):
+        # Get trial #, iteration # and time (s) for arbitrary nidq sample indexes
+        samples = np.asarray(samples)
+
+        idx_iteration, in_session = self.get_iteration_index(samples)
+
+        trial = np.full(samples.shape, np.nan)
+        iteration = np.full(samples.shape, np.nan)
+        trial[in_session] = self.trial_number[idx_iteration[in_session]]
+        iteration[in_session] = self.iteration_number[idx_iteration[in_session]]
+
+        time = samples/self.nidq_sampling_rate - self.session_start_sample/self.nidq_sampling_rate
+
+        return trial, iteration, time
+
+    def get_sample_index(self, times):
+        # Get nidq sample index for time(s) relative to session start (inverse of lookup time)
+        return np.floor(np.asarray(times)*self.nidq_sampling_rate + self.session_start_sample).astype(np.int64)
+
+    def get_iterations_in_time_range(self, t_start, t_end):
+        # Get all iteration starts between t_start and t_end (s, relative to session start)
+        sample_start, sample_end = self.get_sample_index([t_start, t_end])
+        first = np.searchsorted(self.iteration_start_samples, sample_start, side='left')
+        last = np.searchsorted(self.iteration_start_samples, sample_end, side='left')
+
+        iterations = dict()
+        iterations['trial'] = self.trial_number[first:last]
+        iterations['iteration'] = self.iteration_number[first:last]
+        iterations['sample'] = self.iteration_start_samples[first:last]
+        iterations['time'] = iterations['sample']/self.nidq_sampling_rate - self.session_start_sample/self.nidq_sampling_rate
+
+        return iterations
+
+    def materialize(self):
+        # Full length trial, iteration and time vectors (as get_full_vector_samples & get_time_vector)
+        if self.total_samples is None:
+            raise ValueError('total_samples is needed to materialize full vectors')
+
+        return self.lookup(np.arange(self.total_samples))
+
+    def align_spikes(self, unit_spike_samples, imec_sampling_rate):
+        # Align spikes of many units (e.g. all units of a probe) to behavior with a single binary search
+        # Inputs
+        # unit_spike_samples = list with an array of spike sample indexes (imec clock) for each unit
+        # imec_sampling_rate = sampling rate of the probe (BehaviorSync.ImecSamplingRate)
+        # Returns a list (one per unit) of dictionaries with, for every spike:
+        # 'trial', 'iteration' (1 based, NaN outside session), 'trial_time' (s since trial start) & 'nidq_sample'
+        # and 'spike_counts_iteration': # of spikes during each iteration of the flat iteration table
+
+        unit_spike_samples = [np.asarray(x).flatten() for x in unit_spike_samples]
+        spikes_per_unit = np.array([x.shape[0] for x in unit_spike_samples], dtype=np.int64)
+        num_iterations = self.iteration_start_samples.shape[0]
+
+        # Move all spikes to the nidq clock
+        nidq_samples = np.concatenate(unit_spike_samples).astype(np.float64)*(self.nidq_sampling_rate/imec_sampling_rate)
+        unit_idx = np.repeat(np.arange(len(unit_spike_samples)), spikes_per_unit)
+
+        idx_iteration, in_session = self.get_iteration_index(nidq_samples)
+
+        trial = np.full(nidq_samples.shape, np.nan)
+        iteration = np.full(nidq_samples.shape, np.nan)
+        trial_time = np.full(nidq_samples.shape, np.nan)
+        trial[in_session] = self.trial_number[idx_iteration[in_session]]
+        iteration[in_session] = self.iteration_number[idx_iteration[in_session]]
+        trial_start = self.trial_start_samples[self.trial_number[idx_iteration[in_session]]-1]
+        trial_time[in_session] = (nidq_samples[in_session] - trial_start)/self.nidq_sampling_rate
+
+        # Spike count for each unit x iteration in one bincount
+        spike_counts = np.bincount(unit_idx[in_session]*num_iterations + idx_iteration[in_session],
+                                   minlength=len(unit_spike_samples)*num_iterations)
+        spike_counts = spike_counts.reshape(len(unit_spike_samples), num_iterations)
+
+        split_points = np.cumsum(spikes_per_unit)[:-1]
+        unit_alignment = list()
+        for i, (t, it, tt, ns) in enumerate(zip(np.split(trial, split_points), np.split(iteration, split_points),
+                                                np.split(trial_time, split_points), np.split(nidq_samples, split_points))):
+            unit_alignment.append(dict(trial=t, iteration=it, trial_time=tt, nidq_sample=ns,
+                                       spike_counts_iteration=spike_counts[i]))
+
+        return unit_alignment
+
+
 
 def get_index_type_vectors(trial_index_nidq, iteration_index_nidq, nidq_sampling_rate):
 
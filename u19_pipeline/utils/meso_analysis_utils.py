@@ -0,0 +1,441 @@
+"""
+Vectorized computations of meso_analysis tables (trial stats and time binned activity by trial).
+
+Imaging frame ids stored in meso_analysis.Trialstats are 1 based (as written by the MATLAB pipeline).
+"""
+
+import numpy as np
+import pandas as pd
+
+good_morphologies = ['Blob', 'Doughnut']
+
+# ROIs read and binned at once by BinnedTraceSegmentation (256 ROIs x 100k frames float32 = 100 MB)
+roi_block_size = 256
+
+# behavior.TowersBlock.Trial * behavior.TowersBlock fields used by get_trialstats
+trialstats_behavior_fields = ['block', 'trial_idx', 'trial_type', 'choice', 'trial_time', 'position', 'sensor_dots',
+                              'cue_pos_right', 'cue_pos_left', 'cue_onset_right', 'cue_onset_left', 'cue_offset_right',
+                              'cue_offset_left', 'trial_duration', 'excess_travel', 'i_cue_entry', 'i_mem_entry',
+                              'i_arm_entry', 'iterations', 'trial_id', 'trial_prior_p_left', 'first_trial',
+                              'block_performance']
+
+
+def get_frame_trials(trial_frame_ids):
+    """
+    Frame ids and trial index (position in trial_frame_ids) of all frames of all trials
+    Args:
+        trial_frame_ids (list): meso_frame_unique_ids of each trial
+    Returns:
+        frames (np.array), frame_trials (np.array)
+    """
+    trial_frame_ids = [np.ravel(x).astype(int) for x in trial_frame_ids]
+    lengths = [len(x) for x in trial_frame_ids]
+    frames = np.concatenate(trial_frame_ids) if len(trial_frame_ids) > 0 else np.array([], dtype=int)
+    frame_trials = np.repeat(np.arange(len(trial_frame_ids)), lengths)
+    return frames, frame_trials
+
+
+def get_frame_bins(standardized_time, epoch_binning):
+    """
+    Bin index of each frame (epoch_binning bins per epoch of the standardized time), -1 if frame is not in any epoch
+    """
+    epoch_binning = np.ravel(epoch_binning).astype(int)
+    bin_offsets = np.concatenate([[0], np.cumsum(epoch_binning)[:-1]])
+
+    valid = ~np.isnan(standardized_time)
+    standardized_time = np.where(valid, standardized_time, 1)
+    epoch_idx = np.floor(standardized_time).astype(int) - 1
+    fraction = standardized_time - 1 - epoch_idx
+    # End of the last epoch goes to its last bin
+    last_frame = epoch_idx >= len(epoch_binning)
+    epoch_idx = np.where(last_frame, len(epoch_binning) - 1, epoch_idx)
+    fraction = np.where(last_frame, 1, fraction)
+
+    n_bins = epoch_binning[epoch_idx]
+    # Tolerance so frames exactly at a bin edge are not moved to the previous bin by rounding errors
+    frame_bins = bin_offsets[epoch_idx] + np.minimum(np.floor(fraction * n_bins + 1e-9).astype(int), n_bins - 1)
+    return np.where(valid & (n_bins > 0), frame_bins, -1)
+
+
+def bin_traces(traces, frames, frame_trials, frame_bins, n_trials, n_bins):
+    """
+    Average of each trace per (trial, bin), NaN values of traces are ignored
+    Args:
+        traces (np.array): ROI x session frames
+        frames (np.array): frame ids (1 based) of the trial frames
+        frame_trials (np.array): trial index of each frame
+        frame_bins (np.array): bin index of each frame (-1 = not binned)
+        n_trials (int), n_bins (int): size of the output
+    Returns:
+        binned_traces (np.array): ROI x trial x bin float32 array (NaN in bins without frames)
+    """
+    n_rois = traces.shape[0]
+    binned_traces = np.full((n_rois, n_trials * n_bins), np.nan, dtype=np.float32)
+
+    valid = (frame_bins >= 0) & (frames >= 1) & (frames <= traces.shape[1])
+    groups = frame_trials[valid] * n_bins + frame_bins[valid]
+    if len(groups) == 0:
+        return binned_traces.reshape(n_rois, n_trials, n_bins)
+
+    # Frames sorted by (trial, bin), each group is a contiguous run of columns
+    order = np.argsort(groups, kind='stable')
+    groups = groups[order]
+    group_frames = frames[valid][order] - 1
+    unique_groups, group_starts = np.unique(groups, return_index=True)
+
+    values = traces[:, group_frames]
+    not_nan = ~np.isnan(values)
+    sums = np.add.reduceat(np.where(not_nan, values, 0), group_starts, axis=1)
+    counts = np.add.reduceat(not_nan, group_starts, axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        binned_traces[:, unique_groups] = np.where(counts > 0, sums / counts, np.nan)
+
+    return binned_traces.reshape(n_rois, n_trials, n_bins)
+
+
+def select_trials(trials, selection_params):
+    """
+    Trials that pass TrialSelectionParameters
+    Args:
+        trials (pd.DataFrame): Trialstats rows (block_id, is_towers_task, is_visguided_task, mean_perf_block,
+                               mean_bias_block, is_excess_travel)
+        selection_params (dict): TrialSelectionParameters row
+    Returns:
+        selected (np.array): boolean per trial
+    """
+    selected = np.ones(len(trials), dtype=bool)
+    if selection_params['no_excess_travel'] == 1:
+        selected &= trials['is_excess_travel'].values == 0
+
+    is_towers = trials['is_towers_task'].values == 1
+    is_visguided = trials['is_visguided_task'].values == 1
+    perf = trials['mean_perf_block'].values
+    bias = np.abs(trials['mean_bias_block'].values)
+    selected &= ~is_towers | ((perf >= selection_params['towers_perf_thresh']) &
+                              (bias <= selection_params['towers_bias_thresh']))
+    selected &= ~is_visguided | ((perf >= selection_params['visguide_perf_thresh']) &
+                                 (bias <= selection_params['visguide_bias_thresh']))
+
+    block_trials = trials.groupby('block_id')['block_id'].transform('count').values
+    selected &= block_trials >= selection_params['min_trials_per_block']
+    return selected
+
+
+def get_iteration_frames(block_by_frame, trial_by_frame, iter_by_frame, iter_blocks, iter_trials, iter_numbers):
+    """
+    Imaging frame (1 based, 0 if not imaged) of behavior iterations, from meso.SyncImagingBehavior per frame arrays.
+    An iteration belongs to the last frame that started at or before it.
+    Args:
+        block_by_frame, trial_by_frame, iter_by_frame (np.array): behavior block, trial & iteration of each frame
+        iter_blocks, iter_trials, iter_numbers (np.array): block, trial & iteration number (1 based) of iterations
+    """
+    block_by_frame = np.ravel(block_by_frame).astype(np.int64)
+    trial_by_frame = np.ravel(trial_by_frame).astype(np.int64)
+    iter_by_frame = np.ravel(iter_by_frame).astype(np.int64)
+
+    def sort_key(blocks, trials, iterations):
+        return (blocks * 100000 + trials) * 10000000 + iterations
+
+    # Frames before behavior started have no block
+    imaged = np.flatnonzero(block_by_frame > 0)
+    frame_keys = sort_key(block_by_frame[imaged], trial_by_frame[imaged], iter_by_frame[imaged])
+    order = np.argsort(frame_keys, kind='stable')
+    frame_keys = frame_keys[order]
+    frame_ids = imaged[order] + 1
+
+    positions = np.searchsorted(frame_keys, sort_key(np.asarray(iter_blocks, dtype=np.int64),
+                                                     np.asarray(iter_trials, dtype=np.int64),
+                                                     np.asarray(iter_numbers, dtype=np.int64)), side='right') - 1
+    return np.where(positions >= 0, frame_ids[np.maximum(positions, 0)], 0)
+
+
+def get_frame_groups(iter_trials, iter_frames):
+    """
+    Group of each iteration by (trial, imaging frame), iterations out of imaging (frame 0) have group -1
+    Returns:
+        groups (np.array), group_trials (np.array), group_frames (np.array)
+    """
+    valid = iter_frames > 0
+    keys = np.asarray(iter_trials, dtype=np.int64) * 100000000 + iter_frames
+    unique_keys, inverse = np.unique(keys[valid], return_inverse=True)
+    groups = np.full(len(keys), -1, dtype=np.int64)
+    groups[valid] = inverse
+    return groups, unique_keys // 100000000, unique_keys % 100000000
+
+
+def average_by_group(values, groups, n_groups):
+    """
+    Mean of values of each group (np.bincount), NaN for groups without values
+    """
+    valid = groups >= 0
+    counts = np.bincount(groups[valid], minlength=n_groups)
+    sums = np.bincount(groups[valid], weights=values[valid], minlength=n_groups)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(counts > 0, sums / counts, np.nan)
+
+
+def split_by_trial(values, value_trials, n_trials):
+    """
+    Split values (sorted by trial) into one array per trial
+    """
+    boundaries = np.searchsorted(value_trials, np.arange(1, n_trials))
+    return np.split(values, boundaries)
+
+
+def get_cue_counts(onset_times, trial_times, iter_frames_by_trial, unique_keys):
+    """
+    Number of cues per (trial, imaging frame) group, cues are assigned to the first iteration at or after their onset
+    Args:
+        onset_times (list): cue onset times of each trial
+        trial_times (list): iteration times of each trial
+        iter_frames_by_trial (list): imaging frame of each iteration of each trial
+        unique_keys (np.array): sorted (trial, frame) keys of the groups (trial * 100000000 + frame)
+    """
+    cue_keys = list()
+    for trial, (onsets, times, iter_frames) in enumerate(zip(onset_times, trial_times, iter_frames_by_trial,
+                                                             strict=True)):
+        onsets = np.ravel(onsets) if onsets is not None else np.array([])
+        if len(onsets) == 0 or len(times) == 0:
+            continue
+        cue_iters = np.minimum(np.searchsorted(times, onsets, side='left'), len(times) - 1)
+        cue_frames = iter_frames[cue_iters]
+        cue_keys.append(trial * 100000000 + cue_frames[cue_frames > 0])
+
+    counts = np.zeros(len(unique_keys), dtype=int)
+    if len(cue_keys) > 0:
+        cue_keys = np.concatenate(cue_keys)
+        counts += np.bincount(np.searchsorted(unique_keys, cue_keys), minlength=len(unique_keys))[:len(unique_keys)]
+    return counts
+
+
+def get_iteration_frame(iter_frames, iteration):
+    """
+    Imaging frame of an iteration (1 based, as i_* fields of behavior.TowersBlock.Trial), None if not imaged
+    """
+    if iteration is None or iteration < 1 or iteration > len(iter_frames) or iter_frames[iteration - 1] == 0:
+        return None
+    return int(iter_frames[iteration - 1])
+
+
+def get_trialstats(trials, block_by_frame, trial_by_frame, iter_by_frame):
+    """
+    Trialstats rows (without the scan key) of all trials of a session
+    Args:
+        trials (pd.DataFrame): behavior.TowersBlock.Trial * behavior.TowersBlock rows sorted by (block, trial_idx)
+        block_by_frame, trial_by_frame, iter_by_frame (np.array): meso.SyncImagingBehavior per frame arrays
+    Returns:
+        rows (list): one dict per trial, trial_idx is the index of the trial in the session (1 based)
+    """
+    n_trials = len(trials)
+    trial_times = [np.ravel(x).astype(float) for x in trials['trial_time']]
+    positions = [np.atleast_2d(np.asarray(x, dtype=float)).reshape(-1, 3) if np.size(x) > 0
+                 else np.zeros((0, 3)) for x in trials['position']]
+
+    # Imaging frame of every iteration of every trial in one search
+    n_iters = np.array([len(x) for x in trial_times])
+    iter_trials = np.repeat(np.arange(n_trials), n_iters)
+    iter_numbers = np.concatenate([np.arange(1, n + 1) for n in n_iters]) if n_trials else np.array([], dtype=int)
+    iter_frames = get_iteration_frames(block_by_frame, trial_by_frame, iter_by_frame,
+                                       trials['block'].values[iter_trials], trials['trial_idx'].values[iter_trials],
+                                       iter_numbers)
+    iter_frames_by_trial = np.split(iter_frames, np.cumsum(n_iters)[:-1]) if n_trials else []
+
+    # Behavior variables of all iterations, averaged per (trial, frame) with one bincount per variable
+    groups, group_trials, group_frames = get_frame_groups(iter_trials, iter_frames)
+    unique_keys = group_trials * 100000000 + group_frames
+    n_groups = len(group_trials)
+
+    displacements = [np.diff(x, axis=0, prepend=x[:1]) for x in positions]
+    # Position is only recorded during the trial, ITI iterations are not averaged
+    n_positions = np.minimum([len(x) for x in positions], n_iters)
+    position_groups = np.concatenate([groups[start:start + n] for start, n in
+                                      zip(np.concatenate([[0], np.cumsum(n_iters)[:-1]]), n_positions, strict=True)]) \
+        if n_trials else np.array([], dtype=int)
+    all_positions = np.concatenate([x[:n] for x, n in zip(positions, n_positions, strict=True)]) if n_trials \
+        else np.zeros((0, 3))
+    all_displacements = np.concatenate([x[:n] for x, n in zip(displacements, n_positions, strict=True)]) if n_trials \
+        else np.zeros((0, 3))
+
+    by_frame = {'behav_time_by_meso_frame': average_by_group(np.concatenate(trial_times) if n_trials else np.array([]),
+                                                             groups, n_groups)}
+    for column, name in enumerate(['position_x', 'position_y', 'position_theta']):
+        by_frame[name + '_by_meso_frame'] = average_by_group(all_positions[:, column], position_groups, n_groups)
+    for column, name in enumerate(['dx', 'dy', 'dtheta']):
+        by_frame[name + '_by_meso_frame'] = average_by_group(all_displacements[:, column], position_groups, n_groups)
+    by_frame['cues_by_meso_frame_right'] = get_cue_counts(trials['cue_onset_right'], trial_times, iter_frames_by_trial,
+                                                          unique_keys)
+    by_frame['cues_by_meso_frame_left'] = get_cue_counts(trials['cue_onset_left'], trial_times, iter_frames_by_trial,
+                                                         unique_keys)
+    by_frame['meso_frame_unique_ids'] = group_frames
+    by_frame = {name: split_by_trial(values, group_trials, n_trials) for name, values in by_frame.items()}
+
+    # Trial level values
+    went_right = (trials['choice'] == 'R').values
+    went_left = (trials['choice'] == 'L').values
+    is_right = (trials['trial_type'] == 'R').values
+    is_correct = (trials['choice'] == trials['trial_type']).values
+    ncues_right = np.array([np.size(x) if x is not None else 0 for x in trials['cue_pos_right']])
+    ncues_left = np.array([np.size(x) if x is not None else 0 for x in trials['cue_pos_left']])
+    ncues_total = ncues_right + ncues_left
+    ncues_minority = np.where(is_right, ncues_left, ncues_right)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        trial_difficulty = np.where(ncues_total > 0, np.abs(ncues_right - ncues_left) / ncues_total, 0)
+
+    # Blocks without any distractor tower are visually guided, blocks with towers on both sides are towers task
+    block_has_distractors = pd.Series(ncues_minority > 0).groupby(trials['block'].values).transform('any').values
+    is_towers = block_has_distractors
+    is_visguided = ~block_has_distractors
+    # Towers task trials with less evidence (delta_towers / total_towers at or below the median) are the hard half
+    median_difficulty = np.median(trial_difficulty[is_towers]) if np.any(is_towers) else 0
+    is_hard = is_towers & (trial_difficulty <= median_difficulty)
+    is_easy = is_towers & (trial_difficulty > median_difficulty)
+
+    # Side bias: performance on right trials - performance on left trials of each block
+    block_perf = pd.DataFrame({'block': trials['block'].values, 'is_right': is_right, 'is_correct': is_correct})
+    right_perf = block_perf[block_perf['is_right']].groupby('block')['is_correct'].mean()
+    left_perf = block_perf[~block_perf['is_right']].groupby('block')['is_correct'].mean()
+    mean_bias_block = (right_perf - left_perf).reindex(trials['block'].values).fillna(0).values
+
+    # Error trials get a timeout after the ITI of correct trials (time from ITI start to its last iteration)
+    iterations = trials['iterations'].values.astype(int)
+    correct_iti_durs = [times[-1] - times[n] for times, n, correct in
+                        zip(trial_times, iterations, is_correct, strict=True) if correct and len(times) > n]
+    correct_iti_dur = np.median(correct_iti_durs) if len(correct_iti_durs) > 0 else np.nan
+
+    is_excess_travel = trials['excess_travel'].values > 0.1
+
+    rows = list()
+    for trial in range(n_trials):
+        trial_row = trials.iloc[trial]
+        times, position, displacement = trial_times[trial], positions[trial], displacements[trial]
+        trial_iter_frames = iter_frames_by_trial[trial]
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            dt = np.diff(times[:len(position)], prepend=times[:1])
+            run_speed = np.where(dt > 0, np.hypot(displacement[:, 0], displacement[:, 1])[:len(dt)] / dt, 0)
+        in_stem = (position[:, 1] > 0) & (position[:, 1] < 300) if len(position) else np.array([], dtype=bool)
+        stem_displacement = np.sum(np.hypot(displacement[in_stem, 0], displacement[in_stem, 1]))
+
+        cue_pos = np.concatenate([np.ravel(x) for x in [trial_row['cue_pos_right'], trial_row['cue_pos_left']]
+                                  if x is not None])
+        cue_onsets = np.concatenate([np.ravel(x) for x in [trial_row['cue_onset_right'], trial_row['cue_onset_left']]
+                                     if x is not None])
+        i_arm_entry = int(trial_row['i_arm_entry'])
+        arm_entry_y = position[i_arm_entry - 1, 1] if 0 < i_arm_entry <= len(position) else np.nan
+        arm_entry_time = times[i_arm_entry - 1] if 0 < i_arm_entry <= len(times) else np.nan
+        cue_length = np.max(cue_pos) - np.min(cue_pos) if len(cue_pos) else 0
+        mem_length = arm_entry_y - np.max(cue_pos) if len(cue_pos) else 0
+        cue_dur = np.max(cue_onsets) - np.min(cue_onsets) if len(cue_onsets) else 0
+        mem_dur = arm_entry_time - np.max(cue_onsets) if len(cue_onsets) else 0
+
+        iterations = int(trial_row['iterations'])
+        timeout_frame = None
+        if not is_correct[trial] and len(times) > iterations:
+            timeout_iters = np.flatnonzero(times[iterations:] - times[iterations] > correct_iti_dur)
+            if len(timeout_iters) > 0:
+                timeout_frame = get_iteration_frame(trial_iter_frames, iterations + timeout_iters[0] + 1)
+
+        row = {
+            'trial_idx': trial + 1,
+            'went_right': int(went_right[trial]),
+            'went_left': int(went_left[trial]),
+            'is_right_trial': int(is_right[trial]),
+            'is_left_trial': int(not is_right[trial]),
+            'is_correct': int(is_correct[trial]),
+            'is_error': int(not is_correct[trial]),
+            'is_towers_task': int(is_towers[trial]),
+            'is_visguided_task': int(is_visguided[trial]),
+            'is_hard': int(is_hard[trial]),
+            'is_easy': int(is_easy[trial]),
+            'has_distractor_towers': int(ncues_minority[trial] > 0),
+            'has_no_distractor_towers': int(ncues_minority[trial] == 0),
+            'is_excess_travel': int(is_excess_travel[trial]),
+            'is_not_excess_travel': int(not is_excess_travel[trial]),
+            'is_first_trial_in_block': int(trial_row['trial_idx'] == trial_row['first_trial']),
+            'time': times,
+            'position_x': position[:, 0],
+            'position_y': position[:, 1],
+            'position_theta': position[:, 2],
+            'dx': displacement[:, 0],
+            'dy': displacement[:, 1],
+            'dtheta': displacement[:, 2],
+            'raw_sensor_data': np.asarray(trial_row['sensor_dots']).T,
+            'run_speed_instant': run_speed,
+            'run_speed_avg_stem': float(np.mean(run_speed[in_stem])) if np.any(in_stem) else 0,
+            'excess_travel': float(trial_row['excess_travel']),
+            'trial_dur_sec': float(trial_row['trial_duration']),
+            'total_stem_displacement': float(stem_displacement),
+            'block_id': int(trial_row['block']),
+            'mean_perf_block': float(trial_row['block_performance']),
+            'mean_bias_block': float(mean_bias_block[trial]),
+            'stim_train_id': int(trial_row['trial_id']),
+            'left_draw_generative_prob': float(trial_row['trial_prior_p_left']),
+            'cue_pos_right': trial_row['cue_pos_right'],
+            'cue_pos_left': trial_row['cue_pos_left'],
+            'cue_onset_time_right': trial_row['cue_onset_right'],
+            'cue_onset_time_left': trial_row['cue_onset_left'],
+            'cue_offset_time_right': trial_row['cue_offset_right'],
+            'cue_offset_time_left': trial_row['cue_offset_left'],
+            'ncues_right': int(ncues_right[trial]),
+            'ncues_left': int(ncues_left[trial]),
+            'ncues_right_minus_left': int(ncues_right[trial] - ncues_left[trial]),
+            'ncues_total': int(ncues_total[trial]),
+            'trial_difficulty': float(trial_difficulty[trial]),
+            'true_cue_period_length_cm': int(np.round(cue_length)),
+            'true_mem_period_length_cm': int(np.round(np.nan_to_num(mem_length))),
+            'true_cue_period_dur_sec': int(np.round(cue_dur)),
+            'true_mem_period_dur_sec': int(np.round(np.nan_to_num(mem_dur))),
+            'meso_frame_per_virmen_iter': trial_iter_frames,
+            'trial_start_meso_frame': get_iteration_frame(trial_iter_frames, 1),
+            'cue_entry_meso_frame': get_iteration_frame(trial_iter_frames, int(trial_row['i_cue_entry'])),
+            'mem_entry_meso_frame': get_iteration_frame(trial_iter_frames, int(trial_row['i_mem_entry'])),
+            'arm_entry_meso_frame': get_iteration_frame(trial_iter_frames, i_arm_entry),
+            'trial_end_meso_frame': get_iteration_frame(trial_iter_frames, iterations),
+            'iti_meso_frame': get_iteration_frame(trial_iter_frames, iterations + 1),
+            'timeout_meso_frame': timeout_frame,
+            'iti_end_meso_frame': get_iteration_frame(trial_iter_frames, len(trial_iter_frames)),
+        }
+        row.update({name: values[trial] for name, values in by_frame.items()})
+        rows.append(row)
+
+    return rows
+
+
+def trialstats_values_equal(python_value, matlab_value, rtol=1e-5, atol=1e-8):
+    """
+    True if a Trialstats value computed in Python matches the MATLAB one (null and empty arrays are equal)
+    """
+    python_value = np.ravel(np.asarray([] if python_value is None else python_value, dtype=float))
+    matlab_value = np.ravel(np.asarray([] if matlab_value is None else matlab_value, dtype=float))
+    return python_value.shape == matlab_value.shape and \
+        np.allclose(python_value, matlab_value, rtol=rtol, atol=atol, equal_nan=True)
+
+
+def compare_trialstats(python_rows, matlab_rows, rtol=1e-5, atol=1e-8):
+    """
+    Compare Trialstats rows computed with get_trialstats with the rows populated by MATLAB for the same scan
+    (or the expected rows of a fixture session)
+    Args:
+        python_rows (list): rows of get_trialstats
+        matlab_rows (list): meso_analysis.Trialstats rows (dicts) of the same scan, only their columns are compared
+    Returns:
+        parity (pd.DataFrame): per column, number of trials compared, trials with different values and first of them
+    """
+    matlab_by_trial = {int(x['trial_idx']): x for x in matlab_rows}
+    python_by_trial = {int(x['trial_idx']): x for x in python_rows}
+    common_trials = sorted(set(matlab_by_trial) & set(python_by_trial))
+
+    # Columns of the reference rows (all Trialstats columns for MATLAB rows, a subset for fixtures)
+    reference_columns = set(matlab_rows[0]) if len(matlab_rows) > 0 else set()
+    columns = [x for x in python_rows[0] if x != 'trial_idx' and x in reference_columns] if len(python_rows) > 0 else []
+    parity = list()
+    for column in columns:
+        mismatch_trials = [trial for trial in common_trials if not trialstats_values_equal(
+            python_by_trial[trial][column], matlab_by_trial[trial].get(column), rtol, atol)]
+        parity.append({'column': column, 'n_trials': len(common_trials), 'n_mismatch': len(mismatch_trials),
+                       'first_mismatch_trial': mismatch_trials[0] if len(mismatch_trials) > 0 else None})
+
+    parity = pd.DataFrame(parity, columns=['column', 'n_trials', 'n_mismatch', 'first_mismatch_trial'])
+    parity.attrs['python_only_trials'] = sorted(set(python_by_trial) - set(matlab_by_trial))
+    parity.attrs['matlab_only_trials'] = sorted(set(matlab_by_trial) - set(python_by_trial))
+    return parity
@@ -0,0 +1,475 @@
+"""
+Read ScanImage (mesoscope & 2 photon) tiff headers without loading pixel data.
+
+Scan level info comes from the first page of the first file (Software tag: SI.* variables, Artist tag: ROI groups json),
+frame level info (timestamps, number of frames) from the ImageDescription tag of every page.
+Headers of all files of a scan are read in a thread pool.
+
+Mesoscope scans are split by field of view (TiffSplit) from memory mapped views of the pages of the original files.
+"""
+
+import contextlib
+import datetime
+import json
+import os
+import pathlib
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import tifffile
+
+header_workers = 8
+
+tiff_extensions = ['.tif', '.tiff']
+
+# ScanImage appends _00001 (file number) to the base name of the files of an acquisition
+file_number_pattern = re.compile(r'_\d{5}$')
+timestamp_pattern = re.compile(r'frameTimestamps_sec\s*=\s*([-\d.eE+]+)')
+epoch_pattern = re.compile(r'epoch\s*=\s*\[([^\]]*)\]')
+
+
+def parse_matlab_value(value):
+    """
+    Convert value of a ScanImage header line (matlab syntax) to python
+    """
+    value = value.strip()
+    if value in ('true', 'false'):
+        return value == 'true'
+    if len(value) > 1 and value[0] == "'" and value[-1] == "'":
+        return value[1:-1]
+    if value.startswith('[') and value.endswith(']'):
+        rows = [x.replace(',', ' ').split() for x in value[1:-1].split(';')]
+        rows = [[parse_matlab_value(x) for x in row] for row in rows if len(row) > 0]
+        if len(rows) == 1:
+            return rows[0]
+        return rows
+    try:
+        return int(value)
+    except ValueError:
+        pass
+    try:
+        return float(value)
+    except ValueError:
+        return value
+
+
+def parse_si_header(software_tag):
+    """
+    Parse "SI.hRoiManager.scanFrameRate = 30" lines into a dict {'hRoiManager.scanFrameRate': 30, ...}
+    """
+    si_header = dict()
+    for line in software_tag.splitlines():
+        if not line.startswith('SI.') or '=' not in line:
+            continue
+        name, value = line.split('=', 1)
+        si_header[name.strip()[3:]] = parse_matlab_value(value)
+    return si_header
+
+
+def to_list(value):
+    # Single element json arrays and matlab vectors are written as scalars
+    if value is None:
+        return []
+    if isinstance(value, list):
+        return value
+    return [value]
+
+
+def get_scan_tiff_files(scan_directory):
+    """
+    Sorted list of tiff files of a scan directory (split fov files in subdirectories are not included)
+    """
+    tiff_files = [x for x in pathlib.Path(scan_directory).iterdir()
+                  if x.is_file() and x.suffix.lower() in tiff_extensions]
+    return sorted(tiff_files, key=lambda x: x.name)
+
+
+def get_file_name_base(tiff_files):
+    """
+    Base name of the files of the acquisition (name without _00001.tif)
+    """
+    return file_number_pattern.sub('', pathlib.Path(tiff_files[0]).stem)
+
+
+def read_frame_headers(tiff_file):
+    """
+    Read number of frames and frame timestamps of a tiff file (tags of each page only, no pixel data)
+    Returns:
+        n_frames (int), frame_ts_sec (list)
+    """
+    frame_ts_sec = list()
+    with tifffile.TiffFile(tiff_file) as tif:
+        tif.pages.cache = False
+        n_frames = 0
+        for page in tif.pages:
+            n_frames += 1
+            # Virtual frames (ScanImage <= 2015 files) have no tags
+            match = timestamp_pattern.search(getattr(page, 'description', None) or '')
+            frame_ts_sec.append(float(match.group(1)) if match else np.nan)
+    return n_frames, frame_ts_sec
+
+
+def read_scan_header(tiff_file):
+    """
+    Read SI variables, ROI groups, first page description and page shape from first page of a tiff file
+    """
+    with tifffile.TiffFile(tiff_file) as tif:
+        first_page = tif.pages[0]
+        software_tag = first_page.tags.get('Software', None)
+        artist_tag = first_page.tags.get('Artist', None)
+        software = software_tag.value if software_tag is not None else ''
+        artist = artist_tag.value if artist_tag is not None else ''
+        description = first_page.description or ''
+        page_shape = first_page.shape
+
+    si_header = parse_si_header(software)
+    roi_groups = dict()
+    if artist:
+        roi_groups = json.loads(artist.strip('\x00'))
+    return si_header, roi_groups, description, page_shape
+
+
+def get_acq_time(description, tiff_file):
+    """
+    Acquisition time from epoch in frame header, modification time of file if not found
+    """
+    match = epoch_pattern.search(description)
+    if match:
+        values = [float(x) for x in match.group(1).replace(',', ' ').split()]
+        if len(values) == 6:
+            seconds = int(values[5])
+            return datetime.datetime(int(values[0]), int(values[1]), int(values[2]), int(values[3]), int(values[4]),
+                                     seconds, int(round((values[5] - seconds) * 1e6)) % 1000000)
+    return datetime.datetime.fromtimestamp(os.path.getmtime(tiff_file))
+
+
+def get_fovs(si_header, roi_groups, page_shape, scan_depths, power_percent):
+    """
+    Field of views of the scan, one per (ROI, depth) imaged.
+    Each fov has the TiffSplit fields plus the rows of the page where it is stored ('first_row', 'last_row')
+    and the depth index of the pages it appears in ('depth_idx').
+    """
+
+    object_resolution = si_header.get('objectiveResolution', 1)
+    page_height, page_width = page_shape[-2], page_shape[-1]
+
+    rois = list()
+    if si_header.get('hRoiManager.mroiEnable', False):
+        rois = to_list(roi_groups.get('RoiGroups', {}).get('imagingRoiGroup', {}).get('rois', None))
+        rois = [x for x in rois if x.get('enable', 1)]
+
+    if len(rois) == 0:
+        # Single FOV scan (2 photon or mesoscope without mROI), whole page per depth
+        fovs = list()
+        for depth_idx, depth in enumerate(scan_depths):
+            this_fov = dict()
+            this_fov['tiff_split_name'] = 'ROI01_z' + str(depth_idx + 1)
+            this_fov['fov_depth'] = depth
+            this_fov['fov_center_xy'] = np.array([0.0, 0.0])
+            this_fov['fov_size_xy'] = np.array([page_width, page_height], dtype=float)
+            this_fov['fov_rotation_degrees'] = 0
+            this_fov['fov_pixel_resolution_xy'] = np.array([page_width, page_height])
+            this_fov['fov_discrete_plane_mode'] = 0
+            this_fov['power_percent'] = power_percent
+            this_fov['first_row'] = 0
+            this_fov['last_row'] = page_height
+            this_fov['depth_idx'] = depth_idx
+            fovs.append(this_fov)
+        return fovs
+
+    # ROIs imaged at each depth, stacked vertically in the page and separated by flyto lines
+    rois_by_depth = list()
+    for depth in scan_depths:
+        rois_depth = list()
+        for roi_idx, roi in enumerate(rois):
+            roi_zs = to_list(roi.get('zs', None))
+            if roi.get('discretePlaneMode', 0) and len(roi_zs) > 0 and depth not in roi_zs:
+                continue
+            scanfields = to_list(roi['scanfields'])
+            # Scanfield defined at closest depth to this one
+            scanfield = scanfields[int(np.argmin(np.abs(np.array(roi_zs, dtype=float) - depth)))] \
+                if len(roi_zs) == len(scanfields) else scanfields[0]
+            rois_depth.append((roi_idx, roi, scanfield))
+        rois_by_depth.append(rois_depth)
+
+    roi_lines = [sum([x[2]['pixelResolutionXY'][1] for x in rois_depth]) for rois_depth in rois_by_depth]
+    max_idx = int(np.argmax(roi_lines))
+    n_rois_max = len(rois_by_depth[max_idx])
+    n_flyto_lines = (page_height - roi_lines[max_idx]) // (n_rois_max - 1) if n_rois_max > 1 else 0
+
+    fovs = list()
+    for depth_idx, rois_depth in enumerate(rois_by_depth):
+        first_row = 0
+        for roi_idx, roi, scanfield in rois_depth:
+            n_lines = scanfield['pixelResolutionXY'][1]
+            this_fov = dict()
+            this_fov['tiff_split_name'] = 'ROI' + str(roi_idx + 1).zfill(2) + '_z' + str(depth_idx + 1)
+            this_fov['fov_depth'] = scan_depths[depth_idx]
+            this_fov['fov_center_xy'] = np.array(scanfield['centerXY'], dtype=float) * object_resolution
+            this_fov['fov_size_xy'] = np.array(scanfield['sizeXY'], dtype=float) * object_resolution
+            this_fov['fov_rotation_degrees'] = scanfield.get('rotationDegrees', 0)
+            this_fov['fov_pixel_resolution_xy'] = np.array(scanfield['pixelResolutionXY'])
+            this_fov['fov_discrete_plane_mode'] = int(roi.get('discretePlaneMode', 0))
+            this_fov['power_percent'] = power_percent
+            this_fov['first_row'] = first_row
+            this_fov['last_row'] = first_row + n_lines
+            this_fov['depth_idx'] = depth_idx
+            fovs.append(this_fov)
+            first_row += n_lines + n_flyto_lines
+
+    return fovs
+
+
+def read_scan_headers(tiff_files, max_workers=header_workers):
+    """
+    Read all info needed for AcquiredTiff, TiffSplit & TiffSplit.File from the headers of the tiff files of a scan
+    Returns:
+        scan_info (dict): AcquiredTiff fields (without key)
+        fovs (list): TiffSplit fields of each fov (without key) + rows and depth of the fov in the pages (see get_fovs)
+        file_frames (list): per file dict with 'first_page', 'n_pages' and 'frame_range' ([first last] frame, 1 based)
+    """
+
+    tiff_files = [pathlib.Path(x) for x in tiff_files]
+
+    si_header, roi_groups, description, page_shape = read_scan_header(tiff_files[0])
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        frame_headers = list(executor.map(read_frame_headers, tiff_files))
+
+    scan_depths = [float(x) for x in to_list(si_header.get('hStackManager.zs', 0))]
+    if not si_header.get('hFastZ.enable', False) and not si_header.get('hStackManager.enable', False):
+        scan_depths = scan_depths[:1]
+    channels = to_list(si_header.get('hChannels.channelSave', 1))
+    power_percent = float(to_list(si_header.get('hBeams.powers', 0))[0])
+
+    # Pages are ordered by volume, depth, channel
+    pages_per_frame = len(scan_depths) * len(channels)
+    file_frames = list()
+    first_page = 0
+    for n_pages, _ in frame_headers:
+        this_file = dict()
+        this_file['first_page'] = first_page
+        this_file['n_pages'] = n_pages
+        this_file['frame_range'] = np.array([first_page // pages_per_frame + 1,
+                                             (first_page + n_pages - 1) // pages_per_frame + 1])
+        file_frames.append(this_file)
+        first_page += n_pages
+    nframes = first_page // pages_per_frame
+
+    page_ts_sec = np.concatenate([np.array(x[1], dtype=float) for x in frame_headers])
+    frame_ts_sec = page_ts_sec[:nframes * pages_per_frame:pages_per_frame]
+    if np.all(np.isnan(frame_ts_sec)) and si_header.get('hRoiManager.scanVolumeRate', 0):
+        frame_ts_sec = np.arange(nframes) / float(si_header['hRoiManager.scanVolumeRate'])
+
+    fovs = get_fovs(si_header, roi_groups, page_shape, scan_depths, power_percent)
+
+    line_period = float(si_header.get('hRoiManager.linePeriod', 0))
+    inter_fov_lag_sec = 0
+    depth_fovs = [x for x in fovs if x['depth_idx'] == 0]
+    if len(depth_fovs) > 1:
+        inter_fov_lag_sec = (depth_fovs[1]['first_row'] - depth_fovs[0]['first_row']) * line_period
+
+    scan_info = dict()
+    scan_info['file_name_base'] = get_file_name_base(tiff_files)
+    scan_info['scan_width'] = page_shape[-1]
+    scan_info['scan_height'] = page_shape[-2]
+    scan_info['acq_time'] = get_acq_time(description, tiff_files[0])
+    scan_info['n_depths'] = len(scan_depths)
+    scan_info['scan_depths'] = np.array(scan_depths)
+    scan_info['frame_rate'] = float(si_header.get('hRoiManager.scanFrameRate', 0))
+    scan_info['inter_fov_lag_sec'] = inter_fov_lag_sec
+    scan_info['frame_ts_sec'] = frame_ts_sec
+    scan_info['power_percent'] = power_percent
+    scan_info['channels'] = np.array(channels)
+    scan_info['cfg_filename'] = str(si_header.get('hConfigurationSaver.cfgFilename', ''))
+    scan_info['usr_filename'] = str(si_header.get('hConfigurationSaver.usrFilename', ''))
+    scan_info['fast_z_lag'] = float(si_header.get('hFastZ.actuatorLag', 0))
+    scan_info['fast_z_flyback_time'] = float(si_header.get('hFastZ.flybackTime', 0))
+    scan_info['line_period'] = line_period
+    scan_info['scan_frame_period'] = float(si_header.get('hRoiManager.scanFramePeriod', 0))
+    scan_info['scan_volume_rate'] = float(si_header.get('hRoiManager.scanVolumeRate', 0))
+    scan_info['flyback_time_per_frame'] = float(si_header.get('hScan2D.flybackTimePerFrame', 0))
+    scan_info['flyto_time_per_scan_field'] = float(si_header.get('hScan2D.flytoTimePerScanfield', 0))
+    scan_info['fov_corner_points'] = np.array(si_header.get('hScan2D.fovCornerPoints', []), dtype=float)
+    scan_info['nfovs'] = len(fovs)
+    scan_info['nframes'] = nframes
+    # Bleaching cutoff is only computed by the MATLAB ingestion (null in AcquiredTiff)
+    scan_info['nframes_good'] = None
+    scan_info['last_good_file'] = None
+    scan_info['motion_correction_enabled'] = int(bool(si_header.get('hMotionManager.enable', False)))
+    scan_info['motion_correction_mode'] = str(si_header.get('hMotionManager.correctionModeXY', 'N/A'))
+    scan_info['stacks_enabled'] = int(bool(si_header.get('hStackManager.enable', False)))
+    scan_info['stack_actuator'] = str(si_header.get('hStackManager.stackActuator', 'N/A'))
+    scan_info['stack_definition'] = str(si_header.get('hStackManager.stackDefinition', 'N/A'))
+
+    scan_info['pages_per_frame'] = pages_per_frame
+    scan_info['n_channels'] = len(channels)
+
+    return scan_info, fovs, file_frames
+
+
+fov_file_extensions = {'tiff': '.tif', 'binary': '.bin'}
+
+
+def get_fov_directory(scan_directory, fov):
+    return pathlib.Path(scan_directory, fov['tiff_split_name'])
+
+
+def get_fov_filename(scan_info, fov, file_number, output_format='tiff'):
+    return scan_info['file_name_base'] + '_' + fov['tiff_split_name'] + '_' + str(file_number).zfill(5) +\
+        fov_file_extensions[output_format]
+
+
+def get_page_views(tiff_file):
+    """
+    Memory mapped (page height x page width) view of each page of a tiff file, no data is read until views are used.
+    Returns None if pages are not uncompressed contiguous strips (pages have to be decoded).
+    """
+    page_specs = list()
+    with tifffile.TiffFile(tiff_file) as tif:
+        tif.pages.cache = False
+        byteorder = tif.byteorder
+        for page in tif.pages:
+            if not page.is_contiguous or len(page.shape) != 2 or \
+               getattr(page, 'predictor', 1) != 1 or getattr(page, 'fillorder', 1) != 1:
+                return None
+            page_specs.append((page.dataoffsets[0], page.shape, page.dtype))
+
+    file_map = np.memmap(tiff_file, dtype=np.uint8, mode='r')
+    return [np.ndarray(shape, dtype=dtype.newbyteorder(byteorder), buffer=file_map, offset=offset)
+            for offset, shape, dtype in page_specs]
+
+
+def get_page_depth_idx(scan_info, global_page):
+    # Pages are ordered by volume, depth, channel
+    return (global_page // scan_info['n_channels']) % scan_info['n_depths']
+
+
+class FovWriter:
+    """Write frames of a fov to a tiff (single contiguous series) or to a raw binary file (frames x rows x columns)."""
+
+    def __init__(self, writer, output_format='tiff'):
+        self.writer = writer
+        self.output_format = output_format
+
+    def write(self, frame):
+        if self.output_format == 'tiff':
+            self.writer.write(frame, contiguous=True)
+        else:
+            # Row range of a page is contiguous in the mapped file, written without intermediate copy
+            self.writer.write(memoryview(np.ascontiguousarray(frame)))
+
+
+@contextlib.contextmanager
+def open_fov_writer(filepath, output_format='tiff'):
+    """
+    FovWriter of a new fov file, closed when the context exits
+    """
+    if output_format == 'tiff':
+        with tifffile.TiffWriter(filepath, bigtiff=True) as writer:
+            yield FovWriter(writer, output_format)
+    else:
+        with open(filepath, 'wb') as writer:
+            yield FovWriter(writer, output_format)
+
+
+def split_fov_files(tiff_files, scan_info, fovs, file_frames, scan_directory, output_format='tiff',
+                    split_directory=None):
+    """
+    Write files of each fov (rows of the fov from pages of its depth), one file per source file.
+    Each source file is read once: uncompressed pages are memory mapped and fov rows are written from strided views,
+    compressed pages are decoded page by page.
+    Scans with a single fov are not split, fov files are the original ones.
+    Args:
+        output_format (str): 'tiff' or 'binary' (raw frames x rows x columns, dtype of the source)
+        split_directory (str): directory where fov directories are written (move_fov_files moves them to
+                               scan_directory), defaults to scan_directory
+    Returns:
+        fov_files (list): per fov list of dicts with 'tiff_split_directory' (in scan_directory), 'tiff_split_filename',
+                          'file_frame_range'
+    """
+
+    fov_files = [list() for _ in fovs]
+    if len(fovs) == 1:
+        for file_idx, tiff_file in enumerate(tiff_files):
+            fov_files[0].append(dict(tiff_split_directory=pathlib.Path(tiff_file).parent.as_posix(),
+                                     tiff_split_filename=pathlib.Path(tiff_file).name,
+                                     file_frame_range=file_frames[file_idx]['frame_range']))
+        return fov_files
+
+    if split_directory is None:
+        split_directory = scan_directory
+    for fov in fovs:
+        get_fov_directory(split_directory, fov).mkdir(parents=True, exist_ok=True)
+
+    for file_idx, tiff_file in enumerate(tiff_files):
+        fov_filepaths = [pathlib.Path(get_fov_directory(split_directory, fov),
+                                      get_fov_filename(scan_info, fov, file_idx + 1, output_format)) for fov in fovs]
+
+        page_views = get_page_views(tiff_file)
+        with contextlib.ExitStack() as writers_stack:
+            writers = [writers_stack.enter_context(open_fov_writer(x, output_format)) for x in fov_filepaths]
+            if page_views is not None:
+                for page_idx, page_view in enumerate(page_views):
+                    depth_idx = get_page_depth_idx(scan_info, file_frames[file_idx]['first_page'] + page_idx)
+                    for fov_idx, fov in enumerate(fovs):
+                        if fov['depth_idx'] == depth_idx:
+                            writers[fov_idx].write(page_view[fov['first_row']:fov['last_row'], :])
+            else:
+                with tifffile.TiffFile(tiff_file) as tif:
+                    tif.pages.cache = False
+                    for page_idx, page in enumerate(tif.pages):
+                        depth_idx = get_page_depth_idx(scan_info, file_frames[file_idx]['first_page'] + page_idx)
+                        data = page.asarray()
+                        for fov_idx, fov in enumerate(fovs):
+                            if fov['depth_idx'] == depth_idx:
+                                writers[fov_idx].write(data[fov['first_row']:fov['last_row'], :])
+        del page_views
+
+        for fov_idx, fov in enumerate(fovs):
+            fov_files[fov_idx].append(dict(tiff_split_directory=get_fov_directory(scan_directory, fov).as_posix(),
+                                           tiff_split_filename=fov_filepaths[fov_idx].name,
+                                           file_frame_range=file_frames[file_idx]['frame_range']))
+
+    return fov_files
+
+
+def move_fov_files(split_directory, scan_directory, fovs):
+    """
+    Move fov files written by split_fov_files in split_directory to their fov directories in scan_directory
+    (files of a previous split are replaced)
+    """
+    for fov in fovs:
+        fov_split_directory = get_fov_directory(split_directory, fov)
+        if not fov_split_directory.is_dir():
+            continue
+        fov_directory = get_fov_directory(scan_directory, fov)
+        fov_directory.mkdir(parents=True, exist_ok=True)
+        for fov_file in sorted(fov_split_directory.iterdir()):
+            os.replace(fov_file, pathlib.Path(fov_directory, fov_file.name))
+
+
+def get_fov_frames(tiff_files, scan_info, fov, file_frames, channel=0):
+    """
+    Frames of a fov read directly from the original (not split) scan files, without copying data
+    (views of the memory mapped files, files with compressed pages are decoded page by page).
+    Yields:
+        frame (np.array): fov rows x columns of each frame of the scan, in order
+    """
+    def is_fov_page(global_page):
+        return global_page % scan_info['n_channels'] == channel and \
+            get_page_depth_idx(scan_info, global_page) == fov['depth_idx']
+
+    for file_idx, tiff_file in enumerate(tiff_files):
+        first_page = file_frames[file_idx]['first_page']
+        page_views = get_page_views(tiff_file)
+        if page_views is not None:
+            for page_idx, page_view in enumerate(page_views):
+                if is_fov_page(first_page + page_idx):
+                    yield page_view[fov['first_row']:fov['last_row'], :]
+        else:
+            with tifffile.TiffFile(tiff_file) as tif:
+                tif.pages.cache = False
+                for page_idx, page in enumerate(tif.pages):
+                    if is_fov_page(first_page + page_idx):
+                        yield page.asarray()[fov['first_row']:fov['last_row'], :]
@@ -1,13 +1,22 @@
 
+import hashlib
 import os
+import pathlib
+import queue
 import psutil
+import re
+import select
+import stat
 import subprocess
 import sys
+import threading
+import time
 from paramiko import SSHClient, AutoAddPolicy, RSAKey
 from paramiko.auth_handler import AuthenticationException, SSHException
 from scp import SCPClient, SCPException
 
-from u19_pipeline.automatic_job.clusters_paths_and_transfers import public_key_location as public_key_location
+import u19_pipeline.automatic_job.clusters_paths_and_transfers as ft
+import u19_pipeline.utils.transfer_manifest as tm
 
 #Steps on windows machine
 #   https://thesysadminchannel.com/solved-add-windowscapability-failed-error-code-0x800f0954-rsat-fix/
@@ -27,6 +36,13 @@ from u19_pipeline.automatic_job.clusters_paths_and_transfers import public_key_l
 #   PowerShell
 #         restart-service sshd
 
+# Exit status of ssh when the connection fails
+ssh_connection_error = 255
+
+# Seconds a remote command can run before exec_command gives up on it
+remote_command_timeout = 600
+
+
 class RemoteClient:
     """Client to interact with a remote host via SSH & SCP."""
 
@@ -86,18 +102,423 @@ class RemoteClient:
         """Download folder from remote host."""
         self.scp.get(remote_path, local_path=local_path, recursive=True)
 
-
-def transfer_scp(host=None, username=None, remote_path=None, local_path=None):
-    rc = RemoteClient(host, username, public_key_location, remote_path)
+    def is_connected(self):
+        """Check if persistent connection is open."""
+        client = getattr(self, 'client', None)
+        if client is None:
+            return False
+        transport = client.get_transport()
+        return transport is not None and transport.is_active()
+
+    def connect(self):
+        """Open persistent connection (reused by exec_command, put, get and stat)."""
+        with self._get_lock():
+            if not self.is_connected():
+                self.close()
+                self.client = self.connection
+            return self.client
+
+    def reconnect(self):
+        """Close and open again persistent connection."""
+        with self._get_lock():
+            self.close()
+        return self.connect()
+
+    def close(self):
+        """Close persistent connection."""
+        sftp = getattr(self, 'sftp', None)
+        client = getattr(self, 'client', None)
+        self.sftp = None
+        self.client = None
+        try:
+            if sftp is not None:
+                sftp.close()
+            if client is not None:
+                client.close()
+        except (SSHException, EOFError, OSError):
+            pass
+
+    def _get_lock(self):
+        if getattr(self, 'lock', None) is None:
+            self.lock = threading.RLock()
+        return self.lock
+
+    def _get_sftp(self):
+        self.connect()
+        if getattr(self, 'sftp', None) is None:
+            self.sftp = self.client.open_sftp()
+        return self.sftp
+
+    def _retry_on_disconnect(self, operation):
+        # If connection was dropped (cluster timeout, network error) reconnect and try once more
+        # Only for idempotent operations: remote commands are retried with _open_channel instead
+        try:
+            return operation()
+        except (SSHException, EOFError, ConnectionError) as e:
+            print(f"Connection to {self.host} lost, reconnecting: {e}")
+            self.reconnect()
+            return operation()
+
+    def _open_channel(self, timeout=None):
+        # Opening the session channel is retried, nothing has been sent to the remote host yet
+        def operation():
+            channel = self.connect().get_transport().open_session(timeout=timeout)
+            channel.settimeout(timeout)
+            return channel
+        return self._retry_on_disconnect(operation)
+
+    def exec_command(self, command: str, timeout=remote_command_timeout):
+        """
+        Execute command in remote host, returns (returncode, stdout, stderr).
+        stdout and stderr are read together, so a command writing a lot to one of them never blocks on a full channel.
+        Command is never sent twice (e.g. sbatch would queue a duplicate job): if connection is lost after the command
+        was sent, or it does not finish in timeout seconds, returncode is 255 (as ssh) and stderr tells it is unknown
+        whether the command ran.
+        """
+        channel = self._open_channel(timeout)
+        try:
+            channel.exec_command(command)
+            stdout_data, stderr_data = self._read_channel(channel, timeout)
+            returncode = channel.recv_exit_status()
+        except TimeoutError as e:
+            error_message = f"Command on {self.host} timed out (not retried, it may still be running): {command}: {e}"
+            print(error_message)
+            return ssh_connection_error, b'', error_message.encode('UTF-8')
+        except (SSHException, EOFError, ConnectionError, OSError) as e:
+            self.close()
+            error_message = f"Connection to {self.host} lost after command was sent (not retried, it may have run): " \
+                            f"{command}: {e}"
+            print(error_message)
+            return ssh_connection_error, b'', error_message.encode('UTF-8')
+        finally:
+            channel.close()
+        return returncode, stdout_data, stderr_data
+
+    @staticmethod
+    def _read_channel(channel, timeout=None, read_size=32768):
+        # Drain stdout & stderr of a command until it exits (TimeoutError if it takes longer than timeout seconds)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        stdout_chunks = list()
+        stderr_chunks = list()
+        while True:
+            received = False
+            while channel.recv_ready():
+                stdout_chunks.append(channel.recv(read_size))
+                received = True
+            while channel.recv_stderr_ready():
+                stderr_chunks.append(channel.recv_stderr(read_size))
+                received = True
+            if received:
+                continue
+            if channel.exit_status_ready() and channel.eof_received:
+                break
+            if deadline is not None and time.monotonic() > deadline:
+                raise TimeoutError(f"command did not finish in {timeout} seconds")
+            select.select([channel], [], [], 0.1)
+        return b''.join(stdout_chunks), b''.join(stderr_chunks)
+
+    def put(self, local_path: str, remote_path: str):
+        """Upload file to remote host."""
+        def operation():
+            with self._get_lock():
+                self._get_sftp().put(local_path, remote_path)
+        self._retry_on_disconnect(operation)
+
+    def get(self, remote_path: str, local_path: str):
+        """Download file from remote host (local file is not created if remote file does not exist)."""
+        def operation():
+            with self._get_lock():
+                sftp = self._get_sftp()
+                sftp.stat(remote_path)
+                sftp.get(remote_path, local_path)
+        self._retry_on_disconnect(operation)
+
+    def stat(self, remote_path: str):
+        """Stat of file/directory in remote host, None if it does not exist."""
+        def operation():
+            with self._get_lock():
+                try:
+                    return self._get_sftp().stat(remote_path)
+                except FileNotFoundError:
+                    return None
+        return self._retry_on_disconnect(operation)
+
+    def is_dir(self, remote_path: str):
+        """Check if directory exists in remote host."""
+        remote_stat = self.stat(remote_path)
+        return remote_stat is not None and stat.S_ISDIR(remote_stat.st_mode)
+
+    def list_files(self, remote_path: str):
+        """List all files under remote directory, returns {relative path: size}."""
+        def operation():
+            with self._get_lock():
+                sftp = self._get_sftp()
+                remote_files = dict()
+                pending_dirs = ['']
+                while pending_dirs:
+                    rel_dir = pending_dirs.pop()
+                    for entry in sftp.listdir_attr(remote_path.rstrip('/') + '/' + rel_dir):
+                        rel_path = rel_dir + entry.filename
+                        if stat.S_ISDIR(entry.st_mode):
+                            pending_dirs.append(rel_path + '/')
+                        else:
+                            remote_files[rel_path] = entry.st_size
+                return remote_files
+        return self._retry_on_disconnect(operation)
+
+
+# One persistent connection per (user, host), shared by all cluster operations of the process
+_remote_clients = dict()
+_remote_clients_lock = threading.Lock()
+
+
+def get_remote_client(user, host):
+    """
+    Get persistent (already authenticated) RemoteClient for user@host from connection pool
+    """
+    with _remote_clients_lock:
+        if (user, host) not in _remote_clients:
+            _remote_clients[(user, host)] = RemoteClient(host, user, os.path.expanduser(ft.public_key_location), None)
+        remote_client = _remote_clients[(user, host)]
+    remote_client.connect()
+    return remote_client
+
+
+def close_remote_clients():
+    """
+    Close all connections of the pool
+    """
+    with _remote_clients_lock:
+        for remote_client in _remote_clients.values():
+            remote_client.close()
+        _remote_clients.clear()
+
+
+def split_remote_path(path):
+    """
+    Split scp style path "user@host:/remote/path", returns (user, host, remote_path), None if path is local
+    """
+    path = str(path)
+    if ':' not in path or '@' not in path.split(':')[0]:
+        return None
+    user_host, remote_path = path.split(':', 1)
+    user, host = user_host.split('@', 1)
+    return user, host, remote_path
+
+
+# Seconds between manifest updates while a transfer is running
+manifest_update_secs = 10
+
+# Parallel transfer settings
+transfer_streams = 4                            # Concurrent sftp connections to the rig
+transfer_chunk_size = 64 * 1024 * 1024          # Large files (e.g. .ap.bin) are read in ranges of this size
+transfer_read_block_size = 1024 * 1024          # Size of each sftp read request
+transfer_max_retries = 3                        # Retries of a chunk (with reconnection) before failing the transfer
+
+
+def get_sftp_path(remote_path):
+    """
+    Windows like directory (C:\\dir\\subdir) to sftp path (/C:/dir/subdir)
+    """
+    sftp_path = str(remote_path).replace('\\', '/')
+    if re.match('^[A-Za-z]:', sftp_path):
+        sftp_path = '/' + sftp_path
+    return sftp_path
+
+
+def get_transfer_source(host, username, remote_path):
+    return username + '@' + host + ':' + str(remote_path)
+
+
+def get_transfer_destination(remote_path, local_path):
+    """
+    Local directory where remote directory is copied (recursive copy creates remote directory inside local_path)
+    """
+    return pathlib.Path(local_path, pathlib.PurePosixPath(get_sftp_path(remote_path)).name)
+
+
+def watch_transfer(manifest, watcher, stop_event):
+    """
+    Update manifest with files received (run in a thread while transfer is in progress)
+    """
+    while not stop_event.is_set():
+        if manifest.update_from_watcher(watcher):
+            manifest.save()
+        stop_event.wait(manifest_update_secs)
+
+
+def transfer_chunk(sftp, remote_file, local_file, offset, length):
+    """
+    Copy range [offset, offset+length) of remote file into the same range of local file (already created)
+    Data is not read back after writing: transfers are checked by size (TransferManifest.verify), chunk checksums are
+    only compared with the local file by TransferManifest.verify(checksums=True)
+    Returns:
+        checksum (str): checksum of the data received for the chunk
+    """
+    chunk_hash = hashlib.new(tm.CHECKSUM_ALGORITHM)
+    read_ranges = [(x, min(transfer_read_block_size, offset + length - x))
+                   for x in range(offset, offset + length, transfer_read_block_size)]
+    with sftp.open(remote_file, 'rb') as rf, open(local_file, 'r+b') as lf:
+        lf.seek(offset)
+        # readv pipelines all read requests of the chunk
+        for data in rf.readv(read_ranges):
+            chunk_hash.update(data)
+            lf.write(data)
+
+    return chunk_hash.hexdigest()
+
+
+def transfer_worker(remote_client, sftp_path, destination, manifest, work_queue, errors):
+    """
+    Transfer chunks from work_queue until it is empty, each worker has its own connection to the rig
+    """
+    while not errors:
+        try:
+            rel_path, chunk_idx, offset, length = work_queue.get_nowait()
+        except queue.Empty:
+            return
+        remote_file = sftp_path.rstrip('/') + '/' + rel_path
+        local_file = pathlib.Path(destination, rel_path).as_posix()
+
+        for attempt in range(transfer_max_retries + 1):
+            try:
+                with remote_client._get_lock():
+                    checksum = transfer_chunk(remote_client._get_sftp(), remote_file, local_file, offset, length)
+                break
+            except (SSHException, EOFError, OSError) as e:
+                print(f"Chunk {chunk_idx} of {rel_path} failed (attempt {attempt + 1}): {e}")
+                if attempt == transfer_max_retries:
+                    errors.append(f"{rel_path} chunk {chunk_idx}: {e}")
+                    return
+                try:
+                    remote_client.reconnect()
+                except (SSHException, OSError) as e:
+                    print(f"Reconnection to {remote_client.host} failed: {e}")
+
+        manifest.mark_chunk_done(rel_path, chunk_idx, length, checksum)
+
+
+def transfer_parallel(host, username, remote_path, manifest, n_streams=transfer_streams):
+    """
+    Copy files listed in manifest with n_streams concurrent sftp connections.
+    Files are split in chunks (ranged reads), chunks already received in a previous attempt are skipped.
+    """
+    sftp_path = get_sftp_path(remote_path)
+    destination = manifest.destination
+
+    work_queue = queue.Queue()
+    for rel_path in sorted(manifest.files, key=lambda x: -manifest.files[x]['size']):
+        this_file = manifest.files[rel_path]
+        local_file = pathlib.Path(destination, rel_path)
+        local_file.parent.mkdir(parents=True, exist_ok=True)
+        # Chunks received in a previous attempt are only kept if they are still in the same local file
+        if not local_file.exists() or os.stat(local_file).st_size != this_file['size'] or\
+           tm.get_local_file_id(local_file) != this_file.get('local_id', None):
+            manifest.reset_file(rel_path)
+        # Local file created with its final size, so chunks can be written in any order
+        if not local_file.exists():
+            local_file.touch()
+        if os.stat(local_file).st_size != this_file['size']:
+            os.truncate(local_file, this_file['size'])
+        this_file['local_id'] = tm.get_local_file_id(local_file)
+        # Inodes are reused, data of chunks already received is checked against their checksums too
+        dropped_chunks = manifest.drop_invalid_chunks(rel_path)
+        if dropped_chunks:
+            print('Chunks of', rel_path, 'not matching the ones received', dropped_chunks)
+        for chunk_idx, offset, length in manifest.set_chunks(rel_path, transfer_chunk_size):
+            work_queue.put((rel_path, chunk_idx, offset, length))
+    manifest.save()
+    print('Chunks to transfer', work_queue.qsize())
+
+    errors = list()
+    workers = list()
+    remote_clients = list()
+    for _ in range(min(n_streams, max(work_queue.qsize(), 1))):
+        remote_client = RemoteClient(host, username, os.path.expanduser(ft.public_key_location), remote_path)
+        remote_clients.append(remote_client)
+        worker = threading.Thread(target=transfer_worker,
+                                  args=(remote_client, sftp_path, destination, manifest, work_queue, errors), daemon=True)
+        worker.start()
+        workers.append(worker)
+
+    # Save progress periodically, so a new attempt resumes from last chunks received
+    for worker in workers:
+        while worker.is_alive():
+            worker.join(manifest_update_secs)
+            manifest.save()
+    manifest.save()
+
+    for remote_client in remote_clients:
+        remote_client.close()
+
+    if errors:
+        raise SCPException('Transfer failed: ' + '; '.join(errors))
+
+
+def transfer_scp_recursive(rc, manifest, remote_path, local_path):
+    """
+    Copy remote directory with a single scp stream (when files of remote directory could not be listed)
+    """
+    watcher = tm.DirectoryWatcher(manifest.destination)
+    stop_event = threading.Event()
+    watch_thread = threading.Thread(target=watch_transfer, args=(manifest, watcher, stop_event), daemon=True)
+    watch_thread.start()
+
+    try:
+        rc.scp
+        rc.download_folder(remote_path=remote_path, local_path=local_path)
+    finally:
+        stop_event.set()
+        watch_thread.join()
+        manifest.update_from_watcher(watcher)
+        watcher.close()
+
+
+def transfer_scp(host=None, username=None, remote_path=None, local_path=None, n_streams=transfer_streams):
+    """
+    Copy remote directory to local_path, progress of the transfer is written in a TransferManifest.
+    If the transfer is started again after a failure it resumes from the manifest.
+    """
+    rc = RemoteClient(host, username, ft.public_key_location, remote_path)
     print(host)
     print(username)
-    print(public_key_location)
+    print(ft.public_key_location)
     print(remote_path)
     print(local_path)
     rc._get_ssh_key()
-    rc.scp
-    rc.download_folder(remote_path=remote_path, local_path=local_path)
-    rc.disconnect()
+
+    destination = get_transfer_destination(remote_path, local_path)
+    destination.mkdir(parents=True, exist_ok=True)
+    manifest = tm.TransferManifest.load(get_transfer_source(host, username, remote_path), destination)
+    if manifest is None:
+        manifest = tm.TransferManifest(get_transfer_source(host, username, remote_path), destination)
+
+    # Expected file list from source, if it cannot be listed completion is given by scp only
+    try:
+        expected_files = rc.list_files(get_sftp_path(remote_path))
+    except (SSHException, OSError) as e:
+        print('Could not list files of remote directory', e)
+        expected_files = None
+    rc.close()
+    manifest.start(expected_files)
+
+    try:
+        if expected_files is None:
+            transfer_scp_recursive(rc, manifest, remote_path, local_path)
+        else:
+            transfer_parallel(host, username, remote_path, manifest, n_streams)
+    except Exception as e:
+        manifest.fail(e)
+        rc.close()
+        raise
+    rc.close()
+
+    # Local files have to match sizes and checksums of the data received
+    verified, message = manifest.verify(checksums=True)
+    if not verified:
+        manifest.fail(message)
+        raise SCPException(message)
+    manifest.complete()
 
 def call_scp_background(ip_address=None, system_user=None, recording_system_directory=None, data_directory=None):
 
@@ -141,6 +562,19 @@ def check_scp_transfer(pid):
 
     return finished, exit_code
 
+
+def check_transfer(host, username, remote_path, local_path, pid):
+    """
+    Check transfer requested with call_scp_background, from its manifest if there is one, from its pid otherwise
+    Returns:
+        is_finished (bool), exit_code (int): exit_code 0 if transfer succeeded
+    """
+    destination = get_transfer_destination(remote_path, local_path)
+    is_finished, exit_code = tm.get_transfer_state(get_transfer_source(host, username, remote_path), destination, pid)
+    if is_finished is None:
+        is_finished, exit_code = check_scp_transfer(pid)
+    return is_finished, exit_code
+
 def check_directory_copied_correctly():
     pass
     # diff -r -q /path/to/dir1 /path/to/dir2
@@ -0,0 +1,232 @@
+"""
+Small on-disk index of SpikeGLX .meta files.
+
+Every entry is keyed by the meta file path and validated with its mtime and size, so a file that
+changes on disk is reparsed automatically. Each entry stores the parsed meta dictionary (same as
+readSGLX.readMeta) and the derived file geometry (sampling rate, channel counts, # of samples ...).
+Directory searches for meta files (rglob) are indexed as well, validated with the mtime of every
+directory visited during the search.
+
+Cache location: dj.config['custom']['spikeglx_meta_cache_dir'] (defaults to ~/.cache/u19_pipeline/spikeglx_meta)
+"""
+
+import hashlib
+import json
+import os
+import pathlib
+
+import datajoint as dj
+
+import u19_pipeline.utils.DemoReadSGLXData.readSGLX as readSGLX
+
+CACHE_VERSION = 1
+
+# In process copy of the index, avoids reading the cache files more than once per process
+_memory_cache = dict()
+
+
+def get_cache_dir():
+    """
+    Get (and create) directory where cached meta entries are stored
+    """
+    cache_dir = dj.config.get('custom', {}).get('spikeglx_meta_cache_dir', None)
+    if not cache_dir:
+        cache_dir = pathlib.Path(pathlib.Path.home(), '.cache', 'u19_pipeline', 'spikeglx_meta')
+    cache_dir = pathlib.Path(cache_dir)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    return cache_dir
+
+
+def get_meta_path(bin_full_path):
+    """
+    Meta file path that corresponds to a bin (or meta) file path (same rule as readSGLX.readMeta)
+    """
+    bin_full_path = pathlib.Path(bin_full_path)
+    return pathlib.Path(bin_full_path.parent, bin_full_path.stem + '.meta')
+
+
+def _get_cache_file(cache_type, cache_id):
+    cache_hash = hashlib.sha1(cache_id.encode('utf-8')).hexdigest()
+    return pathlib.Path(get_cache_dir(), cache_type + '_' + cache_hash + '.json')
+
+
+def _read_cache_file(cache_file):
+    try:
+        with open(cache_file) as f:
+            entry = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if entry.get('cache_version', None) != CACHE_VERSION:
+        return None
+    return entry
+
+
+def _write_cache_file(cache_file, entry):
+    # Write to temporary file and rename, so concurrent populate workers never read half written entries
+    # Cache is only an optimization, if it can't be written just continue
+    tmp_file = cache_file.with_suffix('.' + str(os.getpid()) + '.tmp')
+    try:
+        with open(tmp_file, 'w') as f:
+            json.dump(entry, f)
+        os.replace(tmp_file, cache_file)
+    except OSError as e:
+        print('Could not write spikeglx meta cache file', cache_file, e)
+
+
+def get_file_geometry(meta):
+    """
+    Derive sampling rate, channel counts and file geometry from a parsed meta dictionary
+    Args:
+        meta (dict): dictionary from readSGLX.readMeta
+    Returns:
+        geometry (dict): sampling_rate, n_saved_chans, n_chans_per_type, file_size_bytes, n_file_samples,
+                         file_time_secs, stream_type, probe_serial_number
+    """
+
+    stream_type = meta.get('typeThis', None)
+    sampling_rate = readSGLX.SampRate(meta) if stream_type is not None else None
+    n_saved_chans = int(meta['nSavedChans']) if 'nSavedChans' in meta else None
+    file_size_bytes = int(meta['fileSizeBytes']) if 'fileSizeBytes' in meta else None
+
+    n_file_samples = None
+    if n_saved_chans and file_size_bytes is not None:
+        n_file_samples = int(file_size_bytes / (2 * n_saved_chans))
+
+    # Channel counts by type, e.g. nidq: MN,MA,XA,DW / imec: AP,LF,SY / obx: XA,DW,SY
+    if stream_type == 'imec':
+        n_chans_per_type = meta.get('snsApLfSy', None)
+    elif stream_type == 'nidq':
+        n_chans_per_type = meta.get('snsMnMaXaDw', None)
+    elif stream_type == 'obx':
+        n_chans_per_type = meta.get('snsXaDwSy', None)
+    else:
+        n_chans_per_type = None
+    if n_chans_per_type is not None:
+        n_chans_per_type = [int(x) for x in n_chans_per_type.split(sep=',')]
+
+    geometry = dict()
+    geometry['stream_type'] = stream_type
+    geometry['sampling_rate'] = sampling_rate
+    geometry['n_saved_chans'] = n_saved_chans
+    geometry['n_chans_per_type'] = n_chans_per_type
+    geometry['file_size_bytes'] = file_size_bytes
+    geometry['n_file_samples'] = n_file_samples
+    geometry['file_time_secs'] = float(meta['fileTimeSecs']) if 'fileTimeSecs' in meta else None
+    geometry['probe_serial_number'] = meta.get('imProbeSN', meta.get('imDatPrb_sn', None))
+
+    return geometry
+
+
+def get_meta_entry(bin_full_path):
+    """
+    Get cached entry (meta dictionary + file geometry) for a SpikeGLX bin (or meta) file.
+    Meta file is only parsed if it is not in the index or if its mtime/size changed.
+    Args:
+        bin_full_path (str or Path): path of the .bin file (or the .meta file itself)
+    Returns:
+        entry (dict): {'meta_path', 'mtime_ns', 'size', 'meta', 'geometry'}, None if no meta file was found
+    """
+
+    meta_path = get_meta_path(bin_full_path)
+    try:
+        meta_stat = os.stat(meta_path)
+    except FileNotFoundError:
+        print("no meta file")
+        return None
+
+    meta_id = meta_path.as_posix()
+    memory_key = ('meta', meta_id, meta_stat.st_mtime_ns, meta_stat.st_size)
+    if memory_key in _memory_cache:
+        return _memory_cache[memory_key]
+
+    cache_file = _get_cache_file('meta', meta_id)
+    entry = _read_cache_file(cache_file)
+    if entry is None or entry['meta_path'] != meta_id or \
+       entry['mtime_ns'] != meta_stat.st_mtime_ns or entry['size'] != meta_stat.st_size:
+
+        meta = readSGLX.readMeta(meta_path)
+        entry = dict()
+        entry['cache_version'] = CACHE_VERSION
+        entry['meta_path'] = meta_id
+        entry['mtime_ns'] = meta_stat.st_mtime_ns
+        entry['size'] = meta_stat.st_size
+        entry['meta'] = meta
+        entry['geometry'] = get_file_geometry(meta)
+        _write_cache_file(cache_file, entry)
+
+    _memory_cache[memory_key] = entry
+    return entry
+
+
+def read_meta(bin_full_path):
+    """
+    Drop-in replacement of readSGLX.readMeta that consults the index first
+    """
+    entry = get_meta_entry(bin_full_path)
+    if entry is None:
+        return dict()
+    # Copy so callers can't modify the cached entry
+    return dict(entry['meta'])
+
+
+def read_meta_geometry(bin_full_path):
+    """
+    Get parsed meta dictionary and derived file geometry (see get_file_geometry) of a SpikeGLX file
+    """
+    entry = get_meta_entry(bin_full_path)
+    if entry is None:
+        return dict(), get_file_geometry(dict())
+    return dict(entry['meta']), dict(entry['geometry'])
+
+
+def _directories_unchanged(dir_mtimes):
+    for this_dir, this_mtime in dir_mtimes.items():
+        try:
+            if os.stat(this_dir).st_mtime_ns != this_mtime:
+                return False
+        except FileNotFoundError:
+            return False
+    return True
+
+
+def find_meta_files(directory, pattern='*.ap.meta'):
+    """
+    Cached version of sorted(pathlib.Path(directory).rglob(pattern)).
+    Result is reused while none of the directories visited during the search changed (mtime),
+    adding/removing a file or subdirectory anywhere in the tree invalidates it.
+    """
+
+    directory = pathlib.Path(directory)
+    search_id = directory.as_posix() + '|' + pattern
+
+    memory_key = ('search', search_id)
+    entry = _memory_cache.get(memory_key)
+    if entry is None:
+        cache_file = _get_cache_file('search', search_id)
+        entry = _read_cache_file(cache_file)
+        if entry is not None and entry['search_id'] != search_id:
+            entry = None
+    else:
+        cache_file = None
+
+    if entry is not None and _directories_unchanged(entry['dir_mtimes']):
+        _memory_cache[memory_key] = entry
+        return [pathlib.Path(x) for x in entry['files']]
+
+    # Stat directories before listing, so a change during the search invalidates the entry next time
+    dir_mtimes = dict()
+    for this_dir, _, _ in os.walk(directory):
+        dir_mtimes[pathlib.Path(this_dir).as_posix()] = os.stat(this_dir).st_mtime_ns
+    files = sorted(directory.rglob(pattern))
+
+    entry = dict()
+    entry['cache_version'] = CACHE_VERSION
+    entry['search_id'] = search_id
+    entry['dir_mtimes'] = dir_mtimes
+    entry['files'] = [x.as_posix() for x in files]
+    if cache_file is None:
+        cache_file = _get_cache_file('search', search_id)
+    _write_cache_file(cache_file, entry)
+
+    _memory_cache[memory_key] = entry
+    return files
@@ -0,0 +1,183 @@
+"""
+Chunked, compressed storage of the activity traces (meso.Trace) of all ROIs of a segmentation in one HDF5 file.
+
+Each trace attribute is a ROI x frame float32 dataset, chunked in blocks of roi_chunk_size ROIs x frame_chunk_size
+frames, so any window of ROIs and frames is read without reading (or fetching from the database) whole traces.
+Per ROI values (baselines, noise, ...) are stored as 1 dimensional (or ROI x n) datasets.
+"""
+
+import pathlib
+
+import datajoint as dj
+import h5py
+import numpy as np
+
+trace_attributes = ['f_roi_raw', 'f_roi', 'f_surround_raw', 'dff_roi', 'dff_roi_uncorrected', 'spiking']
+roi_attributes = ['f0_roi_raw', 'f0_roi', 'time_constants', 'init_concentration', 'noise']
+
+roi_chunk_size = 64
+frame_chunk_size = 4096
+# ROIs fetched and written at once when filling a trace store (256 ROIs x 100k frames float32 = 100 MB)
+write_roi_block_size = 4 * roi_chunk_size
+compression = 'gzip'
+compression_level = 4
+
+
+def get_trace_store_root():
+    """
+    Root directory of trace store files: dj.config['custom']['trace_store_dir']
+    """
+    trace_store_dir = dj.config.get('custom', {}).get('trace_store_dir', None)
+    if not trace_store_dir:
+        raise ValueError("Trace store directory not configured (dj.config['custom']['trace_store_dir'])")
+    return pathlib.Path(trace_store_dir)
+
+
+def get_trace_store_filename(key):
+    """
+    File path (relative to trace store root) of the traces of a segmentation
+    """
+    return dj.hash.key_hash(key) + '.h5'
+
+
+class TraceStoreWriter:
+    """Write traces of a segmentation by attribute and blocks of ROIs, without holding all traces in memory."""
+
+    def __init__(self, filepath, roi_idx):
+        """
+        Args:
+            filepath (str): HDF5 file to create (overwritten if it exists, only visible when writer is closed)
+            roi_idx (np.array): index of each ROI (rows of all datasets), sorted
+        """
+        self.filepath = pathlib.Path(filepath)
+        self.filepath.parent.mkdir(parents=True, exist_ok=True)
+        self.tmp_filepath = self.filepath.with_suffix('.h5.tmp')
+        self.file = h5py.File(self.tmp_filepath, 'w')
+        self.roi_idx = np.asarray(roi_idx)
+        self.file.create_dataset('roi_idx', data=self.roi_idx)
+
+    @property
+    def n_frames(self):
+        if trace_attributes[0] not in self.file:
+            return None
+        return self.file[trace_attributes[0]].shape[1]
+
+    def write_traces(self, attribute, first_row, values):
+        """
+        Write rows [first_row, first_row + len(values)) of a trace attribute (dataset is created on first write)
+        """
+        values = np.asarray(values, dtype=np.float32)
+        if attribute not in self.file:
+            shape = (len(self.roi_idx), values.shape[1])
+            chunks = (max(min(roi_chunk_size, shape[0]), 1), max(min(frame_chunk_size, shape[1]), 1))
+            self.file.create_dataset(attribute, shape=shape, dtype=np.float32, chunks=chunks, compression=compression,
+                                     compression_opts=compression_level, shuffle=True)
+        self.file[attribute][first_row:first_row + values.shape[0], :] = values
+
+    def write_roi_values(self, attribute, values):
+        self.file.create_dataset(attribute, data=np.asarray(values))
+
+    def close(self):
+        # File is only visible when completely written
+        self.file.close()
+        self.tmp_filepath.replace(self.filepath)
+
+    def abort(self):
+        self.file.close()
+        self.tmp_filepath.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *args):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def write_trace_store(filepath, roi_idx, traces, roi_values):
+    """
+    Write traces of a segmentation
+    Args:
+        filepath (str): HDF5 file to create (overwritten if it exists)
+        roi_idx (np.array): index of each ROI (rows of all datasets), sorted
+        traces (dict): {trace attribute: ROI x frame array}
+        roi_values (dict): {roi attribute: array with one value (or row) per ROI}
+    """
+    with TraceStoreWriter(filepath, roi_idx) as writer:
+        for attribute, values in traces.items():
+            writer.write_traces(attribute, 0, values)
+        for attribute, values in roi_values.items():
+            writer.write_roi_values(attribute, values)
+
+
+class TraceStoreReader:
+    """Lazy access to ROI and frame windows of the traces of a segmentation."""
+
+    def __init__(self, filepath):
+        self.filepath = pathlib.Path(filepath)
+        self.file = h5py.File(self.filepath, 'r')
+        self.roi_idx = self.file['roi_idx'][()]
+
+    @property
+    def n_rois(self):
+        return len(self.roi_idx)
+
+    @property
+    def n_frames(self):
+        return self.file[trace_attributes[0]].shape[1]
+
+    def get_roi_positions(self, roi_idx):
+        """
+        Rows of the datasets for roi_idx values
+        """
+        roi_idx = np.atleast_1d(roi_idx)
+        positions = np.searchsorted(self.roi_idx, roi_idx)
+        if np.any(positions >= self.n_rois) or np.any(self.roi_idx[np.minimum(positions, self.n_rois - 1)] != roi_idx):
+            raise KeyError('roi_idx not found in trace store: ' + str(roi_idx))
+        return positions
+
+    def read_rows(self, dataset, roi_idx, frames):
+        if roi_idx is None:
+            return dataset[:, frames] if frames is not None else dataset[()]
+
+        positions = self.get_roi_positions(roi_idx)
+        # HDF5 selections have to be increasing, read sorted unique rows and reorder
+        unique_positions, inverse = np.unique(positions, return_inverse=True)
+        if frames is None:
+            values = dataset[unique_positions, ...]
+        else:
+            values = dataset[unique_positions, frames]
+        return values[inverse]
+
+    def get(self, attribute, roi_idx=None, frames=None):
+        """
+        Read a window of a trace attribute
+        Args:
+            attribute (str): one of trace_attributes
+            roi_idx (int|list): roi_idx values of the ROIs to read (all if None)
+            frames (slice): frames to read (all if None)
+        Returns:
+            traces (np.array): ROI x frame float32 array
+        """
+        if attribute not in trace_attributes:
+            raise ValueError('Not a trace attribute: ' + attribute)
+        return self.read_rows(self.file[attribute], roi_idx, frames)
+
+    def get_roi_values(self, attribute, roi_idx=None):
+        """
+        Read per ROI values (one of roi_attributes)
+        """
+        if attribute not in roi_attributes:
+            raise ValueError('Not a roi attribute: ' + attribute)
+        return self.read_rows(self.file[attribute], roi_idx, None)
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,503 @@
+"""
+Track progress of recording transfers (rig -> PNI) with a manifest file.
+
+The transfer process writes a manifest with the expected file list (relative path & size from the source),
+the size received so far and checksum of each file, and the state of the transfer (in_progress, completed, failed).
+Completion checks read the manifest and stat only the files listed in it, instead of measuring the whole
+destination directory (du).
+Received sizes are updated from a DirectoryWatcher on the destination directory
+(inotify on linux, polling of the directory as fallback).
+
+Manifest location: dj.config['custom']['transfer_manifest_dir'] (defaults to ~/.cache/u19_pipeline/transfer_manifests)
+"""
+
+import ctypes
+import ctypes.util
+import hashlib
+import json
+import os
+import pathlib
+import select
+import struct
+import sys
+import threading
+import time
+
+import datajoint as dj
+
+MANIFEST_VERSION = 1
+
+STATE_IN_PROGRESS = 'in_progress'
+STATE_COMPLETED = 'completed'
+STATE_FAILED = 'failed'
+
+CHECKSUM_ALGORITHM = 'md5'
+CHECKSUM_BLOCK_SIZE = 8 * 1024 * 1024
+
+
+def get_manifest_dir():
+    """
+    Get (and create) directory where transfer manifests are stored
+    """
+    manifest_dir = dj.config.get('custom', {}).get('transfer_manifest_dir', None)
+    if not manifest_dir:
+        manifest_dir = pathlib.Path(pathlib.Path.home(), '.cache', 'u19_pipeline', 'transfer_manifests')
+    manifest_dir = pathlib.Path(manifest_dir)
+    manifest_dir.mkdir(parents=True, exist_ok=True)
+    return manifest_dir
+
+
+def get_manifest_path(source, destination):
+    """
+    Manifest file of the transfer of source (e.g. user@host:/path) to local destination directory
+    """
+    transfer_id = str(source) + '|' + pathlib.Path(destination).as_posix()
+    transfer_hash = hashlib.sha1(transfer_id.encode('utf-8')).hexdigest()
+    return pathlib.Path(get_manifest_dir(), 'transfer_' + transfer_hash + '.json')
+
+
+def get_file_checksum(filepath):
+    """
+    Checksum (CHECKSUM_ALGORITHM) of a local file
+    """
+    file_hash = hashlib.new(CHECKSUM_ALGORITHM)
+    with open(filepath, 'rb') as f:
+        for block in iter(lambda: f.read(CHECKSUM_BLOCK_SIZE), b''):
+            file_hash.update(block)
+    return file_hash.hexdigest()
+
+
+def get_file_chunk_checksums(filepath, chunk_size):
+    """
+    Checksum (CHECKSUM_ALGORITHM) of each chunk of chunk_size bytes of a local file, {chunk index (str): checksum}
+    """
+    chunk_checksums = dict()
+    with open(filepath, 'rb') as f:
+        for chunk_idx, chunk in enumerate(iter(lambda: f.read(chunk_size), b'')):
+            chunk_checksums[str(chunk_idx)] = hashlib.new(CHECKSUM_ALGORITHM, chunk).hexdigest()
+    return chunk_checksums
+
+
+def get_local_file_id(filepath):
+    """
+    Identity of a local file ([device, inode]), changes if the file is deleted and created again
+    """
+    file_stat = os.stat(filepath)
+    return [file_stat.st_dev, file_stat.st_ino]
+
+
+def is_process_alive(pid):
+    """
+    Check if process pid is still running (local machine)
+    """
+    if pid is None:
+        return False
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class TransferManifest:
+    """Manifest of a transfer (file list, sizes, checksums & state)."""
+
+    def __init__(self, source, destination):
+        self.source = str(source)
+        self.destination = pathlib.Path(destination)
+        self.manifest_path = get_manifest_path(self.source, self.destination)
+        self.state = STATE_IN_PROGRESS
+        self.pid = None
+        self.error = None
+        self.started = None
+        self.updated = None
+        # {relative path: {'size': expected size, 'received': bytes received, 'checksum': checksum of received file}}
+        # Files transferred in chunks also have 'chunk_size', 'chunks' ({chunk index: checksum} of chunks received)
+        # and 'local_id' (get_local_file_id of the local file chunks were written to)
+        self.files = dict()
+        # Manifest is updated by all transfer threads
+        self.lock = threading.RLock()
+
+    @classmethod
+    def load(cls, source, destination):
+        """
+        Read manifest of a transfer, None if there is no (valid) manifest
+        """
+        manifest = cls(source, destination)
+        try:
+            with open(manifest.manifest_path) as f:
+                manifest_dict = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if manifest_dict.get('manifest_version', None) != MANIFEST_VERSION:
+            return None
+
+        manifest.state = manifest_dict['state']
+        manifest.pid = manifest_dict['pid']
+        manifest.error = manifest_dict['error']
+        manifest.started = manifest_dict['started']
+        manifest.updated = manifest_dict['updated']
+        manifest.files = manifest_dict['files']
+        return manifest
+
+    def save(self):
+        """
+        Write manifest (to temporary file and rename, so readers never see half written manifests)
+        """
+        with self.lock:
+            self._save()
+
+    def _save(self):
+        self.updated = time.time()
+        manifest_dict = dict()
+        manifest_dict['manifest_version'] = MANIFEST_VERSION
+        manifest_dict['source'] = self.source
+        manifest_dict['destination'] = self.destination.as_posix()
+        manifest_dict['state'] = self.state
+        manifest_dict['pid'] = self.pid
+        manifest_dict['error'] = self.error
+        manifest_dict['started'] = self.started
+        manifest_dict['updated'] = self.updated
+        manifest_dict['files'] = self.files
+
+        tmp_path = self.manifest_path.with_suffix('.' + str(os.getpid()) + '.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest_dict, f)
+        os.replace(tmp_path, self.manifest_path)
+
+    def start(self, expected_files=None, pid=None):
+        """
+        Start (or restart) transfer
+        Args:
+            expected_files (dict): {relative path: size} of files in source, None if unknown
+            pid (int): process doing the transfer (defaults to current process)
+        """
+        self.state = STATE_IN_PROGRESS
+        self.error = None
+        self.pid = os.getpid() if pid is None else pid
+        self.started = time.time()
+        if expected_files is not None:
+            old_files = self.files
+            self.files = dict()
+            for rel_path, size in expected_files.items():
+                self.files[rel_path] = {'size': size, 'received': 0, 'checksum': None}
+                # Keep progress of files from previous attempts
+                if rel_path in old_files and old_files[rel_path]['size'] == size:
+                    self.files[rel_path] = old_files[rel_path]
+        self.save()
+
+    def update_file(self, rel_path, received, checksum=None):
+        """
+        Update bytes received (and checksum if file is complete) of a file
+        """
+        if rel_path not in self.files:
+            # File not listed in source (list unknown), its size is the received one
+            self.files[rel_path] = {'size': None, 'received': received, 'checksum': None}
+        self.files[rel_path]['received'] = received
+        if checksum is not None:
+            self.files[rel_path]['checksum'] = checksum
+
+    def set_chunks(self, rel_path, chunk_size):
+        """
+        Split file in chunks of chunk_size bytes (chunks already received are kept if chunk size did not change)
+        Returns:
+            pending_chunks (list): (chunk index, offset, length) of chunks not received yet
+        """
+        with self.lock:
+            this_file = self.files[rel_path]
+            if this_file.get('chunk_size', None) != chunk_size:
+                this_file['chunk_size'] = chunk_size
+                this_file['chunks'] = dict()
+                this_file['received'] = 0
+                this_file['checksum'] = None
+
+            pending_chunks = list()
+            for offset in range(0, max(this_file['size'], 1), chunk_size):
+                chunk_idx = offset // chunk_size
+                if str(chunk_idx) not in this_file['chunks']:
+                    pending_chunks.append((chunk_idx, offset, min(chunk_size, this_file['size'] - offset)))
+            return pending_chunks
+
+    def reset_file(self, rel_path):
+        """
+        Forget progress of a file (local file missing or created again, chunks received are not in it anymore)
+        """
+        with self.lock:
+            this_file = self.files[rel_path]
+            for field in ['chunk_size', 'chunks', 'local_id']:
+                this_file.pop(field, None)
+            this_file['received'] = 0
+            this_file['checksum'] = None
+
+    def drop_invalid_chunks(self, rel_path):
+        """
+        Forget chunks received whose data in the local file does not match their checksum anymore
+        (local file created again with the same inode, or changed by another process)
+        Returns:
+            dropped_chunks (int): number of chunks to be transferred again
+        """
+        with self.lock:
+            this_file = self.files[rel_path]
+            if not this_file.get('chunks', None) or not this_file['size']:
+                return 0
+            chunk_size = this_file['chunk_size']
+            local_chunks = get_file_chunk_checksums(pathlib.Path(self.destination, rel_path), chunk_size)
+            dropped_chunks = 0
+            for chunk_idx, checksum in list(this_file['chunks'].items()):
+                if local_chunks.get(chunk_idx, None) == checksum:
+                    continue
+                del this_file['chunks'][chunk_idx]
+                this_file['received'] -= min(chunk_size, this_file['size'] - int(chunk_idx) * chunk_size)
+                this_file['checksum'] = None
+                dropped_chunks += 1
+            return dropped_chunks
+
+    def mark_chunk_done(self, rel_path, chunk_idx, length, checksum):
+        """
+        Record chunk of file received (file checksum is the chunk one for files of a single chunk)
+        """
+        with self.lock:
+            this_file = self.files[rel_path]
+            this_file['chunks'][str(chunk_idx)] = checksum
+            this_file['received'] += length
+            if this_file['chunk_size'] >= this_file['size']:
+                this_file['checksum'] = checksum
+
+    def is_file_complete(self, rel_path):
+        this_file = self.files[rel_path]
+        return this_file['size'] is not None and this_file['received'] == this_file['size']
+
+    def complete(self):
+        """
+        Mark transfer as completed (sizes of all files are taken from destination)
+        """
+        for rel_path in self.files:
+            if self.files[rel_path]['size'] is None:
+                self.files[rel_path]['size'] = self.files[rel_path]['received']
+        self.state = STATE_COMPLETED
+        self.save()
+
+    def fail(self, error):
+        """
+        Mark transfer as failed
+        """
+        self.state = STATE_FAILED
+        self.error = str(error)
+        self.save()
+
+    def get_progress(self):
+        """
+        Bytes received and expected of the whole transfer (expected is None if file list is unknown)
+        """
+        received = sum([x['received'] for x in self.files.values()])
+        sizes = [x['size'] for x in self.files.values()]
+        expected = None if None in sizes else sum(sizes)
+        return received, expected
+
+    def verify(self, checksums=False):
+        """
+        Check all files of the manifest are in destination with the expected size
+        (and, if checksums, that local files match checksums of data received, chunk by chunk for chunked files)
+        Returns:
+            verified (bool), message (str)
+        """
+        for rel_path, this_file in self.files.items():
+            filepath = pathlib.Path(self.destination, rel_path)
+            try:
+                size = os.stat(filepath).st_size
+            except FileNotFoundError:
+                return False, 'File not found in destination: ' + rel_path
+            if this_file['size'] is not None and size != this_file['size']:
+                return False, 'Size of file different than source: ' + rel_path
+            if not checksums:
+                continue
+            if len(this_file.get('chunks', dict())) > 1:
+                local_chunks = get_file_chunk_checksums(filepath, this_file['chunk_size'])
+                if any(local_chunks.get(x, None) != checksum for x, checksum in this_file['chunks'].items()):
+                    return False, 'Checksum of file chunk different than transferred one: ' + rel_path
+            elif this_file['checksum'] is not None and get_file_checksum(filepath) != this_file['checksum']:
+                return False, 'Checksum of file different than transferred one: ' + rel_path
+        return True, ''
+
+    def update_from_watcher(self, watcher, compute_checksums=True):
+        """
+        Update received sizes with changes detected by a DirectoryWatcher on the destination directory.
+        Checksum of a file is computed once it reaches the expected size.
+        Returns:
+            changed (bool): if some file changed
+        """
+        changes = watcher.get_changes()
+        for rel_path, size in changes.items():
+            checksum = None
+            expected_size = self.files.get(rel_path, {}).get('size', None)
+            if compute_checksums and expected_size is not None and size == expected_size and\
+               self.files[rel_path]['checksum'] is None:
+                checksum = get_file_checksum(pathlib.Path(self.destination, rel_path))
+            self.update_file(rel_path, size, checksum)
+        return len(changes) > 0
+
+
+def get_transfer_state(source, destination, pid=None):
+    """
+    Get state of a transfer from its manifest
+    Returns:
+        is_finished (bool), exit_code (int): same as scp_transfers.check_scp_transfer (exit_code 0 if succeeded)
+        None, None if there is no manifest for the transfer (or it is from another transfer process than pid)
+    """
+    manifest = TransferManifest.load(source, destination)
+    if manifest is None:
+        return None, None
+    # Manifest from a previous attempt, transfer process has not started yet
+    if pid is not None and manifest.pid != pid:
+        return None, None
+
+    if manifest.state == STATE_COMPLETED:
+        verified, message = manifest.verify()
+        if not verified:
+            print('Transfer manifest not verified', message)
+            return True, -1
+        return True, 0
+
+    if manifest.state == STATE_FAILED:
+        print('Transfer failed', manifest.error)
+        return True, -1
+
+    # In progress but transfer process is gone (killed, machine restarted)
+    if not is_process_alive(manifest.pid):
+        print('Transfer process not running and transfer not completed', manifest.pid)
+        return True, -1
+
+    received, expected = manifest.get_progress()
+    print('Transfer in progress', received, 'of', expected, 'bytes')
+    return False, -1
+
+
+# inotify constants (linux/inotify.h)
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_ISDIR = 0x40000000
+IN_Q_OVERFLOW = 0x00004000
+INOTIFY_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+INOTIFY_EVENT = struct.Struct('iIII')
+
+
+class DirectoryWatcher:
+    """
+    Detect files created/written in a directory tree.
+    Uses inotify (linux) if available, otherwise each call walks the directory and compares file sizes.
+    """
+
+    def __init__(self, directory, use_inotify=True):
+        self.directory = pathlib.Path(directory)
+        self.file_sizes = dict()
+        self.libc = None
+        self.inotify_fd = None
+        self.watch_dirs = dict()
+        self.pending_paths = set()
+
+        if use_inotify and sys.platform.startswith('linux'):
+            self._init_inotify()
+
+        # Files already in directory when watch starts
+        self.pending_paths.update(self._walk_files())
+
+    @property
+    def uses_inotify(self):
+        return self.inotify_fd is not None
+
+    def _init_inotify(self):
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            inotify_fd = libc.inotify_init1(os.O_NONBLOCK)
+        except (OSError, AttributeError):
+            return
+        if inotify_fd < 0:
+            return
+        self.libc = libc
+        self.inotify_fd = inotify_fd
+        for this_dir, _, _ in os.walk(self.directory):
+            self._add_watch(this_dir)
+
+    def _add_watch(self, this_dir):
+        watch_id = self.libc.inotify_add_watch(self.inotify_fd, os.fsencode(this_dir), INOTIFY_MASK)
+        if watch_id >= 0:
+            self.watch_dirs[watch_id] = pathlib.Path(this_dir)
+
+    def _walk_files(self):
+        all_files = list()
+        for this_dir, _, files in os.walk(self.directory):
+            all_files.extend([pathlib.Path(this_dir, x) for x in files])
+        return all_files
+
+    def _read_inotify_events(self, timeout):
+        readable, _, _ = select.select([self.inotify_fd], [], [], timeout)
+        if not readable:
+            return
+        try:
+            data = os.read(self.inotify_fd, 1024 * 1024)
+        except BlockingIOError:
+            return
+
+        offset = 0
+        while offset + INOTIFY_EVENT.size <= len(data):
+            watch_id, mask, _, name_length = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+            name = data[offset:offset + name_length].rstrip(b'\0')
+            offset += name_length
+
+            if mask & IN_Q_OVERFLOW:
+                # Events were lost, check all files
+                self.pending_paths.update(self._walk_files())
+                continue
+            if watch_id not in self.watch_dirs or not name:
+                continue
+            path = pathlib.Path(self.watch_dirs[watch_id], os.fsdecode(name))
+            if mask & IN_ISDIR:
+                # New subdirectory, watch it and check files already in it
+                for this_dir, _, files in os.walk(path):
+                    self._add_watch(this_dir)
+                    self.pending_paths.update([pathlib.Path(this_dir, x) for x in files])
+            else:
+                self.pending_paths.add(path)
+
+    def get_changes(self, timeout=0):
+        """
+        Files that changed since previous call
+        Returns:
+            changes (dict): {path relative to directory: current size}
+        """
+        if self.uses_inotify:
+            self._read_inotify_events(timeout)
+            paths = self.pending_paths
+        else:
+            if timeout:
+                time.sleep(timeout)
+            paths = set(self._walk_files())
+        self.pending_paths = set()
+
+        changes = dict()
+        for path in paths:
+            try:
+                size = os.stat(path).st_size
+            except FileNotFoundError:
+                continue
+            rel_path = path.relative_to(self.directory).as_posix()
+            if self.file_sizes.get(rel_path, None) != size:
+                self.file_sizes[rel_path] = size
+                changes[rel_path] = size
+        return changes
+
+    def close(self):
+        if self.inotify_fd is not None:
+            os.close(self.inotify_fd)
+            self.inotify_fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()